@@ -9,13 +9,16 @@ openai.api_key = api_key
 
 config = PromptEngineConfig(ModelConfig(max_tokens=1024), description_prefix = "###")
 
+# The examples of each task go to their own namespace of the prompt bank, an engine only retrieves the examples of its namespace
+prompt_bank = PromptBank()
+
 description1 = "The following prompts tell you the urgency of a notification"
 examples1 = [Interaction("Your flight is going to be delayed! Please check your Delta app for updated schedules", "Urgent"),
     Interaction("Your daughter was just taken to the emergency room. Please call us back immediately.", "Urgent"),
     Interaction("Hey how are you? We should get lunch sometime.", "Low"),
     Interaction("What is the project status? Please send it to me today.", "High"),
     Interaction("Liverpool is now leading in their game vs Aston Villa.", "Medium")]
-dynamic_engine = DynamicPromptEngine(openai_key = api_key, config = config, description = description1, examples=examples1, prompt_bank = PromptBank())
+dynamic_engine = DynamicPromptEngine(openai_key = api_key, config = config, description = description1, examples=examples1, prompt_bank = prompt_bank, namespace = "urgency")
 del dynamic_engine
 
 description2 = "Extract the monuments from the given text"
@@ -26,13 +29,14 @@ Interaction("What is the name of that big Buddha statue in Asia?", "Big Buddha S
 Interaction("I want to see the Eiffel Tower!", "Eiffel Tower"),
 Interaction("Where is The Vatican located in italy?", "The Vatican"),
 Interaction("How many steps are there to the top of the Great Pyramid of Giza?", "Great Pyramid of Giza")]
-dynamic_engine = DynamicPromptEngine(openai_key = api_key, config = config, description = description2, examples=examples2, prompt_bank = PromptBank())
+dynamic_engine = DynamicPromptEngine(openai_key = api_key, config = config, description = description2, examples=examples2, prompt_bank = prompt_bank, namespace = "monuments")
 del dynamic_engine
 
 
 description = "I want to classify the importance for the notifications"
 flow_reset_text = "Ignore the previous queries, start afresh"
-dynamic_engine = DynamicPromptEngine(openai_key = api_key, config = config, description = description, flow_reset_text = flow_reset_text, prompt_bank = PromptBank())
+# This engine classifies notifications too, it retrieves the examples added to the urgency namespace above
+dynamic_engine = DynamicPromptEngine(openai_key = api_key, config = config, description = description, flow_reset_text = flow_reset_text, prompt_bank = prompt_bank, namespace = "urgency")
 
 while True:
     user_query = input("Enter your query: ")
@@ -0,0 +1,44 @@
+### Compares the approximate IVF index with exact search on synthetic embeddings: recall@k and time per query for several nprobe
+### Usage: python ivf_benchmark.py [number of vectors] [dimension] [k] [dtype of the IVF index: float32, float16 or int8]
+
+from prompt_engine.utils.ivf_index import IVFIndex, recall_at_k
+from prompt_engine.utils.vector_index import VectorIndex
+import numpy as np
+import sys
+import time
+
+size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+k = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+dtype = sys.argv[4] if len(sys.argv) > 4 else "float32"
+query_count = 200
+
+# Embeddings of related examples are close to each other, the synthetic ones are drawn around random topics
+rng = np.random.default_rng(0)
+topics = rng.normal(size=(max(1, size // 100), dimension))
+def sample(count):
+    return topics[rng.integers(0, len(topics), count)] + 1.5 * rng.normal(size=(count, dimension))
+
+vectors = sample(size).astype(np.float32)
+queries = sample(query_count).astype(np.float32)
+
+exact_index = VectorIndex()
+exact_index.add_many(vectors)
+
+start = time.perf_counter()
+index = IVFIndex(min_train_size = size, dtype = dtype)
+index.add_many(vectors)
+print("IVF index of %d %s vectors of dimension %d built in %.2f s, %d lists" % (size, dtype, dimension, time.perf_counter() - start, len(index.centroids)))
+
+def time_per_query(search_index):
+    start = time.perf_counter()
+    for query in queries:
+        search_index.search(query, k)
+    return (time.perf_counter() - start) / query_count * 1000
+
+print("exact search: %.3f ms per query" % time_per_query(exact_index))
+for nprobe in [1, 2, 4, 8, 16, 32, 64]:
+    if nprobe > len(index.centroids):
+        break
+    index.nprobe = nprobe
+    print("nprobe %3d: recall@%d %.3f, %.3f ms per query" % (nprobe, k, recall_at_k(index, exact_index, queries, k), time_per_query(index)))
@@ -1,4 +1,23 @@
+import importlib.util
+import os
+
 import setuptools
+from setuptools.command.build_py import build_py
+
+
+class BuildPyWithVocabulary(build_py):
+    """
+    Compiles the bundled vocabulary files into the binary vocabulary shipped with the package
+    """
+    def run(self):
+        super().run()
+        spec = importlib.util.spec_from_file_location("vocabulary", os.path.join("src", "prompt_engine", "utils", "vocabulary.py"))
+        vocabulary = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(vocabulary)
+        utils_directory = os.path.join(self.build_lib, "prompt_engine", "utils")
+        vocabulary.write_vocabulary(os.path.join(utils_directory, vocabulary.VOCABULARY_FILE_NAME),
+                                    os.path.join(utils_directory, "encoder.json"), os.path.join(utils_directory, "vocab.bpe"))
+
 
 with open("README.md", "r", encoding="utf-8") as fh:
     long_description = fh.read()
@@ -23,5 +42,6 @@ setuptools.setup(
     package_dir={"": "src"},
     packages=setuptools.find_packages(where="src"),
     python_requires=">=3.6",
-    package_data={'prompt_engine': ['utils/encoder.json', 'utils/vocab.bpe']},
+    package_data={'prompt_engine': ['utils/encoder.json', 'utils/vocab.bpe', 'utils/encoder.bin']},
+    cmdclass={"build_py": BuildPyWithVocabulary},
 )
\ No newline at end of file
@@ -1,6 +1,7 @@
 from prompt_engine.prompt_engine import PromptEngine, PromptEngineConfig
 from prompt_engine.model_config import ModelConfig
 from prompt_engine.interaction import Interaction
+from prompt_engine.utils.encoder import Encoder
 import yaml
 
 class ChatEngineConfig(PromptEngineConfig):
@@ -16,8 +17,8 @@ class ChatEngine(PromptEngine):
     """
     Chat Engine provides a PromptEngine to construct chat-like prompts for large scale language model inference
     """
-    def __init__(self, config: ChatEngineConfig = ChatEngineConfig(), description: str = "", examples: list = [], flow_reset_text = "", dialog: list = []):
-        super().__init__(config = config, description = description, examples = examples, flow_reset_text = flow_reset_text, dialog = dialog)
+    def __init__(self, config: ChatEngineConfig = ChatEngineConfig(), description: str = "", examples: list = None, flow_reset_text = "", dialog: list = None, encoder: Encoder = None):
+        super().__init__(config = config, description = description, examples = examples, flow_reset_text = flow_reset_text, dialog = dialog, encoder = encoder)
     
     def _load_config_yaml(self, yaml_data):
         """
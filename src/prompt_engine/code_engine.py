@@ -1,6 +1,7 @@
 from prompt_engine.prompt_engine import PromptEngine, PromptEngineConfig
 from prompt_engine.model_config import ModelConfig
 from prompt_engine.interaction import Interaction
+from prompt_engine.utils.encoder import Encoder
 import yaml
 
 class CodeEngineConfig(PromptEngineConfig):
@@ -32,8 +33,8 @@ class CodeEngine(PromptEngine):
     """
     Code Engine provides a PromptEngine to construct nl-to-code prompts for large scale language model inference
     """
-    def __init__(self, config: CodeEngineConfig = PythonCodeEngineConfig(), description: str = "", examples: list = [], flow_reset_text = "", dialog: list = []):
-        super().__init__(config = config, description = description, examples = examples, flow_reset_text = flow_reset_text, dialog = dialog)
+    def __init__(self, config: CodeEngineConfig = PythonCodeEngineConfig(), description: str = "", examples: list = None, flow_reset_text = "", dialog: list = None, encoder: Encoder = None):
+        super().__init__(config = config, description = description, examples = examples, flow_reset_text = flow_reset_text, dialog = dialog, encoder = encoder)
 
     def _load_config_yaml(self, yaml_data):
         """
@@ -0,0 +1,180 @@
+from collections import deque
+from collections.abc import MutableSequence, Sequence
+from typing import Callable, Iterable
+from prompt_engine.interaction import Interaction
+
+class Dialog(MutableSequence):
+    """
+    Dialog holds the interactions of a conversation, oldest first. It behaves like a list, but it is backed by a deque so turns
+    are added and removed at both ends in constant time, and it can be bounded by a maximum number of turns and a maximum number
+    of retained tokens. When a bound is exceeded the oldest turns are evicted.
+    The retained tokens are the sum of the token counts of the rendered turns, which the prompt engine holding the dialog provides
+    through token_counter, so the token bound only applies once the dialog belongs to an engine.
+    The version of the dialog changes whenever its turns change, including when one of its interactions is edited in place,
+    so the caches built from the turns are checked in constant time
+    """
+    def __init__(self, interactions: Iterable[Interaction] = (), max_turns: int = None, max_tokens: int = None):
+        if max_turns is not None and max_turns < 0:
+            raise Exception("The maximum number of turns can not be negative")
+        if max_tokens is not None and max_tokens < 0:
+            raise Exception("The maximum number of tokens can not be negative")
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self._interactions = deque()
+        self._token_counts = deque()
+        self._tokens = 0
+        self._token_counter = None
+        self.version = 0
+        for interaction in interactions:
+            self.add(interaction)
+
+    @property
+    def token_counter(self):
+        return self._token_counter
+
+    @token_counter.setter
+    def token_counter(self, token_counter: Callable):
+        self._token_counter = token_counter
+        self.recount()
+
+    @property
+    def tokens(self):
+        """
+        Number of tokens retained by the dialog, None if the turns are not counted
+        """
+        return self._tokens if self._counting() else None
+
+    def changed(self):
+        """
+        Marks the turns as changed, called by the interactions of the dialog when they are edited
+        """
+        self.version += 1
+
+    def _hold(self, interaction: Interaction):
+        interaction.watch(self)
+        self.version += 1
+
+    def _counting(self):
+        return self.max_tokens is not None and self._token_counter is not None
+
+    def _count(self, interaction: Interaction):
+        return self._token_counter(interaction) if self._counting() else 0
+
+    def recount(self):
+        """
+        Counts the tokens of every turn again, e.g. after the formatting of the turns changed, and evicts the turns over the bounds
+        """
+        self._token_counts = deque(self._count(interaction) for interaction in self._interactions)
+        self._tokens = sum(self._token_counts)
+        return self._evict()
+
+    def add(self, interaction: Interaction):
+        """
+        Appends an interaction and returns the interactions evicted to stay within the bounds, oldest first
+        """
+        self._hold(interaction)
+        token_count = self._count(interaction)
+        self._interactions.append(interaction)
+        self._token_counts.append(token_count)
+        self._tokens += token_count
+        return self._evict()
+
+    def _evict(self):
+        evicted = []
+        while len(self._interactions) > 0 and ((self.max_turns is not None and len(self._interactions) > self.max_turns)
+                                              or (self._counting() and self._tokens > self.max_tokens)):
+            evicted.append(self.popleft())
+        return evicted
+
+    def append(self, interaction: Interaction):
+        self.add(interaction)
+
+    def popleft(self):
+        if len(self._interactions) == 0:
+            raise IndexError("pop from an empty dialog")
+        self.version += 1
+        self._tokens -= self._token_counts.popleft()
+        return self._interactions.popleft()
+
+    def pop(self, index: int = -1):
+        if len(self._interactions) == 0:
+            raise IndexError("pop from an empty dialog")
+        if index == 0 or index == -len(self._interactions):
+            return self.popleft()
+        if index == -1 or index == len(self._interactions) - 1:
+            self.version += 1
+            self._tokens -= self._token_counts.pop()
+            return self._interactions.pop()
+        interaction = self._interactions[index]
+        del self[index]
+        return interaction
+
+    def clear(self):
+        self.version += 1
+        self._interactions.clear()
+        self._token_counts.clear()
+        self._tokens = 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._interactions)[index]
+        return self._interactions[index]
+
+    def __setitem__(self, index, interaction):
+        if isinstance(index, slice):
+            interactions = list(self._interactions)
+            interactions[index] = interaction
+            for held in interactions:
+                self._hold(held)
+            self._interactions = deque(interactions)
+            self.recount()
+        else:
+            self._hold(interaction)
+            token_count = self._count(interaction)
+            self._tokens += token_count - self._token_counts[index]
+            self._interactions[index] = interaction
+            self._token_counts[index] = token_count
+            self._evict()
+
+    def __delitem__(self, index):
+        self.version += 1
+        if isinstance(index, slice):
+            interactions = list(self._interactions)
+            del interactions[index]
+            self._interactions = deque(interactions)
+            self.recount()
+        else:
+            self._tokens -= self._token_counts[index]
+            del self._interactions[index]
+            del self._token_counts[index]
+
+    def insert(self, index: int, interaction: Interaction):
+        self._hold(interaction)
+        token_count = self._count(interaction)
+        self._interactions.insert(index, interaction)
+        self._token_counts.insert(index, token_count)
+        self._tokens += token_count
+        self._evict()
+
+    def __len__(self):
+        return len(self._interactions)
+
+    def __iter__(self):
+        return iter(self._interactions)
+
+    def __reversed__(self):
+        return reversed(self._interactions)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and list(self._interactions) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Dialog(%r, max_turns=%r, max_tokens=%r)" % (list(self._interactions), self.max_turns, self.max_tokens)
+
+    def __reduce__(self):
+        # The token counter belongs to the engine holding the dialog, it is attached again when the dialog is given to an engine
+        return (Dialog, (list(self._interactions), self.max_turns, self.max_tokens))
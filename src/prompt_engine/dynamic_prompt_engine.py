@@ -6,199 +6,691 @@
 
 from prompt_engine.prompt_engine import PromptEngine, PromptEngineConfig
 from prompt_engine.interaction import Interaction
-from prompt_engine.prompt_engine import get_encoder
+from prompt_engine.utils.encoder import Encoder, get_shared_encoder
+from prompt_engine.utils.embedding_provider import EmbeddingProvider, OpenAIEmbeddingProvider
+from prompt_engine.utils.embedding_store import get_shared_store
+from prompt_engine.utils.lru_cache import LRUCache
+from prompt_engine.utils.vector_index import normalize, quantize, VectorIndex, VECTOR_DTYPES
 import openai
 from pathlib import Path
 from typing import List, Dict
-from openai.embeddings_utils import (
-    get_embedding,
-    distances_from_embeddings,
-    indices_of_nearest_neighbors_from_distances,
-)
+import asyncio
+import json
 import os
-import pandas as pd
 import pickle
 import string 
+import threading
+import zlib
+
+DEFAULT_QUERY_CACHE_SIZE = 4096
+DEFAULT_RESULT_CACHE_SIZE = 4096
+# Namespace of the dynamic prompt engines whose examples are added without a namespace and which search the whole prompt bank
+WHOLE_BANK = ""
+
+
+class ExamplePartition:
+    """
+    The examples of one namespace of a prompt bank, with their embeddings indexed for search
+    """
+    def __init__(self, index = None):
+        self.index = index if index is not None else VectorIndex()
+        self.rows = {}
+        self.keys = []
+        self.examples = []
+
+    def __len__(self):
+        return len(self.examples)
+
+    def add(self, key, embedding, example: Interaction):
+        """
+        Indexes an entry, replacing the one of its key. Returns the vector kept by the index, see add_many
+        """
+        row = self.rows.get(key)
+        if row is None:
+            return self.add_many([(key, embedding, example)])[0]
+        self.index.set(row, embedding, normalized=True)
+        self.examples[row] = example
+        return self.vector(row, embedding)
+
+    def add_many(self, entries):
+        """
+        Indexes (key, embedding, example) entries whose keys are not in the partition yet. The embeddings are expected normalized
+        and of the type of the index, as stored in the bank. Returns the vectors kept by the index, views of its rows when it
+        hands them out, which the bank keeps in place of the embeddings so they are only held once
+        """
+        if len(entries) == 0:
+            return []
+        rows = self.index.add_many([embedding for _, embedding, _ in entries], normalized=True)
+        for row, (key, _, example) in zip(rows, entries):
+            self.rows[key] = row
+            self.keys.append(key)
+            self.examples.append(example)
+        return [self.vector(row, embedding) for row, (_, embedding, _) in zip(rows, entries)]
+
+    def vector(self, row: int, embedding):
+        # Indexes whose rows move (IVFIndex) do not hand out views, the embedding is kept as it is
+        return self.index.row(row) if hasattr(self.index, "row") else embedding
+
+    def search(self, embedding, k: int):
+        """
+        Returns the k examples nearest to the embedding along with their cosine similarities and their keys, nearest first
+        """
+        rows, similarities = self.index.search(embedding, k)
+        return [(self.examples[row], similarity, self.keys[row]) for row, similarity in zip(rows, similarities)]
+
 
 class OpenAIEmbedding:
-    def __init__(self, cache_location: str = os.getcwd()):
+    def __init__(self, cache_location: str = os.getcwd(), provider: EmbeddingProvider = None, query_cache_size: int = DEFAULT_QUERY_CACHE_SIZE, result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE, index_class = VectorIndex,
+                 dtype: str = "float32"):
         """
-        This function initializes the OpenAI service
+        This function initializes the OpenAI service, the embeddings are computed by the provider and searched with indexes made
+        by index_class, exact ones by default. The embeddings are normalized once when they are added, and stored and indexed
+        as dtype: float32, or float16 or int8 to take 2 or 4 times less space
         """
-        # load the cache if it exists, and save a copy to disk
-        if (os.path.exists("cache") == False):
-            os.mkdir("cache")
+        if dtype not in VECTOR_DTYPES:
+            raise Exception("Unsupported vector type %s, expected one of %s" % (dtype, ", ".join(VECTOR_DTYPES)))
+        self.provider = provider if provider is not None else OpenAIEmbeddingProvider()
+        self.index_class = index_class
+        self.dtype = dtype
+
+        # The embeddings of queries are kept in memory, apart from the examples, and so are the examples retrieved for a query
+        # until the examples they were retrieved from change. The versions count the changes of the whole bank and of each namespace
+        self.query_cache = LRUCache(query_cache_size)
+        self.result_cache = LRUCache(result_cache_size)
+        self._version = 0
+        self._versions = {}
 
+        # Embeddings are appended to a persistent store, opening it maps the vectors instead of reading them.
+        # A cache pickled by earlier versions is imported into the store the first time it is opened
         self.cache_path = os.path.join(cache_location, "embeddings_cache.pkl")
+        self.store = get_shared_store(os.path.join(cache_location, "embeddings_store"))
+        if len(self.store) == 0 and os.path.exists(self.cache_path):
+            self._import_pickled_cache(self.cache_path)
 
-        # load the cache if it exists
-        try:
-            self.embedding_cache = pd.read_pickle(self.cache_path)
-        except FileNotFoundError:
-            self.embedding_cache = {}
+        # The token spans of the rendered examples are stored next to their embeddings, keyed by the encoder and the rendered
+        # text they were measured on (see DynamicPromptEngine), so the examples retrieved are packed without tokenizing them
+        self.embedding_cache = {}
+        self.token_costs = {}
+        for key, vector, metadata in self.store.items():
+            # The vectors of the store are normalized, they are only converted if they were stored in another type
+            if vector.dtype != self.dtype:
+                vector = self._vector(vector)
+            self.embedding_cache[key] = [vector, Interaction(metadata["input"], metadata["response"])]
+            if "tokens" in metadata:
+                self.token_costs[key] = metadata["tokens"]
 
-        # Store the embedding cache in a pickle file
-        with open(self.cache_path, "wb") as embedding_cache_file:
-            pickle.dump(self.embedding_cache, embedding_cache_file)
+        # The examples of the cache are indexed for search, one partition per namespace, when the first recommendations are
+        # asked for, then kept up to date
+        self._partitions = None
     
-    def embedding_from_string(self, string: str, example: Interaction = None, engine: str = "text-similarity-davinci-001", embedding_cache=None, query = False):
-        """Return embedding of given string, using a cache to avoid recomputing."""
+    def _engine(self, engine: str = None):
+        # The engine only names the model in the keys of the cache, the embeddings are computed by the provider
+        if engine is None:
+            return self.provider.name
+        if engine != self.provider.name:
+            raise Exception("The embeddings are computed by %s, not %s" % (self.provider.name, engine))
+        return engine
+
+    @staticmethod
+    def _key(string: str, engine: str, namespace: str = None):
+        # Examples without a namespace keep the keys of the caches made before namespaces existed
+        return (string, engine) if namespace is None else (string, engine, namespace)
+
+    @staticmethod
+    def _namespace(key):
+        return key[2] if len(key) > 2 else None
+
+    def embedding_from_string(self, string: str, example: Interaction = None, engine: str = None, embedding_cache=None, query = False, namespace: str = None):
+        """Return embedding of given string, using a cache to avoid recomputing. Examples are stored in the partition of the namespace,
+        queries are embedded by query_embedding and not stored."""
         
+        engine = self._engine(engine)
+        key = self._key(string, engine, namespace)
+
         # Make a temp Interaction object to get its embedding while building a prompt
         if example is None:
             example = Interaction(input=string, response="")
 
+        if query:
+            embedding = self.query_embedding(string, engine)
+            return [embedding, example] if embedding is not None else None
+
         # If the embedding cache is not provided, use the default one
         if embedding_cache is None:
             embedding_cache = self.embedding_cache
 
         # if the embedding is already in the cache, return it, otherwise compute it
-        if (string, engine) not in embedding_cache.keys() or (embedding_cache[(string, engine)][1].response == "" and query == False):
+        if key not in embedding_cache.keys() or embedding_cache[key][1].response == "":
             print (f"Computing embedding for unseen interaction!")
             success, embedding = self.get_embedding_with_retries(string, engine)
             if success:
-                embedding_cache[(string, engine)] = [embedding, example]
-                with open(self.cache_path, "wb") as embedding_cache_file:
-                    pickle.dump(embedding_cache, embedding_cache_file)
+                entries = [(key, embedding, example)]
+                self._store_embeddings(embedding_cache, entries)
+                self._persist_embeddings(embedding_cache, entries)
 
-                return embedding_cache[(string, engine)]
+                return embedding_cache[key]
             else:
                 return None
         
         else:
-            return embedding_cache[(string, engine)]
+            return embedding_cache[key]
 
-    def get_embedding_with_retries(self, text, engine, retries = 3):
+    def _pending_embeddings(self, strings: List[str], examples: List[Interaction], engine: str, namespace: str = None, token_costs: List[dict] = None):
         """
-        This function is used to get the embedding of a string from OpenAI. It is used to handle the case where the API is rate limited.
+        Splits the examples to embed under the strings into the ones to send to the provider, and the ones whose string was
+        already embedded (as a query, or in another namespace), whose embedding is reused. Cached examples given token costs
+        they were not stored with are stored again
         """
-        try:
-            if retries > 0:
-                return True, get_embedding(text, engine)
-        except openai.error.RateLimitError:
-            if retries > 0:
-                return self.get_embedding_with_retries(text, engine, retries - 1)
+        pending = {}
+        reused = []
+        for position, (text, example) in enumerate(zip(strings, examples)):
+            key = self._key(text, engine, namespace)
+            added_costs = self._add_token_costs(key, token_costs[position] if token_costs is not None else None)
+            cached = self.embedding_cache.get(key)
+            if cached is not None and (cached[1].response != "" or example.response == ""):
+                if added_costs:
+                    reused.append((key, cached[0], cached[1]))
+                continue
+            if cached is None:
+                cached = self.embedding_cache.get(self._key(text, engine))
+            embedding = cached[0] if cached is not None else self.query_cache.get((text, engine))
+            if embedding is not None:
+                reused.append((key, embedding, example))
             else:
-                print('\n\n# OpenAI API error: Rate limit exceeded, try later')
-                return False, None
-        except openai.error.APIConnectionError:
-            if retries > 0:
-                return self.get_embedding_with_retries(text, engine, retries - 1)
+                pending.setdefault(key, example)
+        return pending, reused
+
+    def embeddings_from_strings(self, strings: List[str], examples: List[Interaction], engine: str = None, namespace: str = None, token_costs: List[dict] = None):
+        """
+        Embeds many examples, each under the string at the same position, in the partition of the namespace. The strings that
+        are not cached yet are sent to the provider in batches, several batches at a time. token_costs are stored along, a dict
+        per example mapping cost keys to token span records. Returns False if some embeddings could not be computed
+        """
+        pending, reused, keys = self._start_embeddings(strings, examples, self._engine(engine), namespace, token_costs)
+        results = self.provider.embed_many([key[0] for key in keys], self.get_embeddings_with_retries)
+        succeeded, entries = self._finish_embeddings(pending, reused, keys, results)
+        self._persist_embeddings(self.embedding_cache, entries)
+        return succeeded
+
+    async def aembeddings_from_strings(self, strings: List[str], examples: List[Interaction], engine: str = None, executor = None, namespace: str = None, token_costs: List[dict] = None):
+        """
+        Async variant of embeddings_from_strings, the batches are awaited and the store is written in the executor
+        """
+        pending, reused, keys = self._start_embeddings(strings, examples, self._engine(engine), namespace, token_costs)
+        results = await self.provider.aembed_many([key[0] for key in keys], self.aget_embeddings_with_retries)
+        succeeded, entries = self._finish_embeddings(pending, reused, keys, results)
+        await asyncio.get_running_loop().run_in_executor(executor, self._persist_embeddings, self.embedding_cache, entries)
+        return succeeded
+
+    def _start_embeddings(self, strings: List[str], examples: List[Interaction], engine: str, namespace: str, token_costs: List[dict]):
+        # The part of (a)embeddings_from_strings before the requests: the examples to embed, those reused and the keys to send
+        pending, reused = self._pending_embeddings(strings, examples, engine, namespace, token_costs)
+        keys = list(pending.keys())
+        if len(keys) > 0:
+            print (f"Computing embeddings for {len(keys)} unseen interactions!")
+        return pending, reused, keys
+
+    def _finish_embeddings(self, pending, reused, keys, results):
+        # The part of (a)embeddings_from_strings after the requests: caches and indexes the embeddings, returns whether they
+        # were all computed and the entries left to persist
+        entries = []
+        succeeded = self._completed_entries(pending, keys, results, entries)
+        self._store_embeddings(self.embedding_cache, reused, normalized=True)
+        self._store_embeddings(self.embedding_cache, entries)
+        return succeeded, reused + entries
+
+    def _completed_entries(self, pending, keys, results, entries):
+        # Adds the embeddings of the batches that succeeded to the entries, returns whether they all did
+        succeeded = True
+        start = 0
+        for success, embeddings in results:
+            batch = keys[start:start + self.provider.batch_size]
+            start += len(batch)
+            if success:
+                entries.extend((key, embedding, pending[key]) for key, embedding in zip(batch, embeddings))
             else:
-                print('\n\n# OpenAI API error: API connection error, are you connected to the internet?')
-                return False, None
-        except openai.error.InvalidRequestError as e:
-            print('\n\n# OpenAI API error: Invalid request - ' + str(e))
-            return False, None
+                succeeded = False
+        return succeeded
+
+    def _add_token_costs(self, key, costs: dict = None):
+        # Returns whether some of the costs were not known yet
+        if not costs:
+            return False
+        known = self.token_costs.setdefault(key, {})
+        added = any(known.get(cost_key) != record for cost_key, record in costs.items())
+        known.update(costs)
+        return added
+
+    def _vector(self, embedding, normalized: bool = False):
+        # The embeddings are kept as contiguous arrays of the type of the bank instead of lists of floats. Normalized ones,
+        # e.g. those of the bank or of the query cache, are at most converted to the type of the bank
+        if not normalized:
+            embedding = normalize(embedding)
+        return embedding if embedding.dtype == self.dtype else quantize(embedding, self.dtype)
+
+    def _store_embeddings(self, embedding_cache, entries, normalized: bool = False):
+        for key, embedding, example in entries:
+            embedding = self._vector(embedding, normalized)
+            embedding_cache[key] = [embedding, example]
+            if embedding_cache is self.embedding_cache and example.response != "":
+                self._version += 1
+                self._versions[self._namespace(key)] = self._version
+                if self._partitions is not None:
+                    self._index_example(key, embedding, example)
+
+    def _index_example(self, key, embedding, example: Interaction):
+        # Only examples are searched, the embeddings of queries are cached with an empty response
+        if example.response == "":
+            return
+        namespace = self._namespace(key)
+        partition = self._partitions.get(namespace)
+        if partition is None:
+            partition = self._partitions[namespace] = ExamplePartition(self._new_index())
+        self.embedding_cache[key][0] = partition.add(key, embedding, example)
+
+    def _get_partitions(self):
+        if self._partitions is None:
+            entries = {}
+            for key, (embedding, example) in self.embedding_cache.items():
+                if example.response != "":
+                    entries.setdefault(self._namespace(key), []).append((key, embedding, example))
+            self._partitions = {namespace: self._build_partition(namespace, namespace_entries) for namespace, namespace_entries in entries.items()}
+        return self._partitions
+
+    def _build_partition(self, namespace: str, entries):
+        partition = self._load_partition(namespace, entries)
+        if partition is None:
+            partition = ExamplePartition(self._new_index())
+            self._share_vectors(entries, partition.add_many(entries))
+        return partition
+
+    def _share_vectors(self, entries, vectors):
+        # The cache keeps the vectors held by the index instead of its own copies
+        for (key, _, _), vector in zip(entries, vectors):
+            self.embedding_cache[key][0] = vector
+
+    def _new_index(self):
+        # The indexes keep the vectors in the type of the bank
+        return self.index_class() if self.dtype == "float32" else self.index_class(dtype=self.dtype)
+
+    def _index_path(self, namespace: str):
+        return os.path.join(self.store.path, "search-index.%08x.npz" % zlib.crc32(json.dumps(namespace).encode()))
+
+    def _load_partition(self, namespace: str, entries):
+        """
+        Loads the index saved for the namespace by save_indexes, if the examples it was saved with are still the first ones of the
+        namespace. The vectors stored again since are replaced and the examples stored since are added
+        """
+        index = self._new_index()
+        path = self._index_path(namespace)
+        if not hasattr(index, "save") or not os.path.exists(path):
+            return None
+        saved_index, metadata = type(index).load(path)
+        saved_keys = metadata.get("keys", [])
+        if (metadata.get("namespace") != namespace or metadata.get("generation") != self.store.generation or len(saved_index) != len(saved_keys)
+                or getattr(saved_index, "dtype", "float32") != self.dtype
+                or saved_keys != [list(key) for key, _, _ in entries[:len(saved_keys)]]):
+            return None
+
+        # The search parameters are the ones asked for, not the saved ones
+        saved_index.nprobe = index.nprobe
+        partition = ExamplePartition(saved_index)
+        for row, (key, embedding, example) in enumerate(entries[:len(saved_keys)]):
+            partition.rows[key] = row
+            partition.keys.append(key)
+            partition.examples.append(example)
+            sequence = self.store.sequence(key)
+            if sequence is None or sequence >= metadata["records"]:
+                saved_index.set(row, embedding, normalized=True)
+        self._share_vectors(entries[len(saved_keys):], partition.add_many(entries[len(saved_keys):]))
+        return partition
+
+    def save_indexes(self):
+        """
+        Saves the indexes that support it (the approximate ones) next to the store, so they are loaded instead of built again
+        """
+        for namespace, partition in self._get_partitions().items():
+            if hasattr(partition.index, "save"):
+                metadata = {"namespace": namespace, "generation": self.store.generation, "records": self.store.records,
+                            "keys": [list(key) for key in partition.keys]}
+                partition.index.save(self._index_path(namespace), metadata)
+
+    def namespaces(self):
+        """
+        Returns the namespaces holding examples, None stands for the examples stored without one
+        """
+        return list(self._get_partitions().keys())
+
+    def _persist_embeddings(self, embedding_cache, entries):
+        if embedding_cache is self.embedding_cache:
+            self.store.append_many((key, embedding_cache[key][0], self._metadata(key, example)) for key, _, example in entries)
+
+    def _metadata(self, key, example: Interaction):
+        metadata = {"input": example.input, "response": example.response}
+        if key in self.token_costs:
+            metadata["tokens"] = self.token_costs[key]
+        return metadata
+
+    def _import_pickled_cache(self, cache_path: str):
+        with open(cache_path, "rb") as embedding_cache_file:
+            embedding_cache = pickle.load(embedding_cache_file)
+        self.store.append_many((key, self._vector(embedding), {"input": example.input, "response": example.response})
+                               for key, (embedding, example) in embedding_cache.items())
+
+    def compact(self):
+        """
+        Gives back the space of the superseded embeddings in the store
+        """
+        self.store.compact()
+
+    def get_embedding_with_retries(self, text, engine = None):
+        """
+        This function is used to get the embedding of a string from the provider, see get_embeddings_with_retries
+        """
+        success, embeddings = self.get_embeddings_with_retries([text])
+        return success, embeddings[0] if success else None
+
+    def get_embeddings_with_retries(self, texts):
+        """
+        Gets the embeddings of a batch of strings from the provider. The OpenAI provider retries with backoff when the API is rate
+        limited or can not be reached (see EmbeddingClient), the error left once its retries are exhausted is reported here
+        """
+        try:
+            return True, self.provider.embed(texts)
+        except Exception as e:
+            return self._embedding_error(e)
+
+    async def aget_embedding_with_retries(self, text, engine = None):
+        """
+        Async variant of get_embedding_with_retries
+        """
+        success, embeddings = await self.aget_embeddings_with_retries([text])
+        return success, embeddings[0] if success else None
+
+    async def aget_embeddings_with_retries(self, texts):
+        """
+        Async variant of get_embeddings_with_retries
+        """
+        try:
+            return True, await self.provider.aembed(texts)
         except Exception as e:
+            return self._embedding_error(e)
+
+    @staticmethod
+    def _embedding_error(e: Exception):
+        if isinstance(e, openai.error.RateLimitError):
+            print('\n\n# OpenAI API error: Rate limit exceeded, try later')
+        elif isinstance(e, openai.error.Timeout):
+            print('\n\n# OpenAI API error: Request timed out, try later')
+        elif isinstance(e, openai.error.APIConnectionError):
+            print('\n\n# OpenAI API error: API connection error, are you connected to the internet?')
+        elif isinstance(e, openai.error.InvalidRequestError):
+            print('\n\n# OpenAI API error: Invalid request - ' + str(e))
+        else:
             print('\n\n# OpenAI API error: Unexpected exception - ' + str(e))
-            return False, None
+        return False, None
+
+    def query_embedding(self, string: str, engine: str = None):
+        """
+        Returns the embedding of a query, None if it could not be computed. The embeddings of recent queries are kept in memory,
+        they are not stored with the examples
+        """
+        engine = self._engine(engine)
+        embedding = self.query_cache.get((string, engine))
+        if embedding is None:
+            cached = self.embedding_cache.get((string, engine))
+            if cached is not None:
+                embedding = cached[0]
+            else:
+                success, embedding = self.get_embedding_with_retries(string)
+                if not success:
+                    return None
+                embedding = normalize(embedding)
+            self.query_cache.put((string, engine), embedding)
+        return embedding
 
-    def get_recommendations_from_strings(self, source_string: int, k_nearest_neighbors: int = 3, engine="text-similarity-davinci-001"):
-        """Print out the k nearest neighbors of a given string."""
+    async def aquery_embedding(self, string: str, engine: str = None):
+        """
+        Async variant of query_embedding
+        """
+        engine = self._engine(engine)
+        embedding = self.query_cache.get((string, engine))
+        if embedding is None:
+            cached = self.embedding_cache.get((string, engine))
+            if cached is not None:
+                embedding = cached[0]
+            else:
+                success, embedding = await self.aget_embedding_with_retries(string)
+                if not success:
+                    return None
+                embedding = normalize(embedding)
+            self.query_cache.put((string, engine), embedding)
+        return embedding
 
-        all_embeddings_except_empty = [x for x in self.embedding_cache.values() if x[1].response != ""]
+    def get_recommendations_from_strings(self, source_string: int, k_nearest_neighbors: int = 3, engine = None, namespace: str = None):
+        """Return the k examples nearest to a given string, by cosine similarity of their embeddings.
+        Only the examples of the namespace are searched, or those of every namespace if it is None.
+        The examples found for recent strings are reused until the examples searched change."""
 
-        # get embeddings for all strings
-        embeddings:List[List] = [em[0] for em in all_embeddings_except_empty]
+        return [example for example, _, _ in self.get_candidates_from_strings(source_string, k_nearest_neighbors, engine, namespace)]
+
+    def get_candidates_from_strings(self, source_string: str, k_nearest_neighbors: int = 3, engine = None, namespace: str = None):
+        """
+        Like get_recommendations_from_strings, but returns (example, similarity, token costs) candidates, the token costs being
+        the dict of the token span records stored with the example
+        """
+        engine = self._engine(engine)
+        version = self._versions.get(namespace, 0) if namespace is not None else self._version
+        result_key = (source_string, engine, namespace, k_nearest_neighbors)
+        cached = self.result_cache.get(result_key)
+        if cached is not None and cached[0] == version:
+            return self._with_token_costs(cached[1])
+
+        partitions = self._get_partitions()
+        if namespace is not None:
+            partitions = [partitions[namespace]] if namespace in partitions else []
+        else:
+            partitions = list(partitions.values())
 
         # get the embedding of the source string
-        query_embedding = self.embedding_from_string(source_string, Interaction(input=source_string, response=""), engine=engine, query=True)[0]
+        query_embedding = self.query_embedding(source_string, engine)
         if query_embedding is None:
             raise Exception("Could not get embedding for source string, please try again")
 
-        # get distances between the source embedding and other embeddings (function from embeddings_utils.py)
-        distances = distances_from_embeddings(query_embedding, embeddings, distance_metric="cosine")
+        # a single matrix-vector product scores every example of a partition, only the k best are sorted
+        candidates = [candidate for partition in partitions for candidate in partition.search(query_embedding, k_nearest_neighbors)]
+        if len(partitions) > 1:
+            candidates.sort(key=lambda candidate: -candidate[1])
 
-        # get indices of nearest neighbors (function from embeddings_utils.py)
-        indices_of_nearest_neighbors = indices_of_nearest_neighbors_from_distances(distances)
+        candidates = candidates[:k_nearest_neighbors]
+        self.result_cache.put(result_key, (version, candidates))
+        return self._with_token_costs(candidates)
 
-        return [all_embeddings_except_empty[i][1] for k, i in enumerate(indices_of_nearest_neighbors) if k<k_nearest_neighbors]
+    def _with_token_costs(self, candidates):
+        # The costs are looked up when returned, so the ones stored after the candidates were cached are found too
+        return [(example, similarity, self.token_costs.get(key, {})) for example, similarity, key in candidates]
 
 
 class PromptBank:
     """
-    This class provides a bank of prompts for the Chat Engine
+    This class provides a bank of prompts for the Chat Engine. The embeddings are computed by the provider, OpenAI embeddings
+    by default, and stored in cache_location, the working directory by default
     """
-    def __init__(self):
+    def __init__(self, provider: EmbeddingProvider = None, cache_location: str = None, query_cache_size: int = DEFAULT_QUERY_CACHE_SIZE, result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE, index_class = VectorIndex,
+                 dtype: str = "float32"):
         # Examples is a list of interactions
-        self.openaiservice = OpenAIEmbedding()
+        self.openaiservice = OpenAIEmbedding(cache_location if cache_location is not None else os.getcwd(), provider, query_cache_size, result_cache_size, index_class, dtype)
+
+    @property
+    def provider(self):
+        return self.openaiservice.provider
+
+    def add_examples(self, strings: List[str], examples: List[Interaction], namespace: str = None, token_costs: List[dict] = None):
+        """
+        Adds the examples to the partition of the namespace, each embedded from the string at the same position.
+        token_costs are stored with the examples and returned by retrieve_candidates, see OpenAIEmbedding.embeddings_from_strings
+        """
+        if not self.openaiservice.embeddings_from_strings(strings, examples, namespace=namespace, token_costs=token_costs):
+            raise Exception("Could not get embedding for example, please try again")
+
+    def namespaces(self):
+        return self.openaiservice.namespaces()
+
+    def save_indexes(self):
+        """
+        Saves the approximate indexes of the bank next to its embeddings, see OpenAIEmbedding.save_indexes
+        """
+        self.openaiservice.save_indexes()
 
     # Returns a list of interactions that are similar to the given interaction
-    def retrieve_matched_prompts(self, query: str, limit: int = 5):
+    def retrieve_matched_prompts(self, query: str, limit: int = 5, namespace: str = None):
         """
-        This function retrieves the prompts that match the query
+        This function retrieves the prompts that match the query, from the partition of the namespace or from the whole bank if it is None
         """
 
-        relevantExamples = self.openaiservice.get_recommendations_from_strings(source_string = query, k_nearest_neighbors = limit)
+        relevantExamples = self.openaiservice.get_recommendations_from_strings(source_string = query, k_nearest_neighbors = limit, namespace = namespace)
         return relevantExamples
 
+    def retrieve_candidates(self, query: str, limit: int = 5, namespace: str = None):
+        """
+        Like retrieve_matched_prompts, but returns (example, similarity, token costs) candidates, so the examples can be packed
+        into a prompt with the token spans stored with them
+        """
+        return self.openaiservice.get_candidates_from_strings(source_string = query, k_nearest_neighbors = limit, namespace = namespace)
+
+    async def aretrieve_matched_prompts(self, query: str, limit: int = 5, executor = None, namespace: str = None):
+        """
+        Async variant of retrieve_matched_prompts. The embedding of the query is awaited, then the nearest examples are
+        searched in the executor
+        """
+        await self.aembed_query(query, executor)
+        return await asyncio.get_running_loop().run_in_executor(executor, self.retrieve_matched_prompts, query, limit, namespace)
+
+    async def aembed_query(self, query: str, executor = None):
+        """
+        Computes the embedding of a query ahead of retrieve_matched_prompts, which then finds it in the cache
+        """
+        embedding = await self.openaiservice.aquery_embedding(query)
+        if embedding is None:
+            raise Exception("Could not get embedding for source string, please try again")
+
+
+_shared_prompt_banks = {}
+_shared_prompt_banks_lock = threading.Lock()
+
+def get_shared_prompt_bank(cache_location: str = None):
+    """
+    Returns the prompt bank of the cache location (the working directory by default), with the default embedding provider,
+    creating it on first use. The dynamic prompt engines given no prompt bank share it, so the embeddings of the location are
+    loaded once per process and the engines only search the partitions of their namespaces
+    """
+    cache_location = os.path.realpath(cache_location if cache_location is not None else os.getcwd())
+    with _shared_prompt_banks_lock:
+        prompt_bank = _shared_prompt_banks.get(cache_location)
+        if prompt_bank is None:
+            prompt_bank = _shared_prompt_banks[cache_location] = PromptBank(cache_location=cache_location)
+        return prompt_bank
+
 
 class DynamicPromptEngine(PromptEngine):
     """
     Chat Engine provides a PromptEngine to construct chat-like prompts for large scale language model inference
     """
+    # The examples are retrieved for every user input, so they are not part of a static prefix
+    static_prefix_cacheable = False
 
-    def __init__(self, openai_key: str, config: PromptEngineConfig = PromptEngineConfig(), description: str = "", examples: list = [], flow_reset_text = "", dialog: list = [], prompt_bank: PromptBank = PromptBank()):
+    def __init__(self, openai_key: str, config: PromptEngineConfig = PromptEngineConfig(), description: str = "", examples: list = None, flow_reset_text = "", dialog: list = None, prompt_bank: PromptBank = None, encoder: Encoder = None, namespace: str = None):
         """
-        Initializes the Dynamic Prompt Engine
+        Initializes the Dynamic Prompt Engine. Its examples are added to the partition of the namespace in the prompt bank, and
+        only that partition is searched. The namespace defaults to the normalized description, so engines of different tasks sharing
+        a prompt bank never retrieve each other's examples. With namespace = WHOLE_BANK (or no description), the whole bank is searched.
+        Engines given no prompt bank share the one of the working directory, see get_shared_prompt_bank
         """
         self.config = config
         self.description = description
-        self.examples = examples
+        self.examples = examples if examples is not None else []
         self.flow_reset_text = flow_reset_text
-        self.dialog = dialog
+        self.encoder = encoder if encoder is not None else get_shared_encoder()
+        self.dialog = dialog if dialog is not None else []
         self.context: str = ""
         
-        # Set the auth key for the OpenAI service
-        openai.api_key = openai_key
+        # Set the auth key for the OpenAI service, it is not needed by a prompt bank with another embedding provider
+        if openai_key is not None:
+            openai.api_key = openai_key
 
         # Initialize the prompt bank
-        self.prompt_bank = prompt_bank
+        self.prompt_bank = prompt_bank if prompt_bank is not None else get_shared_prompt_bank()
+        if namespace is None:
+            namespace = self.preprocess_for_embedding_computation(description, "").strip()
+        self.namespace = namespace if namespace != WHOLE_BANK else None
 
         # If there are examples, add them to the embedding cache
         if (self.examples != []):
             self.__add_examples_to_embedding_cache(self.examples, self.description)
-
-        self.encoder = get_encoder()
     
     # Overriding the _insert_examples function from the PromptEngine class to achieve the dynamic prompt engine behavior
     def _insert_examples(self, context: str = "", user_input: str = ""):
         """
         Inserts the examples into the context
         """
-        temp_examples_text = ""
+        temp_examples_texts = []
         if user_input == "":
-            examples = self.examples
+            candidates = [(example, None, None) for example in self.examples]
         else:
             processed_embedding_query_text = self.preprocess_for_embedding_computation(self.description, user_input)
-            examples = self.prompt_bank.retrieve_matched_prompts(processed_embedding_query_text)
-        if (examples != []):
-            for example in examples:
-                temp_example_text = self.config.input_prefix + example.input + self.config.input_postfix + self.config.newline_operator
-                temp_example_text += self.config.output_prefix +  example.response + self.config.output_postfix +  self.config.newline_operator*2
-            
-                if (self._assert_token_limit(context + temp_example_text, user_input, self.config.model_config.max_tokens)):
+            candidates = self.prompt_bank.retrieve_candidates(processed_embedding_query_text, namespace=self.namespace)
+        if (candidates != []):
+            token_budget = self._get_token_budget()
+            render_key = self._example_render_key()
+            context_span = token_budget.span(context)
+            for example, _, token_costs in candidates:
+                temp_example_text = example.render(render_key, self._format_example)
+                # The span stored in the bank is used instead of tokenizing the example, only the seam with the context is tokenized
+                record = token_costs.get(self._token_cost_key(temp_example_text)) if token_costs else None
+                example_span = example.token_span(render_key, self._format_example, token_budget, record)
+
+                if (self._assert_span_token_limit(token_budget.concat(context_span, example_span), user_input, self.config.model_config.max_tokens)):
                     raise Exception("""Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig
                     It is highly recommended to lowering the number of examples to have more room for interactions""")
                 else:
-                    temp_examples_text += temp_example_text
+                    temp_examples_texts.append(temp_example_text)
 
-            context += temp_examples_text
+            context = "".join([context] + temp_examples_texts)
         return context
     
+    async def _aprepare_context(self, user_input: str = "", executor = None):
+        """
+        Awaits the embedding of the user input, so the retrieval of the examples while building the context finds it in the cache
+        """
+        if user_input != "":
+            processed_embedding_query_text = self.preprocess_for_embedding_computation(self.description, user_input)
+            await self.prompt_bank.aembed_query(processed_embedding_query_text, executor if executor is not None else self.executor)
+
     def __add_examples_to_embedding_cache(self, examples: List[Interaction], description:str = ""):
         """
         This function adds the examples to the embedding cache
         """
 
-        # Creating embeddings for each example using the OpenAI service
+        # Creating embeddings for the examples with batched requests to the embedding provider
         # A single embedding is a combination of the main description of the task and the natural language input of the example
-        for example in examples:
-            processed_example = self.preprocess_for_embedding_computation(description, example.input)
-            embedding = self.prompt_bank.openaiservice.embedding_from_string(processed_example, example, engine="text-similarity-davinci-001", embedding_cache=self.prompt_bank.openaiservice.embedding_cache)
-            if embedding is None:
-                raise Exception("Could not get embedding for example, please try again")
+        processed_examples = [self.preprocess_for_embedding_computation(description, example.input) for example in examples]
+        self.prompt_bank.add_examples(processed_examples, examples, self.namespace, [self._example_token_costs(example) for example in examples])
+
+    def _example_token_costs(self, example: Interaction):
+        """
+        Returns the token span of the rendered example keyed by its cost key, to be stored with the example in the prompt bank
+        """
+        render_key = self._example_render_key()
+        cost_key = self._token_cost_key(example.render(render_key, self._format_example))
+        if cost_key is None:
+            return None
+        return {cost_key: example.token_span(render_key, self._format_example, self._get_token_budget()).record()}
+
+    def _token_cost_key(self, example_text: str):
+        # A stored span is only valid for the rendered text it was measured on and for the vocabulary that measured it
+        if self.encoder.name is None:
+            return None
+        return "%s:%08x" % (self.encoder.name, zlib.crc32(example_text.encode()))
 
     def preprocess_for_embedding_computation(self, description, user_input):
         """
@@ -1,7 +1,117 @@
+import weakref
+from prompt_engine.utils.token_budget import TokenSpan
+
 class Interaction:
     """
-    Interaction class is used to store natural natural language and code pairs to be used in the prompt engine
+    Interaction class is used to store natural natural language and code pairs to be used in the prompt engine.
+    It remembers the text it was last rendered into and the tokens of that text, keyed by the formatting that produced them,
+    so unchanged examples and dialog turns are neither rendered nor tokenized again. Changing the input or the response drops them
+    and tells the dialogs holding the interaction that it changed
     """
+    __slots__ = ("_input", "_response", "_render_key", "_text", "_span", "_span_encoder", "_dialogs")
+
     def __init__(self, input, response):
-        self.input = input
-        self.response = response
\ No newline at end of file
+        self._input = input
+        self._response = response
+        self._render_key = None
+        self._text = None
+        self._span = None
+        self._span_encoder = None
+        self._dialogs = None
+
+    @property
+    def input(self):
+        return self._input
+
+    @input.setter
+    def input(self, input):
+        self._input = input
+        self._invalidate()
+
+    @property
+    def response(self):
+        return self._response
+
+    @response.setter
+    def response(self, response):
+        self._response = response
+        self._invalidate()
+
+    def _invalidate(self):
+        self._render_key = None
+        self._text = None
+        self._span = None
+        self._span_encoder = None
+        if self._dialogs is not None:
+            for reference in self._dialogs:
+                dialog = reference()
+                if dialog is not None:
+                    dialog.changed()
+
+    def watch(self, dialog):
+        """
+        Registers a dialog holding the interaction, its changed() method is called whenever the interaction is changed.
+        The dialog is only weakly referenced
+        """
+        references = [reference for reference in self._dialogs or () if reference() is not None]
+        if not any(reference() is dialog for reference in references):
+            references.append(weakref.ref(dialog))
+        self._dialogs = tuple(references)
+
+    def render(self, key, render):
+        """
+        Returns the interaction rendered by render(interaction), reusing the last rendering if it was made with the same key
+        """
+        if self._text is None or self._render_key != key:
+            self._text = render(self)
+            self._render_key = key
+            self._span = None
+        return self._text
+
+    def token_span(self, key, render, token_budget, record = None):
+        """
+        Returns the token span of the rendered interaction, reusing the last one if it was made with the same key and encoder.
+        A record of the span measured earlier (see TokenSpan.record) is used instead of tokenizing the rendering
+        """
+        text = self.render(key, render)
+        if self._span is None or self._span_encoder is not token_budget.encoder:
+            span = TokenSpan.from_record(record, text) if record is not None else None
+            self._span = span if span is not None else token_budget.tokenize(text)
+            self._span_encoder = token_budget.encoder
+        return self._span
+
+    @property
+    def token_count(self):
+        """
+        Number of tokens of the last tokenized rendering, None if it has not been tokenized
+        """
+        return self._span.count if self._span is not None else None
+
+    def __getstate__(self):
+        return {"input": self._input, "response": self._response}
+
+    def __setstate__(self, state):
+        self.__init__(state["input"], state["response"])
+
+
+class FrozenInteraction(Interaction):
+    """
+    An interaction that can not be changed once created, e.g. one of the examples shared by the sessions of a prompt template
+    """
+    __slots__ = ()
+
+    @property
+    def input(self):
+        return self._input
+
+    @input.setter
+    def input(self, input):
+        raise Exception("A frozen interaction can not be changed, create a new one instead")
+
+    @property
+    def response(self):
+        return self._response
+
+    @response.setter
+    def response(self, response):
+        raise Exception("A frozen interaction can not be changed, create a new one instead")
@@ -1,7 +1,24 @@
+import copy
+
 class ModelConfig:
     """
     Interaction class is used to store the model config to be used in the prompt engine
     """
     def __init__(self, max_tokens, **kwargs):
         self.max_tokens = max_tokens
-        self.__dict__.update(kwargs)
\ No newline at end of file
+        self.__dict__.update(kwargs)
+
+
+class FrozenModelConfig(ModelConfig):
+    """
+    A model config that can not be changed once created, e.g. the one of a frozen prompt engine config
+    """
+    def __init__(self, model_config: ModelConfig):
+        # The values are deep copied, so changing the original ones (e.g. a list of stop sequences) does not change this config
+        self.__dict__.update(copy.deepcopy(model_config.__dict__))
+
+    def __setattr__(self, name, value):
+        raise Exception("A frozen model config can not be changed, create a new one instead")
+
+    def __delattr__(self, name):
+        raise Exception("A frozen model config can not be changed, create a new one instead")
@@ -1,13 +1,48 @@
 from prompt_engine.interaction import Interaction
-from prompt_engine.model_config import ModelConfig
-from typing import List
-from prompt_engine.utils.encoder import Encoder, get_encoder
+from prompt_engine.model_config import FrozenModelConfig, ModelConfig
+from typing import Iterable, List
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import asyncio
+import functools
+import multiprocessing
+import pickle
+import threading
+from operator import attrgetter
+from prompt_engine.utils.encoder import Encoder, get_shared_encoder
+from prompt_engine.utils.token_budget import TokenBudget, EMPTY_SPAN
+from prompt_engine.utils.dialog_index import DialogTokenIndex
+from prompt_engine.prompt_renderer import PromptRenderer
+from prompt_engine.dialog import Dialog
 import yaml
 
+TOKEN_LIMIT_MESSAGE = "Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig"
+EXAMPLES_TOKEN_LIMIT_MESSAGE = """Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig
+                    It is highly recommended to lowering the number of examples to have more room for interactions"""
+
+# Static part of a prompt along with what it was built from and the spans on which the token limit is checked
+StaticPrefix = namedtuple("StaticPrefix", ["key", "examples", "example_texts", "text", "span", "checks"])
+
+# Guards the lazy creation of the per-engine locks
+_engine_lock_creation = threading.Lock()
+
+def _synchronized(method):
+    """
+    Runs the method under the lock of the engine, so prompts built in executor threads never see the engine half updated
+    """
+    @functools.wraps(method)
+    def synchronized_method(self, *args, **kwargs):
+        with self._get_lock():
+            return method(self, *args, **kwargs)
+    return synchronized_method
+
 class PromptEngineConfig: 
     """
     This class provides the configuration for the Prompt Engine
     """
+    renderer_class = PromptRenderer
+
     def __init__(self, model_config: ModelConfig = ModelConfig(max_tokens=1024), description_prefix: str = "", description_postfix: str = "", newline_operator: str = "\n",
                  input_prefix: str = "", input_postfix: str = "", output_prefix: str = "", output_postfix: str = ""):
                  
@@ -23,19 +58,94 @@ class PromptEngineConfig:
         self.output_prefix = output_prefix + " " if output_prefix != "" else ""
         self.output_postfix = " " + output_postfix if output_postfix != "" else ""
 
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_frozen", False):
+            raise Exception("The config is frozen and can not be changed")
+        # Any change to the config drops the renderer compiled from it
+        self.__dict__.pop("_renderer", None)
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        """
+        Prevents any further change to the config, e.g. while it is shared by the sessions of a prompt template. Its model config
+        is replaced by a frozen copy, as it may be shared with other configs, e.g. the default one
+        """
+        if self.model_config is not None:
+            self.__dict__["model_config"] = FrozenModelConfig(self.model_config)
+        self.compile()
+        self.__dict__["_frozen"] = True
+
+    def compile(self):
+        """
+        Returns the renderer compiled from this config, it is kept until the config changes
+        """
+        renderer = self.__dict__.get("_renderer")
+        if renderer is None:
+            renderer = self.renderer_class(self)
+            self.__dict__["_renderer"] = renderer
+        return renderer
+
 class PromptEngine(object):
     """
     Prompt Engine provides a reusable interface for the developer to construct prompts for large scale language model inference
     """
-    def __init__(self, config: PromptEngineConfig = PromptEngineConfig(), description: str = "", examples: List[Interaction] = [], flow_reset_text: str = "", dialog: List[Interaction] = []):
+    # Executor that runs the tokenization of the async methods, None uses the default executor of the event loop
+    executor = None
+    # Whether the description, the examples and the flow reset text are rendered and tokenized once and reused, rather than
+    # inserted by the _insert_* methods for every prompt, and whether build_prompts builds the prompts from that prefix rather than
+    # by calling build_prompt. A subclass overriding one of STATIC_PREFIX_STEPS or PROMPT_STEPS gets False unless it sets it itself,
+    # e.g. to True when its override only wraps the method of the PromptEngine
+    static_prefix_cacheable = True
+    STATIC_PREFIX_STEPS = ("_insert_description", "_insert_examples", "_insert_flow_reset_text", "_assert_token_limit", "_assert_span_token_limit")
+    PROMPT_STEPS = ("build_prompt", "build_context", "format_input", "_insert_interactions")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "static_prefix_cacheable" not in cls.__dict__ and any(name in cls.__dict__ for name in PromptEngine.STATIC_PREFIX_STEPS + PromptEngine.PROMPT_STEPS):
+            cls.static_prefix_cacheable = False
+
+    def __init__(self, config: PromptEngineConfig = PromptEngineConfig(), description: str = "", examples: List[Interaction] = None, flow_reset_text: str = "", dialog: List[Interaction] = None, encoder: Encoder = None):
         
         self.config = config
         self.description = description
-        self.examples = examples
+        self.examples = examples if examples is not None else []
         self.flow_reset_text = flow_reset_text
-        self.dialog = dialog
-        self.encoder = get_encoder()
+        # The tokenizer is expensive to build, so engines share a single process-wide instance unless one is injected
+        self.encoder = encoder if encoder is not None else get_shared_encoder()
+        self.dialog = dialog if dialog is not None else []
+
+    def __getstate__(self):
+        # The caches are rebuilt on demand, they are left out so copies sent to worker processes stay small
+        state = self.__dict__.copy()
+        for name in ("_token_budget", "_dialog_index", "_static_prefix", "_lock"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dialog.token_counter = self._count_interaction_tokens
+
+    @property
+    def dialog(self):
+        return self._dialog
+
+    @dialog.setter
+    def dialog(self, dialog: List[Interaction]):
+        """
+        Sets the dialog of the engine. A Dialog is used as is, while the interactions of any other list are copied into a new Dialog
+        with the bounds of the dialog it replaces, so changing that list afterwards does not change the dialog of the engine
+        """
+        if not isinstance(dialog, Dialog):
+            previous_dialog = getattr(self, "_dialog", None)
+            if previous_dialog is not None:
+                dialog = Dialog(dialog, max_turns = previous_dialog.max_turns, max_tokens = previous_dialog.max_tokens)
+            else:
+                dialog = Dialog(dialog)
+        self._dialog = dialog
+        self._dialog_index = None
+        dialog.token_counter = self._count_interaction_tokens
 
+    @_synchronized
     def load_yaml(self, yaml_config: str):
         """
         Loads the yaml file and initializes the Prompt Engine
@@ -111,24 +221,29 @@ class PromptEngine(object):
         return yaml.dump(yaml_data, default_flow_style=False)
     
 
+    @_synchronized
     def build_context(self, user_input: str = "", multi_turn: bool = True):
         """
         Builds the context from the description, examples, and interactions.
         """
-        context: str = ""
+        if self.static_prefix_cacheable:
+            # The description, the examples and the flow reset text are rendered and tokenized once, only the limits are checked
+            context = self._insert_static_prefix(user_input)
+        else:
+            context: str = ""
 
-        # Add the description to the context
-        context = self._insert_description(context, user_input)
-        
-        # Add the examples to the context
-        context = self._insert_examples(context, user_input)
-        
-        # Checks if the number of tokens after adding the examples in the context is greater than the max_tokens
-        if (self.config.model_config != None and self._assert_token_limit(context, user_input, self.config.model_config.max_tokens)):
-            raise Exception("Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig")
-        
-        # Add the flow reset text to the context
-        context = self._insert_flow_reset_text(context, user_input)
+            # Add the description to the context
+            context = self._insert_description(context, user_input)
+            
+            # Add the examples to the context
+            context = self._insert_examples(context, user_input)
+            
+            # Checks if the number of tokens after adding the examples in the context is greater than the max_tokens
+            if (self.config.model_config != None and self._assert_token_limit(context, user_input, self.config.model_config.max_tokens)):
+                raise Exception(TOKEN_LIMIT_MESSAGE)
+            
+            # Add the flow reset text to the context
+            context = self._insert_flow_reset_text(context, user_input)
 
         if multi_turn:
             # Add the interactions to the context
@@ -136,6 +251,7 @@ class PromptEngine(object):
 
         return context
 
+    @_synchronized
     def build_prompt(self, user_input: str, multi_turn: bool = True, newline_end: bool = True):
         """
         Builds the prompt from the parameters given to the Prompt Engine 
@@ -146,46 +262,163 @@ class PromptEngine(object):
 
         return prompt
 
-    def build_dialog(self):
-        temp_interactions = ""
-        if (self.dialog != []):
-            for interaction in self.dialog:
-                temp_interaction_text = self.config.input_prefix + interaction.input + self.config.input_postfix + self.config.newline_operator
-                temp_interaction_text += self.config.output_prefix +  interaction.response + self.config.output_postfix +  self.config.newline_operator*2
+    async def abuild_context(self, user_input: str = "", multi_turn: bool = True, executor = None):
+        """
+        Async variant of build_context. The tokenization runs in the executor, so the event loop keeps serving other requests
+        while a large context is assembled
+        """
+        await self._aprepare_context(user_input, executor)
+        return await self._run_in_executor(executor, self.build_context, user_input, multi_turn)
+
+    async def abuild_prompt(self, user_input: str, multi_turn: bool = True, newline_end: bool = True, executor = None):
+        """
+        Async variant of build_prompt. The tokenization runs in the executor, so the event loop keeps serving other requests
+        while a large prompt is assembled
+        """
+        await self._aprepare_context(self.format_input(user_input, newline_end), executor)
+        return await self._run_in_executor(executor, self.build_prompt, user_input, multi_turn, newline_end)
+
+    async def _aprepare_context(self, user_input: str = "", executor = None):
+        """
+        Awaits the I/O needed to build the context for the user input before the context is built in the executor.
+        The Prompt Engine needs none, engines that do should override it
+        """
 
-                temp_interactions += temp_interaction_text
+    def _run_in_executor(self, executor, function, *args):
+        return asyncio.get_running_loop().run_in_executor(executor if executor is not None else self.executor, function, *args)
 
-        return temp_interactions
+    def build_prompts(self, user_inputs: Iterable[str], multi_turn: bool = True, newline_end: bool = True, workers: int = None, stream: bool = False, chunk_size: int = 256):
+        """
+        Builds the prompts of many user inputs against the same context, in input order.
+        The description, examples, flow reset text and dialog are rendered and tokenized once for the whole batch, so each prompt
+        only costs formatting its input and checking the token limit. Passing workers splits the inputs in chunks built by a pool of
+        worker processes, each holding a copy of the engine, so changes made to the engine during the call are not seen. Unless the
+        processes are forked, the engine is pickled to be copied: engines that can not be pickled, e.g. a DynamicPromptEngine
+        holding an open prompt bank, build the prompts in the calling process instead. With stream set, returns a generator
+        that yields the prompts as they are built instead of a list
+        """
+        prompts = self._stream_prompts(user_inputs, multi_turn, newline_end, workers, chunk_size)
+        return prompts if stream else list(prompts)
+
+    def _stream_prompts(self, user_inputs: Iterable[str], multi_turn: bool, newline_end: bool, workers: int, chunk_size: int):
+        if workers is None or workers <= 1 or not self._copyable_to_workers():
+            build_prompt = self._prompt_builder(multi_turn, newline_end)
+            for user_input in user_inputs:
+                yield build_prompt(user_input)
+            return
+
+        # Only a few chunks are in flight at a time, so large batches are neither read nor held in memory all at once
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_prompt_worker, initargs=(self, multi_turn, newline_end)) as pool:
+            pending = deque()
+            user_inputs = iter(user_inputs)
+            while True:
+                chunk = list(islice(user_inputs, chunk_size))
+                if chunk != []:
+                    pending.append(pool.submit(_build_prompt_chunk, chunk))
+                if pending and (chunk == [] or len(pending) >= workers * 2):
+                    yield from pending.popleft().result()
+                elif chunk == []:
+                    return
+
+    def _copyable_to_workers(self):
+        """
+        Checks that the worker processes can get a copy of the engine: forked processes inherit it, the others unpickle it
+        """
+        if multiprocessing.get_start_method() == "fork":
+            return True
+        try:
+            pickle.dumps(self)
+            return True
+        except Exception:
+            return False
+
+    def _prompt_builder(self, multi_turn: bool = True, newline_end: bool = True):
+        """
+        Returns a function that builds the prompt of a user input like build_prompt does, with the parts of the prompt that do
+        not depend on the input built beforehand. Engines whose static prefix is not cacheable get build_prompt itself
+        """
+        if not self.static_prefix_cacheable:
+            return lambda user_input: self.build_prompt(user_input, multi_turn, newline_end)
+
+        static_prefix = self._get_static_prefix()
+        self._get_token_budget().remember(static_prefix.text, static_prefix.span)
+        dialog_index = self._get_dialog_index() if multi_turn and len(self.dialog) > 0 else None
+        renderer = self.config.compile()
+        lock = self._get_lock()
+
+        def build_prompt(user_input: str):
+            with lock:
+                return build_locked_prompt(user_input)
+
+        def build_locked_prompt(user_input: str):
+            formatted_input = renderer.input(user_input, newline_end)
+            self._check_static_prefix(static_prefix, formatted_input)
+            if dialog_index is None:
+                return static_prefix.text + formatted_input
+            turns = dialog_index.window(static_prefix.span, formatted_input, self.config.model_config.max_tokens)
+            if turns is None:
+                return self._insert_interactions(static_prefix.text, formatted_input) + formatted_input
+            return "".join((static_prefix.text, dialog_index.text(turns), formatted_input))
+
+        return build_prompt
+
+    @_synchronized
+    def build_dialog(self):
+        render_key = self._render_key()
+        return "".join([interaction.render(render_key, self._format_interaction) for interaction in self.dialog])
 
+    @_synchronized
     def add_example(self, input: str, response: str):
         """
         Adds an interaction to the example
         """
+        if isinstance(self.examples, tuple):
+            raise Exception("The examples are shared by a prompt template and can not be changed")
         example = Interaction(input, response)
         self.examples.append(example)
     
+    @_synchronized
     def add_interaction(self, input: str, response: str):
         """
         Adds an interaction to the interactions
         """
         interaction = Interaction(input, response)
-        self.dialog.append(interaction)
-
+        dialog_index = self._get_dialog_index(build = False)
+        evicted = self.dialog.add(interaction)
+        if dialog_index is not None:
+            dialog_index.append(interaction)
+            # The oldest turns are evicted when the dialog is over its bounds
+            for _ in evicted:
+                dialog_index.popleft()
+            dialog_index.sync(self.dialog)
+
+    @_synchronized
     def remove_last_interaction(self):
         """
         Removes the last interaction from the interactions
         """
         if (len(self.dialog) > 0):
-            return self.dialog.pop()
+            dialog_index = self._get_dialog_index(build = False)
+            interaction = self.dialog.pop()
+            if dialog_index is not None:
+                dialog_index.pop()
+                dialog_index.sync(self.dialog)
+            return interaction
         else:
             raise Exception("No interactions to remove")
 
+    @_synchronized
     def remove_first_interaction(self):
         """
         Removes the first interaction from the interactions
         """
         if (len(self.dialog) > 0):
-            return self.dialog.pop(0)
+            dialog_index = self._get_dialog_index(build = False)
+            interaction = self.dialog.pop(0)
+            if dialog_index is not None:
+                dialog_index.popleft()
+                dialog_index.sync(self.dialog)
+            return interaction
         else:
             raise Exception("No interactions to remove")
 
@@ -193,13 +426,11 @@ class PromptEngine(object):
         """
         Inserts the description into the context
         """
-        temp_description_text = ""
         if (self.description != ""):
-            temp_description_text += self.config.description_prefix + self.description + self.config.description_postfix +  self.config.newline_operator
-            temp_description_text += self.config.newline_operator
+            temp_description_text = self.config.compile().description(self.description)
 
             if (self._assert_token_limit(context + temp_description_text, user_input, self.config.model_config.max_tokens)):
-                raise Exception("Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig")
+                raise Exception(TOKEN_LIMIT_MESSAGE)
             
             context += temp_description_text
 
@@ -209,19 +440,23 @@ class PromptEngine(object):
         """
         Inserts the examples into the context
         """
-        temp_examples_text = ""
+        temp_examples_texts = []
         if (self.examples != []):
+            token_budget = self._get_token_budget()
+            render_key = self._example_render_key()
+            examples_span = token_budget.span(context)
             for example in self.examples:
-                temp_example_text = self.config.input_prefix + example.input + self.config.input_postfix + self.config.newline_operator
-                temp_example_text += self.config.output_prefix +  example.response + self.config.output_postfix +  self.config.newline_operator*2
-            
-                if (self._assert_token_limit(context + temp_examples_text + temp_example_text, user_input, self.config.model_config.max_tokens)):
-                    raise Exception("""Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig
-                    It is highly recommended to lowering the number of examples to have more room for interactions""")
+                temp_example_text = example.render(render_key, self._format_example)
+                temp_examples_span = token_budget.concat(examples_span, example.token_span(render_key, self._format_example, token_budget))
 
-                temp_examples_text += temp_example_text
+                if (self._assert_span_token_limit(temp_examples_span, user_input, self.config.model_config.max_tokens)):
+                    raise Exception(EXAMPLES_TOKEN_LIMIT_MESSAGE)
 
-            context += temp_examples_text
+                temp_examples_texts.append(temp_example_text)
+                examples_span = temp_examples_span
+
+            context = "".join([context] + temp_examples_texts)
+            token_budget.remember(context, examples_span)
         
         return context
 
@@ -229,13 +464,11 @@ class PromptEngine(object):
         """
         Inserts the examples into the context
         """
-        temp_flow_reset_text = ""
         if (self.flow_reset_text != ""):
-            temp_flow_reset_text += self.config.description_prefix + self.flow_reset_text + self.config.description_postfix + self.config.newline_operator
-            temp_flow_reset_text += self.config.newline_operator
+            temp_flow_reset_text = self.config.compile().flow_reset(self.flow_reset_text)
            
             if (self._assert_token_limit(context + temp_flow_reset_text, user_input, self.config.model_config.max_tokens)):
-                raise Exception("Token limit exceeded, reduce the number of examples or size of description. Alternatively, you may increase the max_tokens in ModelConfig")
+                raise Exception(TOKEN_LIMIT_MESSAGE)
                 
             context += temp_flow_reset_text
 
@@ -245,18 +478,31 @@ class PromptEngine(object):
         """
         Inserts the interactions into the context
         """
-        temp_interactions_text = ""
+        temp_interactions_texts = []
         if (self.dialog != []):
+            token_budget = self._get_token_budget()
+            context_span = token_budget.span(context)
+
+            # The token counts of the turns are kept as the dialog changes, so the turns that fit are found by binary search
+            dialog_index = self._get_dialog_index()
+            turns = dialog_index.window(context_span, user_input, self.config.model_config.max_tokens)
+            if turns is not None:
+                return context + dialog_index.text(turns)
+
+            # Otherwise the limit is checked on the joined spans of the interactions, which are tokenized only once
+            interactions_span = EMPTY_SPAN
             for interaction in self.dialog[::-1]:
-                temp_interaction_text = self.config.input_prefix + interaction.input + self.config.input_postfix + self.config.newline_operator
-                temp_interaction_text += self.config.output_prefix +  interaction.response + self.config.output_postfix +  self.config.newline_operator*2
+                temp_interaction_text, interaction_span = self._measure_interaction(interaction)
 
-                if (self._assert_token_limit(context + temp_interactions_text + temp_interaction_text, user_input, self.config.model_config.max_tokens)):
+                if (self._assert_span_token_limit(token_budget.concat(context_span, interactions_span, interaction_span), user_input, self.config.model_config.max_tokens)):
                     break
                 
-                temp_interactions_text = temp_interaction_text + temp_interactions_text
+                temp_interactions_texts.append(temp_interaction_text)
+                interactions_span = token_budget.concat(interaction_span, interactions_span)
 
-            context += temp_interactions_text
+            # The interactions were collected from the newest to the oldest
+            temp_interactions_texts.append(context)
+            context = "".join(temp_interactions_texts[::-1])
         
         return context
     
@@ -264,27 +510,153 @@ class PromptEngine(object):
         """
         Inserts the prompt into the context
         """
-        temp_prompt_text = ""
-        if (user_input != ""):
-            temp_prompt_text += self.config.input_prefix + user_input + self.config.input_postfix
-            if (newline_end):
-                temp_prompt_text += self.config.newline_operator
-
-        return temp_prompt_text
+        return self.config.compile().input(user_input, newline_end)
     
+    @_synchronized
     def reset_context(self):
         self.dialog = []
         return self.build_context()
 
+    def _get_static_prefix(self):
+        """
+        Returns the static prefix, made of the description, the examples and the flow reset text, rebuilding it if any of them,
+        the config or the encoder changed since it was built
+        """
+        key = (self.description, self.flow_reset_text, self._example_render_key(), self.config.model_config, self.encoder)
+        static_prefix = getattr(self, "_static_prefix", None)
+        if (static_prefix is not None and static_prefix.key == key and static_prefix.examples == list(self.examples)
+                and list(map(attrgetter("_text"), self.examples)) == static_prefix.example_texts):
+            return static_prefix
+        static_prefix = self._static_prefix = self._build_static_prefix(key)
+        return static_prefix
+
+    def _build_static_prefix(self, key: tuple):
+        """
+        Renders and tokenizes the static prefix, remembering the spans on which _insert_description, _insert_examples,
+        build_context and _insert_flow_reset_text check the token limit
+        """
+        token_budget = self._get_token_budget()
+        renderer = self.config.compile()
+        texts = []
+        checks = []
+        span = EMPTY_SPAN
+
+        if (self.description != ""):
+            texts.append(renderer.description(self.description))
+            span = token_budget.tokenize(texts[-1])
+            checks.append((span, TOKEN_LIMIT_MESSAGE))
+
+        render_key = self._example_render_key()
+        for example in self.examples:
+            texts.append(example.render(render_key, self._format_example))
+            span = token_budget.concat(span, example.token_span(render_key, self._format_example, token_budget))
+            checks.append((span, EXAMPLES_TOKEN_LIMIT_MESSAGE))
+
+        # Checking the same span again cannot fail
+        if (self.config.model_config != None and (checks == [] or checks[-1][0] is not span)):
+            checks.append((span, TOKEN_LIMIT_MESSAGE))
+
+        if (self.flow_reset_text != ""):
+            texts.append(renderer.flow_reset(self.flow_reset_text))
+            span = token_budget.concat(span, token_budget.tokenize(texts[-1]))
+            checks.append((span, TOKEN_LIMIT_MESSAGE))
+
+        # The joined text is kept on the span, so it is never flattened again while the static prefix is shared
+        text = "".join(texts)
+        token_budget.remember(text, span)
+        return StaticPrefix(key, list(self.examples), [example._text for example in self.examples], text, span, checks)
+
+    def _insert_static_prefix(self, user_input: str = ""):
+        """
+        Returns the static prefix after checking that every step of it leaves room for the user input
+        """
+        static_prefix = self._get_static_prefix()
+        self._check_static_prefix(static_prefix, user_input)
+        self._get_token_budget().remember(static_prefix.text, static_prefix.span)
+        return static_prefix.text
+
+    def _check_static_prefix(self, static_prefix: StaticPrefix, user_input: str = ""):
+        for span, message in static_prefix.checks:
+            if (self._assert_span_token_limit(span, user_input, self.config.model_config.max_tokens)):
+                raise Exception(message)
+
+    def _format_example(self, example: Interaction):
+        """
+        Renders an example the way it appears in the prompt, custom formats are set with the renderer_class of the config
+        """
+        return self.config.compile().example(example)
+
+    def _format_interaction(self, interaction: Interaction):
+        """
+        Renders a dialog interaction the way it appears in the prompt, custom formats are set with the renderer_class of the config
+        """
+        return self.config.compile().interaction(interaction)
+
+    def _example_render_key(self):
+        """
+        Identifies the formatting of examples, the renderings and token counts cached on them are reused while it stays the same
+        """
+        return (type(self)._format_example, self.config.compile().key)
+
+    def _render_key(self):
+        """
+        Identifies the formatting of interactions, the renderings and token counts cached on them are reused while it stays the same
+        """
+        return (type(self)._format_interaction, self.config.compile().key)
+
+    def _measure_interaction(self, interaction: Interaction):
+        """
+        Returns the rendered interaction and its token span, both cached on the interaction
+        """
+        render_key = self._render_key()
+        return interaction.render(render_key, self._format_interaction), interaction.token_span(render_key, self._format_interaction, self._get_token_budget())
+
+    def _get_dialog_index(self, build: bool = True):
+        """
+        Returns the index of the token counts of the dialog turns, rebuilding it if the dialog or the formatting changed
+        behind its back. With build set to False, returns None instead of rebuilding
+        """
+        key = self._render_key()
+        token_budget = self._get_token_budget()
+        dialog_index = getattr(self, "_dialog_index", None)
+        if dialog_index is not None and dialog_index.token_budget is token_budget and dialog_index.matches(self.dialog, key):
+            return dialog_index
+        if not build:
+            return None
+        if key != getattr(dialog_index, "key", key):
+            # The formatting changed, so did the token counts that bound the dialog
+            self.dialog.recount()
+        dialog_index = self._dialog_index = DialogTokenIndex(token_budget, self._measure_interaction, key)
+        dialog_index.rebuild(self.dialog)
+        return dialog_index
+
+    def _count_interaction_tokens(self, interaction: Interaction):
+        return self._measure_interaction(interaction)[1].count
+
+    def _get_lock(self):
+        lock = self.__dict__.get("_lock")
+        if lock is None:
+            with _engine_lock_creation:
+                lock = self.__dict__.setdefault("_lock", threading.RLock())
+        return lock
+
+    def _get_token_budget(self):
+        """
+        Returns the token budget that keeps the running token counts of the contexts being built
+        """
+        token_budget = getattr(self, "_token_budget", None)
+        if token_budget is None or token_budget.encoder is not self.encoder:
+            token_budget = self._token_budget = TokenBudget(self.encoder)
+        return token_budget
+
     def _assert_token_limit(self, context: str, user_input: str = "", max_tokens: int = 1024):
         """
         Asserts that the number of tokens in the context is less than the max_tokens
         """
         if context != None and user_input != None:
             if context != "":
-                num_tokens = len(self.encoder.encode(context))
-                if user_input != "":
-                    num_tokens = len(self.encoder.encode(context + user_input))
+                # Only the part of the context that was not counted by a previous call is tokenized
+                num_tokens = self._get_token_budget().count(context, user_input, max_tokens)
                 if num_tokens > max_tokens:
                     return True
                 else:
@@ -292,4 +664,25 @@ class PromptEngine(object):
             else:
                 return False
         else:
-            raise Exception("The string to assert is None")
\ No newline at end of file
+            raise Exception("The string to assert is None")
+
+    def _assert_span_token_limit(self, context_span, user_input: str = "", max_tokens: int = 1024):
+        """
+        Asserts that the number of tokens in an already tokenized context is less than the max_tokens
+        """
+        if user_input == None:
+            raise Exception("The string to assert is None")
+        if context_span.length == 0:
+            return False
+        return self._get_token_budget().count_span(context_span, user_input, max_tokens) > max_tokens
+
+
+# Engine used by the worker processes of build_prompts, along with its prompt builder
+_worker_prompt_builder = None
+
+def _init_prompt_worker(engine: PromptEngine, multi_turn: bool, newline_end: bool):
+    global _worker_prompt_builder
+    _worker_prompt_builder = engine._prompt_builder(multi_turn, newline_end)
+
+def _build_prompt_chunk(user_inputs: List[str]):
+    return [_worker_prompt_builder(user_input) for user_input in user_inputs]
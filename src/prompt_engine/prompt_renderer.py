@@ -0,0 +1,59 @@
+from typing import List
+from prompt_engine.interaction import Interaction
+
+class PromptRenderer:
+    """
+    PromptRenderer renders the blocks of a prompt for a PromptEngineConfig. The constant fragments around the text of every block
+    are computed once from the config, so each block is assembled with a single join.
+    Custom block formats are plugged in by subclassing it and changing the formats (or overriding the render methods),
+    then setting renderer_class on the config class, this is the supported way to customize the rendering of prompts
+    """
+    def __init__(self, config):
+        newline_operator = config.newline_operator
+
+        # Fragments that go before, between and after the texts of a block
+        self.description_format = (config.description_prefix, config.description_postfix + newline_operator*2)
+        self.example_format = (config.input_prefix, config.input_postfix + newline_operator + config.output_prefix, config.output_postfix + newline_operator*2)
+        self.interaction_format = self.example_format
+        self.input_format = (config.input_prefix, config.input_postfix)
+        self.input_end = newline_operator
+        self._key = None
+
+    @property
+    def key(self):
+        """
+        Identifies the rendered output, renderings cached on interactions are reused while it stays the same
+        """
+        if self._key is None:
+            self._key = (type(self), self.description_format, self.example_format, self.interaction_format, self.input_format, self.input_end)
+        return self._key
+
+    def description(self, description: str):
+        if description == "":
+            return ""
+        prefix, suffix = self.description_format
+        return "".join((prefix, description, suffix))
+
+    def flow_reset(self, flow_reset_text: str):
+        # The flow reset text is rendered like the description
+        return self.description(flow_reset_text)
+
+    def example(self, example: Interaction):
+        prefix, infix, suffix = self.example_format
+        return "".join((prefix, example.input, infix, example.response, suffix))
+
+    def interaction(self, interaction: Interaction):
+        prefix, infix, suffix = self.interaction_format
+        return "".join((prefix, interaction.input, infix, interaction.response, suffix))
+
+    def examples(self, examples: List[Interaction]):
+        return "".join([self.example(example) for example in examples])
+
+    def dialog(self, dialog: List[Interaction]):
+        return "".join([self.interaction(interaction) for interaction in dialog])
+
+    def input(self, user_input: str, newline_end: bool = True):
+        if user_input == "":
+            return ""
+        prefix, suffix = self.input_format
+        return "".join((prefix, user_input, suffix, self.input_end if newline_end else ""))
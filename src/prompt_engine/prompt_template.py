@@ -0,0 +1,70 @@
+import copy
+import inspect
+from typing import Iterable, List
+from prompt_engine.interaction import FrozenInteraction, Interaction
+from prompt_engine.prompt_engine import PromptEngine, PromptEngineConfig
+from prompt_engine.utils.encoder import Encoder, get_shared_encoder
+
+class PromptTemplate:
+    """
+    PromptTemplate is the immutable part of a prompt engine: the config, the description, the examples and the flow reset text.
+    The static prefix they make up is rendered and tokenized once, when the template is created, and shared with every session.
+    Sessions are prompt engines that hold nothing but their own dialog and the token counts cached for it, so a single template
+    can serve many concurrent conversations, each session being used by one thread at a time
+    """
+    __slots__ = ("config", "description", "examples", "flow_reset_text", "encoder", "engine_class", "_static_prefix", "_frozen")
+
+    def __init__(self, config: PromptEngineConfig = None, description: str = "", examples: Iterable[Interaction] = (), flow_reset_text: str = "",
+                 encoder: Encoder = None, engine_class: type = PromptEngine):
+        # The config and the examples are copied, so changing the originals does not change the template, and the copies are
+        # frozen, so a session can not change the examples it shares with the other sessions
+        config = copy.deepcopy(config) if config is not None else PromptEngineConfig()
+        config.freeze()
+        self.config = config
+        self.description = description
+        self.examples = tuple(FrozenInteraction(example.input, example.response) for example in examples)
+        self.flow_reset_text = flow_reset_text
+        self.encoder = encoder if encoder is not None else get_shared_encoder()
+        # Sessions are created with nothing but the template and their dialog, so engines needing more to be created (e.g. the
+        # OpenAI key of the DynamicPromptEngine) can not be used
+        try:
+            inspect.signature(engine_class).bind(config = config, description = description, examples = self.examples, flow_reset_text = flow_reset_text,
+                                                 dialog = None, encoder = self.encoder)
+        except TypeError as error:
+            raise Exception("A prompt template can not create sessions of %s, it is created with the config, description, examples, flow_reset_text, "
+                            "dialog and encoder arguments only (%s)" % (engine_class.__name__, error))
+        self.engine_class = engine_class
+
+        prototype = self._new_engine(None)
+        self._static_prefix = prototype._get_static_prefix()
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise Exception("A prompt template can not be changed, create a new one instead")
+        object.__setattr__(self, name, value)
+
+    def _new_engine(self, dialog):
+        return self.engine_class(config = self.config, description = self.description, examples = self.examples, flow_reset_text = self.flow_reset_text,
+                                 dialog = dialog, encoder = self.encoder)
+
+    def create_session(self, dialog: List[Interaction] = None):
+        """
+        Returns a new prompt engine for a conversation, sharing the template and starting from the given dialog
+        """
+        session = self._new_engine(dialog)
+        session._static_prefix = self._static_prefix
+        return session
+
+    def build_static_prefix(self):
+        """
+        Returns the rendered description, examples and flow reset text shared by the prompts of every session
+        """
+        return self._static_prefix.text
+
+    @property
+    def token_count(self):
+        """
+        Number of tokens of the static prefix
+        """
+        return self._static_prefix.span.count
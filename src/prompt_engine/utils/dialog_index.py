@@ -0,0 +1,193 @@
+# Per-turn token counts of a dialog, used to pick the most recent turns that fit in a prompt without re-tokenizing them
+
+from typing import Callable, List, Optional
+from prompt_engine.utils.token_budget import TokenBudget, TokenSpan
+
+
+def _join(token_budget: TokenBudget, left: TokenSpan, right: TokenSpan):
+    """
+    Returns the number of tokens the seam between two spans adds (or removes) and whether the joined span ends with the
+    trailing pre-tokens of the right span, which is what makes the seams of a chain of spans add up independently
+    """
+    joined = token_budget.concat(left, right)
+    local = joined.tail_start == left.length + right.tail_start and joined.tail_count == right.tail_count
+    return joined.count - left.count - right.count, local
+
+
+class DialogTokenIndex:
+    """
+    Keeps the rendered text and the token span of every dialog turn, along with prefix sums of their token counts and of
+    the seams between consecutive turns, so the token count of any run of consecutive turns is known in constant time.
+    Turns are appended and removed at both ends in amortized constant time
+    """
+    def __init__(self, token_budget: TokenBudget, measure: Callable, key: tuple = None):
+        self.token_budget = token_budget
+        self.measure = measure
+        self.key = key
+        # Version of the dialog the index describes
+        self.version = None
+        self.interactions = []
+        self.texts = []
+        self.spans = []
+        self._seams = []
+        self._token_sums = [0]
+        self._nonlocal_sums = [0]
+        self._empty_turns = 0
+        self._start = 0
+        # Seams that do not depend on the user input, keyed by the span of the turn they join to the context or to the last turn
+        self._seams_in = {}
+        self._seams_in_context = None
+        self._seams_out = {}
+
+    def matches(self, dialog: List, key: tuple):
+        """
+        Checks that the index still describes the dialog, i.e. that the dialog was only changed along with the index (see sync)
+        and that none of its interactions was edited in place, which both change the version of the dialog
+        """
+        return key == self.key and dialog.version == self.version and len(dialog) == len(self)
+
+    def sync(self, dialog: List):
+        """
+        Records that the index describes the dialog as it is now, after a change made to both of them
+        """
+        self.version = dialog.version
+
+    def rebuild(self, dialog: List):
+        self.__init__(self.token_budget, self.measure, self.key)
+        for interaction in dialog:
+            self.append(interaction)
+        self.sync(dialog)
+
+    def append(self, interaction):
+        text, span = self.measure(interaction)
+        if len(self) > 0:
+            seam, local = _join(self.token_budget, self.spans[-1], span)
+        else:
+            seam, local = 0, True
+        self._seams_out.clear()
+        self.interactions.append(interaction)
+        self.texts.append(text)
+        self.spans.append(span)
+        self._seams.append(seam)
+        self._token_sums.append(self._token_sums[-1] + span.count + seam)
+        self._nonlocal_sums.append(self._nonlocal_sums[-1] + (0 if local else 1))
+        if span.length == 0:
+            self._empty_turns += 1
+
+    def pop(self):
+        self._seams_out.clear()
+        if self.spans.pop().length == 0:
+            self._empty_turns -= 1
+        self.texts.pop()
+        self._seams.pop()
+        self._token_sums.pop()
+        self._nonlocal_sums.pop()
+        return self.interactions.pop()
+
+    def popleft(self):
+        interaction = self.interactions[self._start]
+        if self.spans[self._start].length == 0:
+            self._empty_turns -= 1
+        self._start += 1
+        if self._start > len(self.interactions) // 2:
+            self._compact()
+        return interaction
+
+    def _compact(self):
+        """
+        Drops the turns removed from the front, the sums are rebased so they keep describing the remaining turns
+        """
+        start = self._start
+        self.interactions = self.interactions[start:]
+        self.texts = self.texts[start:]
+        self.spans = self.spans[start:]
+        self._seams = self._seams[start:]
+        token_base, nonlocal_base = self._token_sums[start], self._nonlocal_sums[start]
+        self._token_sums = [total - token_base for total in self._token_sums[start:]]
+        self._nonlocal_sums = [total - nonlocal_base for total in self._nonlocal_sums[start:]]
+        self._start = 0
+        self._seams_in.clear()
+        self._seams_out.clear()
+
+    def __len__(self):
+        return len(self.interactions) - self._start
+
+    def _run_tokens(self, first: int, last: int):
+        """
+        Token count of the turns first..last (absolute positions, inclusive) joined together
+        """
+        return self._token_sums[last + 1] - self._token_sums[first] - self._seams[first]
+
+    def _run_is_local(self, first: int, last: int):
+        return self._nonlocal_sums[last + 1] - self._nonlocal_sums[first + 1] == 0
+
+    def text(self, turns: int):
+        """
+        Returns the rendered text of the last `turns` turns
+        """
+        return "".join(self.texts[len(self.interactions) - turns:])
+
+    def _check_tokens(self, context_span: TokenSpan, suffix_span: TokenSpan, turns: int):
+        """
+        Token count of the text checked before adding the turn `turns` back from the end: the context, the newer turns
+        in order, that turn, and the user input. Returns None when the seams do not add up independently
+        """
+        last = len(self.interactions) - 1
+        candidate = last - turns + 1
+        candidate_span = self.spans[candidate]
+        count = context_span.count + candidate_span.count + suffix_span.count
+        if turns > 1:
+            if not self._run_is_local(candidate + 1, last):
+                return None
+            seam_in, local_in = self._seam_in(context_span, self.spans[candidate + 1])
+            seam_out, local_out = self._seam_out(candidate_span)
+            count += self._run_tokens(candidate + 1, last) + seam_in + seam_out
+        else:
+            seam_in, local_in = self._seam_in(context_span, candidate_span)
+            local_out = True
+            count += seam_in
+        if not (local_in and local_out):
+            return None
+        seam_suffix = self.token_budget.count_with_suffix(candidate_span, suffix_span) - candidate_span.count - suffix_span.count
+        return count + seam_suffix
+
+    def _seam_in(self, context_span: TokenSpan, span: TokenSpan):
+        """
+        Seam between the context and a turn
+        """
+        if context_span is not self._seams_in_context:
+            self._seams_in.clear()
+            self._seams_in_context = context_span
+        seam = self._seams_in.get(span)
+        if seam is None:
+            seam = self._seams_in[span] = _join(self.token_budget, context_span, span)
+        return seam
+
+    def _seam_out(self, span: TokenSpan):
+        """
+        Seam between the last turn and a turn, which is how that turn is checked when it is the oldest one
+        """
+        seam = self._seams_out.get(span)
+        if seam is None:
+            seam = self._seams_out[span] = _join(self.token_budget, self.spans[-1], span)
+        return seam
+
+    def window(self, context_span: TokenSpan, suffix: str, max_tokens: int) -> Optional[int]:
+        """
+        Returns how many of the most recent turns fit after the context, found by binary search over the prefix sums.
+        Returns None if the counts cannot be derived from the prefix sums, in which case the turns have to be checked one by one
+        """
+        if self._empty_turns > 0:
+            return None
+        suffix_span = self.token_budget.suffix_span(suffix)
+        low, high = 0, len(self)
+        while low < high:
+            turns = (low + high + 1) // 2
+            count = self._check_tokens(context_span, suffix_span, turns)
+            if count is None:
+                return None
+            if count > max_tokens:
+                high = turns - 1
+            else:
+                low = turns
+        return low
@@ -0,0 +1,233 @@
+# Client side rate limiting and retries of the requests sent to an embeddings API
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+import openai
+
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_MAX_IN_FLIGHT = 16
+DEFAULT_TIMEOUT = 30.0
+
+# Errors after which the same request may succeed if it is sent again later
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIConnectionError, openai.error.Timeout,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+
+class TokenBucket:
+    """
+    Allows per_minute units (requests or tokens) a minute, in bursts of up to per_minute units. Units are taken from the bucket
+    as soon as they are asked for, even if it is empty, and the caller is told how long to wait before using them, so waiting
+    callers are served in order
+    """
+    def __init__(self, per_minute: float, clock = time.monotonic):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.clock = clock
+        self.level = per_minute
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float):
+        """
+        Takes amount units from the bucket and returns the number of seconds to wait before using them
+        """
+        with self.lock:
+            now = self.clock()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+
+def _retry_after(error):
+    # Seconds to wait before retrying, as asked for by the Retry-After header of the response
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingClient:
+    """
+    EmbeddingClient sends the requests of the embedding providers that share it, the process-wide one by default
+    (get_shared_embedding_client), so every PromptBank of the process stays under the same limits:
+    at most requests_per_minute requests and tokens_per_minute tokens a minute (no limit when None), at most max_in_flight
+    requests waiting for a response, and timeout seconds for each response. Requests failing with a rate limit, connection,
+    timeout or server error are sent again up to max_retries times, after an exponential backoff with jitter
+    (or the delay asked for by the server if it is longer). The clock and the sleep functions can be replaced, e.g. by fake ones in tests
+    """
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 timeout: float = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES, backoff: float = 0.5, max_backoff: float = 30.0, seed: int = None,
+                 clock = time.monotonic, sleep = time.sleep, asleep = asyncio.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.asleep = asleep
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+        self._random = random.Random(seed)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        # Coroutines waiting for a request slot, as (event loop, future) pairs, since they may run on other threads' loops
+        self._async_waiters = deque()
+
+    @property
+    def requests_per_minute(self):
+        return self._requests_per_minute
+
+    @requests_per_minute.setter
+    def requests_per_minute(self, requests_per_minute: float):
+        self._requests_per_minute = requests_per_minute
+        self._request_bucket = TokenBucket(requests_per_minute, self.clock) if requests_per_minute is not None else None
+
+    @property
+    def tokens_per_minute(self):
+        return self._tokens_per_minute
+
+    @tokens_per_minute.setter
+    def tokens_per_minute(self, tokens_per_minute: float):
+        self._tokens_per_minute = tokens_per_minute
+        self._token_bucket = TokenBucket(tokens_per_minute, self.clock) if tokens_per_minute is not None else None
+
+    @staticmethod
+    def retryable(error: Exception):
+        if isinstance(error, RETRYABLE_ERRORS):
+            return True
+        http_status = getattr(error, "http_status", None)
+        return isinstance(error, openai.error.APIError) and http_status is not None and http_status >= 500
+
+    def _throttle(self, tokens: int):
+        # Seconds to wait before sending a request of that many tokens
+        delay = 0.0
+        if self._request_bucket is not None:
+            delay = self._request_bucket.reserve(1)
+        if self._token_bucket is not None and tokens > 0:
+            delay = max(delay, self._token_bucket.reserve(tokens))
+        return delay
+
+    def _backoff(self, attempt: int, error: Exception):
+        # Half of the exponential delay is kept and the other half is random, so clients failing together retry apart
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay = delay / 2 + self._random.uniform(0, delay / 2)
+        retry_after = _retry_after(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def _acquire(self):
+        with self._condition:
+            while self._in_flight >= self.max_in_flight:
+                self._condition.wait()
+            self._in_flight += 1
+
+    async def _aacquire(self):
+        # Waits on a future resolved by _release, the woken coroutine competes for the slot again like a woken thread does
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < self.max_in_flight:
+                    self._in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    try:
+                        self._async_waiters.remove((loop, waiter))
+                    except ValueError:
+                        # It was woken for a slot it will not take, the next waiter gets it
+                        self._wake_async_waiter()
+                raise
+
+    def _wake_async_waiter(self):
+        # Called holding the condition
+        while len(self._async_waiters) > 0:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, waiter)
+                return
+            except RuntimeError:
+                # The loop of the waiter was closed
+                continue
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+            self._wake_async_waiter()
+
+    def request(self, send, tokens: int = 0):
+        """
+        Returns send(timeout), which sends a request of about that many tokens and waits at most timeout seconds for its response,
+        sending it again when it fails with a retryable error. The last error is raised once the retries are exhausted
+        """
+        attempt = 0
+        while True:
+            delay = self._throttle(tokens)
+            if delay > 0:
+                self.sleep(delay)
+            self._acquire()
+            try:
+                return send(self.timeout)
+            except Exception as error:
+                if attempt >= self.max_retries or not self.retryable(error):
+                    raise
+                delay = self._backoff(attempt, error)
+            finally:
+                self._release()
+            attempt += 1
+            self.retries += 1
+            self.sleep(delay)
+
+    async def arequest(self, asend, tokens: int = 0):
+        """
+        Async variant of request, asend(timeout) returns an awaitable. The event loop is never blocked: a coroutine waiting for
+        a request slot, held by this loop or by other threads and loops, is woken when the slot is released
+        """
+        attempt = 0
+        while True:
+            delay = self._throttle(tokens)
+            if delay > 0:
+                await self.asleep(delay)
+            await self._aacquire()
+            try:
+                return await asend(self.timeout)
+            except Exception as error:
+                if attempt >= self.max_retries or not self.retryable(error):
+                    raise
+                delay = self._backoff(attempt, error)
+            finally:
+                self._release()
+            attempt += 1
+            self.retries += 1
+            await self.asleep(delay)
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+def get_shared_embedding_client():
+    """
+    Returns the process-wide embedding client, creating it on first use. The embedding providers use it unless they are given
+    a client of their own, its limits can be changed by setting its attributes, e.g. get_shared_embedding_client().requests_per_minute = 3000
+    """
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = EmbeddingClient()
+    return _shared_client
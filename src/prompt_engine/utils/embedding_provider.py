@@ -0,0 +1,143 @@
+# Services computing the embeddings of a prompt bank
+
+import asyncio
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import numpy as np
+import openai
+from prompt_engine.utils.embedding_client import EmbeddingClient, get_shared_embedding_client
+
+DEFAULT_ENGINE = "text-similarity-davinci-001"
+
+
+class EmbeddingProvider:
+    """
+    EmbeddingProvider computes the embeddings of batches of texts. name identifies the model, embeddings computed by different
+    models are cached under different keys. Inputs are sent at most batch_size at a time, with up to max_concurrency batches
+    in flight
+    """
+    name = ""
+    batch_size = 1
+    max_concurrency = 1
+
+    def embed(self, texts: List[str]):
+        """
+        Returns the embeddings of the texts, in the same order
+        """
+        raise NotImplementedError
+
+    async def aembed(self, texts: List[str]):
+        """
+        Async variant of embed, which runs embed in the default executor unless overridden
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed, texts)
+
+    def batches(self, texts: List[str]):
+        return [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+
+    def embed_many(self, texts: List[str], embed = None):
+        """
+        Embeds any number of texts, split into batches that are sent concurrently. embed(batch) sends a batch, it defaults
+        to self.embed
+        """
+        embed = embed if embed is not None else self.embed
+        batches = self.batches(texts)
+        if len(batches) <= 1 or self.max_concurrency <= 1:
+            return [embed(batch) for batch in batches]
+        with ThreadPoolExecutor(min(self.max_concurrency, len(batches))) as executor:
+            return list(executor.map(embed, batches))
+
+    async def aembed_many(self, texts: List[str], aembed = None):
+        """
+        Async variant of embed_many, at most max_concurrency batches are awaited at a time
+        """
+        aembed = aembed if aembed is not None else self.aembed
+        semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        async def embed_batch(batch):
+            async with semaphore:
+                return await aembed(batch)
+
+        return await asyncio.gather(*[embed_batch(batch) for batch in self.batches(texts)])
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """
+    Computes embeddings with the OpenAI embeddings endpoint, sending many inputs per request. api_base and api_key default to
+    the ones set on the openai module. The requests are rate limited and retried by the client, the one shared by the whole
+    process by default (see EmbeddingClient)
+    """
+    def __init__(self, engine: str = DEFAULT_ENGINE, batch_size: int = 256, max_concurrency: int = 4, api_base: str = None, api_key: str = None,
+                 client: EmbeddingClient = None):
+        self.name = engine
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.api_base = api_base
+        self.api_key = api_key
+        self.client = client if client is not None else get_shared_embedding_client()
+
+    def _request(self, texts: List[str], timeout: float = None):
+        request = {"input": [text.replace("\n", " ") for text in texts], "engine": self.engine, "request_timeout": timeout}
+        if self.api_base is not None:
+            request["api_base"] = self.api_base
+        if self.api_key is not None:
+            request["api_key"] = self.api_key
+        return request
+
+    @staticmethod
+    def _tokens(texts: List[str]):
+        # Rough count of the tokens of the texts for the tokens per minute limit, English text averages about 4 characters a token
+        return sum(len(text) // 4 + 1 for text in texts)
+
+    @staticmethod
+    def _embeddings(response):
+        return [data["embedding"] for data in sorted(response["data"], key=lambda data: data["index"])]
+
+    def embed(self, texts: List[str]):
+        return self._embeddings(self.client.request(lambda timeout: openai.Embedding.create(**self._request(texts, timeout)), self._tokens(texts)))
+
+    async def aembed(self, texts: List[str]):
+        return self._embeddings(await self.client.arequest(lambda timeout: openai.Embedding.acreate(**self._request(texts, timeout)), self._tokens(texts)))
+
+
+class HashedNgramEmbeddingProvider(EmbeddingProvider):
+    """
+    Computes embeddings in process, without any network request: the character n-grams and the word n-grams of a text are
+    hashed into a fixed number of dimensions (with a hashed sign, so collisions tend to cancel out) and counted with NumPy.
+    Texts sharing words and spellings get similar embeddings, which is enough to retrieve examples phrased like the input
+    """
+    batch_size = 1024
+
+    def __init__(self, dimension: int = 512, char_ngrams = (3, 5), word_ngrams = (1, 2)):
+        self.dimension = dimension
+        self.char_ngrams = char_ngrams
+        self.word_ngrams = word_ngrams
+        self.name = "hashed-ngrams-%d-c%d-%d-w%d-%d" % ((dimension,) + tuple(char_ngrams) + tuple(word_ngrams))
+
+    def _features(self, text: str):
+        # The character n-grams are taken over the UTF-8 bytes, which saves encoding every n-gram before hashing it
+        words = text.lower().encode().split()
+        padded = b" " + b" ".join(words) + b" "
+        for n in range(self.char_ngrams[0], self.char_ngrams[1] + 1):
+            for start in range(len(padded) - n + 1):
+                yield padded[start:start + n]
+        for n in range(self.word_ngrams[0], self.word_ngrams[1] + 1):
+            for start in range(len(words) - n + 1):
+                yield b"\0" + b" ".join(words[start:start + n])
+
+    def embed(self, texts: List[str]):
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            # crc32 is stable across processes, unlike hash(), so stored embeddings stay comparable with new ones
+            hashes = np.fromiter((zlib.crc32(feature) for feature in self._features(text)), dtype=np.uint32)
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+            embeddings[row] = np.bincount(hashes % self.dimension, weights=signs, minlength=self.dimension)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return embeddings / norms
+
+    async def aembed(self, texts: List[str]):
+        # Embedding in process takes microseconds, it is not worth a trip to an executor
+        return self.embed(texts)
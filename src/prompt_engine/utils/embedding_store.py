@@ -0,0 +1,349 @@
+# Persistent, append-only storage of embeddings
+
+import contextlib
+import json
+import os
+import threading
+import zlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (on Windows), only the instances sharing the store of a directory in the process are kept from overwriting each other
+    fcntl = None
+
+ALIGNMENT = 8
+
+
+def _padded(size: int):
+    return size + -size % ALIGNMENT
+
+
+def _record(key, vector, metadata, offset: int):
+    # The index record of a vector written at offset in the segment, along with the padded bytes to write
+    data = vector.tobytes()
+    record = {"key": key, "offset": offset, "bytes": len(data), "dim": len(vector), "dtype": vector.dtype.str,
+              "crc": zlib.crc32(data), "metadata": metadata if metadata is not None else {}}
+    return record, data.ljust(_padded(len(data)), b"\0")
+
+
+def _to_vector(vector):
+    # Vectors are written in their own type if it is float32 or a compact one, anything else (e.g. lists of floats) as float32
+    vector = np.asarray(vector)
+    if vector.dtype not in (np.float32, np.float16, np.int8):
+        vector = vector.astype(np.float32)
+    return np.ascontiguousarray(vector)
+
+
+def _to_key(value):
+    # Keys are tuples of strings, JSON gives them back as lists
+    if isinstance(value, list):
+        return tuple(_to_key(item) for item in value)
+    return value
+
+
+class EmbeddingStore:
+    """
+    EmbeddingStore keeps embeddings and their metadata on disk, in a directory holding two append-only files: a binary segment
+    with the raw vectors, and an index with one JSON line per vector giving its key, its position in the segment and its metadata.
+    Adding an embedding appends to both files, so it costs the same no matter how large the store is, and opening the store
+    memory-maps the segment instead of reading it.
+    A vector is written before its index line, and the line is only valid once complete, so a write interrupted by a crash is
+    discarded when the store is opened again. Storing a key again supersedes the previous vector, the space it used is given
+    back by compact(). Vectors are kept as float32, or float16 and int8 when given in those types. The store keeps no copy of the
+    vectors it appends, they are mapped from the segment when they are first read.
+    Several instances, in one process or in many, can append to the same directory: the files are locked while a store is opened,
+    appended to or compacted, and every append is written at the actual end of the files. An instance only sees the embeddings
+    appended by the others when it is opened again
+    """
+    def __init__(self, path: str, sync: bool = True):
+        self.path = path
+        self.sync = sync
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._vectors_file = None
+        self._index_file = None
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, "LOCK"), "a+b")
+        with self._locked():
+            self._open()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Holds the lock of the directory, shared with the other instances and processes using it. Nested uses keep the lock
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _paths(self, generation: int):
+        return (os.path.join(self.path, "vectors.%d.bin" % generation), os.path.join(self.path, "index.%d.jsonl" % generation))
+
+    def _read_generation(self):
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as current_file:
+                return int(current_file.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _open(self):
+        self.generation = self._read_generation()
+        vectors_path, index_path = self._paths(self.generation)
+        for path in (vectors_path, index_path):
+            if not os.path.exists(path):
+                open(path, "wb").close()
+
+        vectors_size = os.path.getsize(vectors_path)
+        mapped = np.memmap(vectors_path, dtype=np.uint8, mode="r") if vectors_size > 0 else np.zeros(0, dtype=np.uint8)
+
+        # Read the index up to its last complete record, a torn line or a vector past the end of the segment is the end of the store.
+        # Every vector is checked against the crc of its record: a record whose vector does not match is skipped, and if it is
+        # the last one, its vector was torn even though its line made it to disk, so the store ends at the previous record
+        self._records = {}
+        self._sequences = {}
+        self._unmapped = {}
+        self._garbage = 0
+        ends = previous_ends = (0, 0)
+        last_valid = True
+        with open(index_path, "rb") as index_file:
+            for line in index_file:
+                record = self._parse(line, vectors_size)
+                if record is None:
+                    break
+                last_valid = zlib.crc32(mapped[record["offset"]:record["offset"] + record["bytes"]]) == record["crc"]
+                if last_valid:
+                    self._add_record(record, mapped)
+                else:
+                    self._garbage += 1
+                previous_ends, ends = ends, (ends[0] + len(line), _padded(record["offset"] + record["bytes"]))
+
+        if not last_valid:
+            ends = previous_ends
+        if ends != (os.path.getsize(index_path), vectors_size):
+            del mapped
+            self._records = {}
+            with open(index_path, "r+b") as index_file:
+                index_file.truncate(ends[0])
+            with open(vectors_path, "r+b") as vectors_file:
+                vectors_file.truncate(ends[1])
+            return self._open()
+
+        self._vectors_file = open(vectors_path, "ab")
+        self._index_file = open(index_path, "a+b")
+
+    @staticmethod
+    def _parse(line: bytes, vectors_size: int):
+        if not line.endswith(b"\n"):
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        if record["offset"] + record["bytes"] > vectors_size:
+            return None
+        return record
+
+    def _add_record(self, record, mapped):
+        key = _to_key(record["key"])
+        vector = np.frombuffer(mapped, dtype=record["dtype"], count=record["dim"], offset=record["offset"])
+        if key in self._records:
+            self._garbage += 1
+        self._records[key] = (vector, record["metadata"])
+        self._sequences[key] = self._garbage + len(self._records) - 1
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def _mapped_records(self):
+        # Maps the vectors appended since they were last read, a single mapping covers them all. If another instance compacted
+        # the directory since, the segment they were appended to is gone and the store is opened again, from the compacted files
+        if len(self._unmapped) > 0:
+            with self._locked():
+                self._sync_with_directory()
+                if len(self._unmapped) > 0:
+                    mapped = np.memmap(self._paths(self.generation)[0], dtype=np.uint8, mode="r")
+                    for key, record in self._unmapped.items():
+                        vector = np.frombuffer(mapped, dtype=record["dtype"], count=record["dim"], offset=record["offset"])
+                        self._records[key] = (vector, self._records[key][1])
+                    self._unmapped = {}
+        return self._records
+
+    def __getitem__(self, key):
+        """
+        Returns the vector and the metadata stored for the key
+        """
+        return self._mapped_records()[key]
+
+    def get(self, key, default = None):
+        return self._mapped_records().get(key, default)
+
+    def keys(self):
+        return self._records.keys()
+
+    def items(self):
+        """
+        Yields the key, vector and metadata of every embedding, in the order they were first stored
+        """
+        for key, (vector, metadata) in list(self._mapped_records().items()):
+            yield key, vector, metadata
+
+    @property
+    def records(self):
+        """
+        Number of records written in the current generation of the files, superseded ones included
+        """
+        return len(self._records) + self._garbage
+
+    def sequence(self, key):
+        """
+        Position of the latest record of the key among the records of the current generation, None if the key is not stored.
+        Together with generation and records, it tells which keys were stored again since some point
+        """
+        return self._sequences.get(key)
+
+    @property
+    def garbage(self):
+        """
+        Number of superseded vectors still taking up space in the files
+        """
+        return self._garbage
+
+    def append(self, key, vector, metadata: dict = None):
+        """
+        Stores the vector and the metadata under the key
+        """
+        self.append_many([(key, vector, metadata)])
+
+    def append_many(self, entries):
+        """
+        Stores many (key, vector, metadata) entries, with a single write and flush per file
+        """
+        entries = list(entries)
+        if len(entries) == 0:
+            return
+        with self._locked():
+            self._sync_with_directory()
+            chunks = []
+            lines = []
+            records = []
+            # The vectors go at the end of the segment as it is on disk, which other instances may have appended to
+            end = os.fstat(self._vectors_file.fileno()).st_size
+            offset = _padded(end)
+            if offset > end:
+                chunks.append(b"\0" * (offset - end))
+            for key, vector, metadata in entries:
+                vector = _to_vector(vector)
+                record, chunk = _record(key, vector, metadata, offset)
+                chunks.append(chunk)
+                lines.append(json.dumps(record) + "\n")
+                records.append((key, record))
+                offset += len(chunk)
+
+            self._write(self._vectors_file, b"".join(chunks))
+            self._write(self._index_file, "".join(lines).encode())
+
+            for key, record in records:
+                if key in self._records:
+                    self._garbage += 1
+                self._records[key] = (None, record["metadata"])
+                self._unmapped[key] = record
+                self._sequences[key] = self._garbage + len(self._records) - 1
+
+    def _sync_with_directory(self):
+        """
+        Reopens the store if another instance compacted it, and drops the torn last line that a crashed writer may have left in the
+        index, so the next record starts on a line of its own
+        """
+        if self._read_generation() != self.generation:
+            self.close()
+            self._open()
+            return
+        index_file = self._index_file
+        size = os.fstat(index_file.fileno()).st_size
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            index_file.seek(start)
+            newline = index_file.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            index_file.truncate(end)
+
+    def _write(self, file, data: bytes):
+        file.write(data)
+        file.flush()
+        if self.sync:
+            os.fsync(file.fileno())
+
+    def compact(self):
+        """
+        Rewrites the store with only the latest vector of every key. The rewritten files replace the current ones atomically,
+        so a crash during compaction leaves the store as it was
+        """
+        with self._locked():
+            # The records appended by other instances are read first, so they are rewritten too
+            self.close()
+            self._open()
+            generation = self.generation + 1
+            vectors_path, index_path = self._paths(generation)
+            with open(vectors_path, "wb") as vectors_file, open(index_path, "wb") as index_file:
+                offset = 0
+                for key, vector, metadata in self.items():
+                    record, chunk = _record(key, np.ascontiguousarray(vector), metadata, offset)
+                    vectors_file.write(chunk)
+                    index_file.write((json.dumps(record) + "\n").encode())
+                    offset += len(chunk)
+                for file in (vectors_file, index_file):
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            current_path = os.path.join(self.path, "CURRENT")
+            with open(current_path + ".tmp", "w") as current_file:
+                current_file.write(str(generation))
+                current_file.flush()
+                os.fsync(current_file.fileno())
+            os.replace(current_path + ".tmp", current_path)
+
+            self.close()
+            for path in self._paths(generation - 1):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._open()
+
+    def close(self):
+        for file in (self._vectors_file, self._index_file):
+            if file is not None:
+                file.close()
+        self._vectors_file = None
+        self._index_file = None
+
+
+_shared_stores = {}
+_shared_stores_lock = threading.Lock()
+
+def get_shared_store(path: str):
+    """
+    Returns the store of the directory, opening it on first use.
+    Every prompt bank of the process using the directory shares this instance, so they all see the embeddings added by the others
+    """
+    path = os.path.realpath(path)
+    with _shared_stores_lock:
+        store = _shared_stores.get(path)
+        if store is None:
+            store = _shared_stores[path] = EmbeddingStore(path)
+        return store
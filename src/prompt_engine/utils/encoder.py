@@ -1,9 +1,13 @@
 # This file includes code which was modified from https://github.com/openai/gpt-2
 
-import importlib.resources
-import json
+import heapq
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import regex as re
 from functools import lru_cache
+from prompt_engine.utils.lru_cache import LRUCache
+from prompt_engine.utils.vocabulary import load_vocabulary, read_sources
 
 @lru_cache()
 def bytes_to_unicode():
@@ -44,62 +48,121 @@ def get_pairs(word):
     return pairs
 
 
+DEFAULT_BPE_CACHE_SIZE = 2 ** 16
+# Name of the GPT-2 vocabulary bundled with the package
+BUNDLED_VOCABULARY = "gpt2"
+
+class BPECache(LRUCache):
+    """
+    Least recently used cache of the BPE merges of pre-tokens, holding at most maxsize entries (None for no limit).
+    It is shared by every thread using the encoder, so all the operations are done under a lock
+    """
+    def __init__(self, maxsize=DEFAULT_BPE_CACHE_SIZE):
+        super().__init__(maxsize)
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors="replace"):
+    def __init__(self, encoder, bpe_merges=None, errors="replace", decoder=None, bpe_ranks=None, cache_size=DEFAULT_BPE_CACHE_SIZE, name=None):
         self.encoder = encoder
-        self.decoder = {v: k for k, v in self.encoder.items()}
+        # Names the vocabulary, token counts stored by name (e.g. in a prompt bank) are only reused by encoders of the same name
+        self.name = name
+        self.decoder = decoder if decoder is not None else {v: k for k, v in self.encoder.items()}
         self.errors = errors
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.bpe_ranks = bpe_ranks if bpe_ranks is not None else dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.cache = BPECache(cache_size)
         self.pat = re.compile(
             r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
         )
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-
-        pairs = get_pairs(word)
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
 
-        if not pairs:
+        if len(token) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-
-        word = " ".join(word)
-        self.cache[token] = word
+        word = " ".join(self._merge(token))
+        self.cache.put(token, word)
         return word
 
+    def _merge(self, token):
+        """
+        Applies the ranked merges to the symbols of a pre-token.
+        The symbols are kept in a linked list and the mergeable pairs in a heap ordered by rank and position, entries made stale by
+        earlier merges are skipped when popped. All the occurrences of the lowest ranked pair are merged left to right before any
+        pair created by those merges is considered, which gives the same result as repeatedly merging the lowest ranked pair of the whole word
+        """
+        bpe_ranks = self.bpe_ranks
+        symbols = list(token)
+        length = len(symbols)
+        prev_symbol = list(range(-1, length - 1))
+        next_symbol = list(range(1, length + 1))
+        next_symbol[-1] = -1
+
+        heap = []
+        for i in range(length - 1):
+            rank = bpe_ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, symbols[i], symbols[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            batch = []
+            while heap and heap[0][0] == rank:
+                batch.append(heapq.heappop(heap))
+
+            for _, i, first, second in batch:
+                j = next_symbol[i]
+                if symbols[i] != first or j == -1 or symbols[j] != second:
+                    continue
+
+                merged = first + second
+                symbols[i] = merged
+                symbols[j] = None
+                k = next_symbol[j]
+                next_symbol[i] = k
+                if k != -1:
+                    prev_symbol[k] = i
+                    rank = bpe_ranks.get((merged, symbols[k]))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, i, merged, symbols[k]))
+                p = prev_symbol[i]
+                if p != -1:
+                    rank = bpe_ranks.get((symbols[p], merged))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, p, symbols[p], merged))
+
+        return [symbol for symbol in symbols if symbol is not None]
+
+    def cache_info(self):
+        """
+        Returns the hits, misses, evictions, capacity and size of the BPE cache
+        """
+        return self.cache.info()
+
+    def count_pre_token(self, token):
+        """
+        Returns the number of tokens a single pre-token (one match of self.pat) is encoded into
+        """
+        token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+        return self.bpe(token).count(" ") + 1
+
+    def count_tokens(self, text, limit=None):
+        """
+        Returns the number of tokens of the text without building the list of token ids.
+        With a limit, counting stops as soon as the count goes over it and the count so far is returned
+        """
+        count = 0
+        for match in self.pat.finditer(text):
+            count += self.count_pre_token(match.group())
+            if limit is not None and count > limit:
+                break
+        return count
+
     def encode(self, text):
         bpe_tokens = []
         for token in re.findall(self.pat, text):
@@ -113,14 +176,109 @@ class Encoder:
         text = bytearray([self.byte_decoder[c] for c in text]).decode("utf-8", errors=self.errors)
         return text
 
+    def _pre_tokenize(self, text):
+        return ["".join(self.byte_encoder[b] for b in token.encode("utf-8")) for token in re.findall(self.pat, text)]
+
+    def _encode_pre_token(self, token):
+        return [self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")]
+
+    def encode_batch(self, texts, workers=None, pool=None):
+        """
+        Encodes many texts at once, returning their tokens in input order.
+        Pre-tokens repeated across the batch go through BPE only once. Passing workers (or a pool from process_pool) spreads
+        the distinct pre-tokens over worker processes
+        """
+        pre_tokens = [self._pre_tokenize(text) for text in texts]
+        encoded = self._map_pre_tokens(_encode_pre_tokens, pre_tokens, workers, pool)
+        return [[token_id for token in tokens for token_id in encoded[token]] for tokens in pre_tokens]
 
-def get_encoder():
-    with importlib.resources.open_text("prompt_engine.utils", "encoder.json") as file:
-        encoder = json.load(file)
-    with importlib.resources.open_text("prompt_engine.utils", "vocab.bpe") as file:
-        bpe_data = file.read()
-    bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
-    return Encoder(encoder=encoder, bpe_merges=bpe_merges)
+    def count_tokens_batch(self, texts, workers=None, pool=None):
+        """
+        Counts the tokens of many texts at once, see encode_batch
+        """
+        pre_tokens = [self._pre_tokenize(text) for text in texts]
+        counts = self._map_pre_tokens(_count_pre_tokens, pre_tokens, workers, pool)
+        return [sum(counts[token] for token in tokens) for tokens in pre_tokens]
+
+    def process_pool(self, workers=None):
+        """
+        Returns a process pool whose workers encode with this encoder, to be reused across batches.
+        Workers receive the vocabulary by path when it is memory-mapped, so they share its pages with this process
+        """
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,))
+
+    def _map_pre_tokens(self, function, pre_tokens, workers, pool):
+        """
+        Applies function to the distinct pre-tokens of the batch, in this process or in the pool, and returns a dict of the results
+        """
+        unique_tokens = list(dict.fromkeys(token for tokens in pre_tokens for token in tokens))
+        if pool is None and (workers is None or workers <= 1):
+            return dict(zip(unique_tokens, function(unique_tokens, self)))
+
+        owns_pool = pool is None
+        if owns_pool:
+            pool = self.process_pool(workers)
+        try:
+            chunk_count = (workers or os.cpu_count() or 1) * 4
+            chunk_size = max(1, -(-len(unique_tokens) // chunk_count))
+            chunks = [unique_tokens[i:i + chunk_size] for i in range(0, len(unique_tokens), chunk_size)]
+            results = [result for chunk_results in pool.map(function, chunks) for result in chunk_results]
+        finally:
+            if owns_pool:
+                pool.shutdown()
+        return dict(zip(unique_tokens, results))
+
+
+def get_json_encoder(cache_size=DEFAULT_BPE_CACHE_SIZE):
+    """
+    Builds an encoder by parsing the bundled encoder.json and vocab.bpe files into dicts
+    """
+    encoder, bpe_merges = read_sources()
+    return Encoder(encoder=encoder, bpe_merges=bpe_merges, cache_size=cache_size, name=BUNDLED_VOCABULARY)
+
+
+def get_encoder(cache_size=DEFAULT_BPE_CACHE_SIZE):
+    """
+    Builds an encoder backed by the memory-mapped binary vocabulary, which is shipped with the package or compiled from the
+    bundled files into the user cache directory on first use. Falls back to parsing the bundled files when the binary vocabulary cannot be written
+    """
+    vocabulary = load_vocabulary()
+    if vocabulary is None:
+        return get_json_encoder(cache_size)
+    return Encoder(encoder=vocabulary.encoder, decoder=vocabulary.decoder, bpe_ranks=vocabulary.bpe_ranks, cache_size=cache_size, name=BUNDLED_VOCABULARY)
+
+
+# The encoder used by the functions running in process_pool workers
+_worker_encoder = None
+
+def _init_worker(encoder):
+    global _worker_encoder
+    _worker_encoder = encoder
+
+def _encode_pre_tokens(pre_tokens, encoder=None):
+    encoder = encoder or _worker_encoder
+    return [encoder._encode_pre_token(token) for token in pre_tokens]
+
+def _count_pre_tokens(pre_tokens, encoder=None):
+    encoder = encoder or _worker_encoder
+    return [encoder.bpe(token).count(" ") + 1 for token in pre_tokens]
+
+
+_shared_encoder = None
+_shared_encoder_lock = threading.Lock()
+
+def get_shared_encoder():
+    """
+    Returns the process-wide encoder, building it on first use.
+    All the prompt engines share this instance (and therefore its BPE cache) unless they are given an encoder of their own.
+    The capacity of the shared BPE cache can be changed with get_shared_encoder().cache.resize(maxsize)
+    """
+    global _shared_encoder
+    if _shared_encoder is None:
+        with _shared_encoder_lock:
+            if _shared_encoder is None:
+                _shared_encoder = get_encoder()
+    return _shared_encoder
 
 # encoder = get_encoder()
 # print('encoded is ', encoder.encode('hello world!'))
\ No newline at end of file
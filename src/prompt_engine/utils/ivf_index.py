@@ -0,0 +1,281 @@
+# Approximate nearest neighbour search over the embeddings of a prompt bank
+
+import json
+import os
+import numpy as np
+from prompt_engine.utils.vector_index import dot, inverse_norms, normalize, quantize, VectorIndex, VECTOR_DTYPES
+
+DEFAULT_NPROBE = 8
+DEFAULT_MIN_TRAIN_SIZE = 1024
+TRAINING_SAMPLES_PER_LIST = 64
+
+
+def _top(scores, k: int):
+    # Positions of the k highest scores, highest first
+    if k < len(scores):
+        positions = np.argpartition(-scores, k - 1)[:k]
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind="stable")]
+
+
+class InvertedList:
+    """
+    The vectors assigned to one centroid, kept contiguous so they are scored with a single matrix-vector product, and their rows.
+    int8 vectors are kept along with their inverse norms, see VectorIndex
+    """
+    def __init__(self, dimension: int, capacity: int = 16, dtype: str = "float32"):
+        self.vectors = np.empty((capacity, dimension), dtype=dtype)
+        self.rows = np.empty(capacity, dtype=np.int64)
+        self.scales = np.empty(capacity, dtype=np.float32) if dtype == "int8" else None
+        self.size = 0
+
+    def append(self, rows, vectors):
+        """
+        Appends vectors already converted to the type of the list
+        """
+        if self.size + len(rows) > len(self.rows):
+            capacity = max(2 * len(self.rows), self.size + len(rows))
+            grown = np.empty((capacity, self.vectors.shape[1]), dtype=self.vectors.dtype)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+            self.rows = np.resize(self.rows, capacity)
+            if self.scales is not None:
+                self.scales = np.resize(self.scales, capacity)
+        self.vectors[self.size:self.size + len(rows)] = vectors
+        self.rows[self.size:self.size + len(rows)] = rows
+        if self.scales is not None:
+            self.scales[self.size:self.size + len(rows)] = inverse_norms(vectors)
+        self.size += len(rows)
+
+    def remove(self, position: int):
+        """
+        Removes the vector at the position by moving the last one there, returns the row of the moved vector
+        """
+        self.size -= 1
+        self.vectors[position] = self.vectors[self.size]
+        self.rows[position] = self.rows[self.size]
+        if self.scales is not None:
+            self.scales[position] = self.scales[self.size]
+        return self.rows[position]
+
+    def similarities(self, query):
+        return dot(self.vectors[:self.size], query, self.scales[:self.size] if self.scales is not None else None)
+
+
+class IVFIndex:
+    """
+    IVFIndex is an approximate alternative to VectorIndex for large prompt banks. The vectors are clustered around nlist centroids
+    (spherical k-means), and a query only scores the vectors of the nprobe clusters whose centroids are the most similar to it,
+    so raising nprobe trades speed for recall, up to exact search when it reaches nlist.
+    The index behaves as an exact index until it holds min_train_size vectors, it is then trained on them (nlist defaults to
+    4 * sqrt(size)). Vectors added afterwards go to the cluster of their nearest centroid without training again, train() can
+    be called to fit the clusters to the current vectors. Like VectorIndex, it can keep the vectors in a compact dtype
+    """
+    def __init__(self, nlist: int = None, nprobe: int = DEFAULT_NPROBE, min_train_size: int = DEFAULT_MIN_TRAIN_SIZE, iterations: int = 10, seed: int = 0,
+                 dtype: str = "float32"):
+        if dtype not in VECTOR_DTYPES:
+            raise Exception("Unsupported vector type %s, expected one of %s" % (dtype, ", ".join(VECTOR_DTYPES)))
+        self.nlist = nlist
+        self.dtype = dtype
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.dimension = None
+        self.centroids = None
+        self._lists = []
+        self._list_of_row = []
+        self._position_of_row = []
+
+    def __len__(self):
+        return len(self._list_of_row)
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def vector(self, row: int):
+        return normalize(self._lists[self._list_of_row[row]].vectors[self._position_of_row[row]])
+
+    @property
+    def vectors(self):
+        """
+        The normalized vectors, in the order of their rows
+        """
+        vectors = np.empty((len(self), self.dimension or 0), dtype=np.float32)
+        for inverted_list in self._lists:
+            vectors[inverted_list.rows[:inverted_list.size]] = normalize(inverted_list.vectors[:inverted_list.size])
+        return vectors
+
+    def _assign(self, vectors):
+        if not self.trained:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _insert(self, rows, vectors, stored = None):
+        # The vectors are assigned in float32, then kept in the type of the index
+        assignments = self._assign(vectors)
+        stored = quantize(vectors, self.dtype) if stored is None else stored
+        for list_id in np.unique(assignments):
+            members = np.flatnonzero(assignments == list_id)
+            inverted_list = self._lists[list_id]
+            for offset, row in enumerate(rows[members]):
+                self._list_of_row[row] = list_id
+                self._position_of_row[row] = inverted_list.size + offset
+            inverted_list.append(rows[members], stored[members])
+
+    def _prepare(self, vectors, normalized: bool):
+        # Returns the normalized float32 vectors the clusters are assigned with, and the vectors to keep if they are
+        # already unit-normalized and of the type of the index (see VectorIndex.add_many), None otherwise
+        vectors = np.atleast_2d(np.asarray(vectors))
+        if normalized and vectors.dtype == self.dtype:
+            return (normalize(vectors) if self.dtype == "int8" else vectors.astype(np.float32, copy=False)), vectors
+        return normalize(vectors), None
+
+    def add(self, vector, normalized: bool = False):
+        """
+        Appends a vector and returns its row
+        """
+        return self.add_many([vector], normalized)[0]
+
+    def add_many(self, vectors, normalized: bool = False):
+        """
+        Appends the vectors and returns their rows, see VectorIndex.add_many
+        """
+        vectors, stored = self._prepare(vectors, normalized)
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+            self._lists = [InvertedList(self.dimension, dtype=self.dtype)]
+        elif vectors.shape[1] != self.dimension:
+            raise Exception("Expected vectors of dimension %d, got %d" % (self.dimension, vectors.shape[1]))
+
+        start = len(self)
+        rows = np.arange(start, start + len(vectors))
+        self._list_of_row.extend([0] * len(vectors))
+        self._position_of_row.extend([0] * len(vectors))
+        self._insert(rows, vectors, stored)
+        if not self.trained and len(self) >= self.min_train_size:
+            self.train()
+        return range(start, len(self))
+
+    def set(self, row: int, vector, normalized: bool = False):
+        """
+        Replaces the vector of a row
+        """
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        inverted_list = self._lists[self._list_of_row[row]]
+        moved = inverted_list.remove(self._position_of_row[row])
+        self._position_of_row[moved] = self._position_of_row[row]
+        self._insert(np.array([row]), *self._prepare(vector, normalized))
+
+    def train(self):
+        """
+        Clusters the vectors of the index and assigns every vector to its cluster again
+        """
+        vectors = self.vectors
+        nlist = self.nlist if self.nlist is not None else max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        if nlist == 0:
+            return
+
+        rng = np.random.default_rng(self.seed)
+        samples = vectors
+        if len(samples) > nlist * TRAINING_SAMPLES_PER_LIST:
+            samples = samples[rng.choice(len(samples), nlist * TRAINING_SAMPLES_PER_LIST, replace=False)]
+        centroids = samples[rng.choice(len(samples), nlist, replace=False)]
+        for _ in range(self.iterations):
+            assignments = np.argmax(samples @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, samples)
+            # A cluster left without vectors starts again from a random one
+            empty = np.flatnonzero(np.bincount(assignments, minlength=nlist) == 0)
+            sums[empty] = samples[rng.choice(len(samples), len(empty))]
+            centroids = normalize(sums)
+
+        self.centroids = centroids
+        self._lists = [InvertedList(self.dimension, dtype=self.dtype) for _ in range(nlist)]
+        self._insert(np.arange(len(vectors)), vectors)
+
+    def search(self, query, k: int, nprobe: int = None):
+        """
+        Returns the rows of the k vectors most similar to the query among the nprobe nearest clusters, most similar first,
+        along with their cosine similarities
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = normalize(query)
+        nprobe = nprobe if nprobe is not None else self.nprobe
+        probed = range(len(self._lists)) if not self.trained else _top(self.centroids @ query, nprobe)
+
+        rows = []
+        similarities = []
+        for list_id in probed:
+            inverted_list = self._lists[list_id]
+            if inverted_list.size > 0:
+                rows.append(inverted_list.rows[:inverted_list.size])
+                similarities.append(inverted_list.similarities(query))
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows = np.concatenate(rows)
+        similarities = np.concatenate(similarities)
+        best = _top(similarities, k)
+        return rows[best], similarities[best]
+
+    def save(self, path: str, metadata: dict = None):
+        """
+        Writes the index to path, replacing the previous file atomically. metadata is saved along, load() returns it
+        """
+        sizes = np.array([inverted_list.size for inverted_list in self._lists], dtype=np.int64)
+        vectors = [inverted_list.vectors[:inverted_list.size] for inverted_list in self._lists]
+        rows = [inverted_list.rows[:inverted_list.size] for inverted_list in self._lists]
+        parameters = {"nlist": self.nlist, "nprobe": self.nprobe, "min_train_size": self.min_train_size,
+                      "iterations": self.iterations, "seed": self.seed, "dimension": self.dimension, "dtype": self.dtype}
+        with open(path + ".tmp", "wb") as index_file:
+            np.savez(index_file, sizes=sizes,
+                     vectors=np.concatenate(vectors) if len(vectors) > 0 else np.zeros((0, 0), dtype=self.dtype),
+                     rows=np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int64),
+                     centroids=self.centroids if self.trained else np.zeros((0, 0), dtype=np.float32),
+                     parameters=json.dumps(parameters), metadata=json.dumps(metadata if metadata is not None else {}))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Reads an index written by save(), returns it along with the metadata saved with it
+        """
+        with np.load(path) as saved:
+            parameters = json.loads(str(saved["parameters"]))
+            index = cls(parameters["nlist"], parameters["nprobe"], parameters["min_train_size"], parameters["iterations"], parameters["seed"],
+                        parameters.get("dtype", "float32"))
+            index.dimension = parameters["dimension"]
+            index.centroids = saved["centroids"] if saved["centroids"].size > 0 else None
+            sizes, vectors, rows = saved["sizes"], saved["vectors"], saved["rows"]
+            index._list_of_row = [0] * len(rows)
+            index._position_of_row = [0] * len(rows)
+            start = 0
+            for list_id, size in enumerate(sizes):
+                inverted_list = InvertedList(index.dimension, max(int(size), 1), index.dtype)
+                inverted_list.append(rows[start:start + size], vectors[start:start + size])
+                for position, row in enumerate(rows[start:start + size]):
+                    index._list_of_row[row] = list_id
+                    index._position_of_row[row] = position
+                index._lists.append(inverted_list)
+                start += size
+            return index, json.loads(str(saved["metadata"]))
+
+
+def recall_at_k(index, exact_index: VectorIndex, queries, k: int):
+    """
+    Fraction of the k nearest neighbours found by exact search that the index finds too, averaged over the queries
+    """
+    found = 0
+    for query in queries:
+        exact_rows, _ = exact_index.search(query, k)
+        rows, _ = index.search(query, k)
+        found += len(np.intersect1d(exact_rows, rows))
+    return found / max(1, len(queries) * min(k, len(exact_index)))
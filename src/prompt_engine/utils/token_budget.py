@@ -0,0 +1,344 @@
+# Incremental token accounting for prompts that are assembled from many rendered segments
+
+from typing import Optional
+
+# Number of leading pre-tokens remembered for every span, used to find where the tokenization of a joined text
+# falls back in line with the tokenization of its right-hand span
+HEAD_PRE_TOKENS = 8
+
+
+def _is_stable(start: int, end: int, length: int):
+    """
+    Returns whether the pre-token matched at [start, end) stays the same whatever text is appended after the first `length` characters.
+    Matching a pre-token looks at most one character past its end and three past its start, the pattern has no lookbehind
+    """
+    return end + 1 < length and start + 3 < length
+
+
+class TokenSpan:
+    """
+    Token count of a piece of text along with what is needed to count the tokens of its concatenation with other spans:
+    the leading pre-tokens and the trailing pre-tokens whose tokenization may still change when more text is appended.
+    Spans built by concatenation keep their parts and only join their text when it is asked for
+    """
+    __slots__ = ("length", "count", "head_starts", "head_tokens", "head_end", "tail_start", "tail_count", "_text", "_parts")
+
+    def __init__(self, length: int, count: int, head_starts: tuple, head_tokens: tuple, head_end: int, tail_start: int, tail_count: int,
+                 text: Optional[str] = None, parts: Optional[tuple] = None):
+        self.length = length
+        self.count = count
+        self.head_starts = head_starts
+        self.head_tokens = head_tokens
+        self.head_end = head_end
+        self.tail_start = tail_start
+        self.tail_count = tail_count
+        self._text = text
+        self._parts = parts
+
+    @property
+    def text(self):
+        if self._text is None:
+            pieces = []
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if node._text is not None:
+                    pieces.append(node._text)
+                else:
+                    stack.append(node._parts[1])
+                    stack.append(node._parts[0])
+            self._text = "".join(pieces)
+            self._parts = None
+        return self._text
+
+    def prefix(self, length: int):
+        """
+        Returns the first `length` characters without joining the whole text
+        """
+        pieces = []
+        node = self
+        while length > 0:
+            if node._text is not None:
+                pieces.append(node._text[:length])
+                break
+            left, right = node._parts
+            if length <= left.length:
+                node = left
+            else:
+                pieces.append(left.text)
+                length -= left.length
+                node = right
+        return "".join(pieces)
+
+    def suffix(self, length: int):
+        """
+        Returns the last `length` characters without joining the whole text
+        """
+        pieces = []
+        node = self
+        while length > 0:
+            if node._text is not None:
+                pieces.append(node._text[node.length - length:])
+                break
+            left, right = node._parts
+            if length <= right.length:
+                node = right
+            else:
+                pieces.append(right.text)
+                length -= right.length
+                node = left
+        return "".join(reversed(pieces))
+
+    def __len__(self):
+        return self.length
+
+    def record(self):
+        """
+        Returns the counts of the span without its text, as a list that can be stored as JSON
+        """
+        return [self.length, self.count, list(self.head_starts), list(self.head_tokens), self.head_end, self.tail_start, self.tail_count]
+
+    @classmethod
+    def from_record(cls, record: list, text: str):
+        """
+        Rebuilds the span of a text from the record of its counts without tokenizing it, returns None if the record was made for a text of another length
+        """
+        length, count, head_starts, head_tokens, head_end, tail_start, tail_count = record
+        if length != len(text):
+            return None
+        return cls(length, count, tuple(head_starts), tuple(head_tokens), head_end, tail_start, tail_count, text = text)
+
+
+EMPTY_SPAN = TokenSpan(0, 0, (), (), 0, 0, 0, text="")
+
+
+class TokenBudget:
+    """
+    Counts the tokens of prompts that grow by appending rendered segments, tokenizing every segment only once.
+    Joining two spans only re-tokenizes the few pre-tokens around the seam, so the counts are exactly those of encoding the joined text.
+    The budget remembers the last counted texts, so counting a text that extends one of them only tokenizes the new part
+    """
+    MAX_CHECKPOINTS = 8
+    MAX_SUFFIX_TAILS = 1024
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self._checkpoints = [EMPTY_SPAN]
+        self._suffix = ""
+        self._suffix_span = EMPTY_SPAN
+        self._suffix_tail_counts = {}
+
+    def tokenize(self, text: str):
+        """
+        Tokenizes a segment on its own
+        """
+        return self._extend(EMPTY_SPAN, text)
+
+    def _extend(self, left: TokenSpan, text: str, limit: int = None):
+        """
+        Returns the span of the left span followed by the text, tokenizing the text together with the tail of the left span.
+        With a limit, gives up and returns None as soon as the pre-tokens that no appended text can change hold more than limit tokens
+        """
+        if text == "":
+            return left
+        length = left.length + len(text)
+        count = left.count - left.tail_count
+        matches = []
+        for match in self.encoder.pat.finditer(left.suffix(left.length - left.tail_start) + text):
+            start, end = left.tail_start + match.start(), left.tail_start + match.end()
+            tokens = self.encoder.count_pre_token(match.group())
+            matches.append((start, end, tokens))
+            count += tokens
+            if limit is not None and count > limit and _is_stable(start, end, length):
+                return None
+
+        head_starts, head_tokens, head_end = self._join_head(left, matches, length)
+        tail_start, tail_count = self._find_tail(matches, length)
+        if left.length == 0:
+            return TokenSpan(length, count, head_starts, head_tokens, head_end, tail_start, tail_count, text = text)
+        # The right part only holds the text, its counts are never read
+        text_part = TokenSpan(len(text), 0, (), (), 0, 0, 0, text = text)
+        return TokenSpan(length, count, head_starts, head_tokens, head_end, tail_start, tail_count, parts = (left, text_part))
+
+    def _join_head(self, left: TokenSpan, pieces: list, length: int, right: TokenSpan = None, synced_at: int = None):
+        """
+        Returns the leading pre-tokens of the left span followed by the re-tokenized pieces and, if the pieces end where
+        a pre-token of the right span starts, the following pre-tokens of the right span
+        """
+        if len(left.head_starts) == HEAD_PRE_TOKENS and left.head_starts[-1] < left.tail_start:
+            return left.head_starts, left.head_tokens, left.head_end
+
+        head = [(start, tokens) for start, tokens in zip(left.head_starts, left.head_tokens) if start < left.tail_start]
+        tokens_before = left.count - left.tail_count
+        for start, _, tokens in pieces:
+            head.append((start, tokens_before))
+            tokens_before += tokens
+        if synced_at is not None:
+            synced_tokens = right.head_tokens[right.head_starts.index(synced_at)]
+            for start, tokens in zip(right.head_starts, right.head_tokens):
+                if start >= synced_at:
+                    head.append((left.length + start, tokens_before + tokens - synced_tokens))
+
+        if len(head) > HEAD_PRE_TOKENS:
+            head_end = head[HEAD_PRE_TOKENS][0]
+            head = head[:HEAD_PRE_TOKENS]
+        elif synced_at is not None and len(right.head_starts) == HEAD_PRE_TOKENS:
+            head_end = left.length + right.head_end
+        else:
+            head_end = length
+        return tuple(start for start, _ in head), tuple(tokens for _, tokens in head), head_end
+
+    def _find_tail(self, elements: list, length: int, last_unstable: bool = False):
+        """
+        Returns the start and the token count of the trailing pre-tokens that are not stable
+        """
+        index = len(elements) - 1
+        tail_count = 0
+        while index >= 0:
+            start, end, tokens = elements[index]
+            if not (last_unstable and index == len(elements) - 1) and _is_stable(start, end, length):
+                break
+            tail_count += tokens
+            index -= 1
+        tail_start = elements[index + 1][0] if index + 1 < len(elements) else length
+        return tail_start, tail_count
+
+    def concat(self, *spans: TokenSpan):
+        """
+        Joins the spans from left to right
+        """
+        result = EMPTY_SPAN
+        for span in spans:
+            result = self._concat(result, span)
+        return result
+
+    def _concat(self, left: TokenSpan, right: TokenSpan):
+        if left.length == 0:
+            return right
+        if right.length == 0:
+            return left
+
+        length = left.length + right.length
+        tail_text = left.suffix(left.length - left.tail_start)
+        offset = len(tail_text)
+        right_starts = dict(zip(right.head_starts, right.head_tokens))
+        last_right_start = right.head_starts[-1]
+
+        # Re-tokenize the tail of the left span followed by the head of the right span, until a pre-token starts where
+        # one of the right span starts. From there on both tokenizations are the same, because matching never looks back
+        window = right.length if right.head_end + 4 >= right.length else right.head_end + 4
+        while True:
+            scan_text = tail_text + right.prefix(window)
+            truncated = window < right.length
+            pieces = []
+            synced_at = None
+            for match in self.encoder.pat.finditer(scan_text):
+                start, end = match.span()
+                if start >= offset and start - offset in right_starts:
+                    synced_at = start - offset
+                    break
+                if truncated and (not _is_stable(start, end, len(scan_text)) or start - offset > last_right_start):
+                    break
+                pieces.append((left.tail_start + start, left.tail_start + end, self.encoder.count_pre_token(match.group())))
+            else:
+                break
+            if synced_at is not None:
+                break
+            # The seam reaches past the known head of the right span, tokenize the rest of it as well
+            window = right.length
+
+        count = left.count - left.tail_count + sum(tokens for _, _, tokens in pieces)
+        if synced_at is not None:
+            count += right.count - right_starts[synced_at]
+
+        head_starts, head_tokens, head_end = self._join_head(left, pieces, length, right, synced_at)
+
+        # Trailing pre-tokens of the joined span
+        if synced_at is not None and right.tail_start >= synced_at and (not pieces or _is_stable(*pieces[-1][:2], length)):
+            tail_start, tail_count = left.length + right.tail_start, right.tail_count
+        else:
+            elements = list(pieces)
+            if synced_at is not None:
+                elements.append((left.length + synced_at, length, right.count - right_starts[synced_at]))
+            tail_start, tail_count = self._find_tail(elements, length, last_unstable = synced_at is not None)
+
+        return TokenSpan(length, count, head_starts, head_tokens, head_end, tail_start, tail_count, parts = (left, right))
+
+    def span(self, text: str, limit: int = None):
+        """
+        Returns the span of the text, reusing the span of the longest previously counted text it starts with.
+        With a limit, returns None as soon as the text is known to hold more than limit tokens whatever follows it
+        """
+        checkpoints = self._checkpoints
+        while len(checkpoints) > 1 and not text.startswith(checkpoints[-1].text):
+            checkpoints.pop()
+        checkpoint = checkpoints[-1]
+        if checkpoint.length == len(text):
+            return checkpoint
+
+        span = self._extend(checkpoint, text[checkpoint.length:], limit)
+        if span is None:
+            return None
+        span._text, span._parts = text, None
+        checkpoints.append(span)
+        if len(checkpoints) > self.MAX_CHECKPOINTS:
+            del checkpoints[1]
+        return span
+
+    def remember(self, text: str, span: TokenSpan):
+        """
+        Keeps the span of a text that was assembled by joining spans, so counting texts that extend it starts from it
+        """
+        checkpoints = self._checkpoints
+        while len(checkpoints) > 1 and not text.startswith(checkpoints[-1].text):
+            checkpoints.pop()
+        if checkpoints[-1].length < len(text):
+            span._text, span._parts = text, None
+            checkpoints.append(span)
+            if len(checkpoints) > self.MAX_CHECKPOINTS:
+                del checkpoints[1]
+
+    def count(self, text: str, suffix: str = "", limit: int = None):
+        """
+        Returns the number of tokens of text + suffix.
+        With a limit, counting stops once the limit is known to be exceeded and limit + 1 is returned
+        """
+        span = self.span(text, limit)
+        if span is None:
+            return limit + 1
+        return self.count_span(span, suffix, limit)
+
+    def count_span(self, span: TokenSpan, suffix: str = "", limit: int = None):
+        """
+        Returns the number of tokens of the span followed by the suffix, the last suffix is kept tokenized.
+        With a limit, a new suffix is first counted with an early exit, and only tokenized on its own if the total fits
+        """
+        if suffix != self._suffix and limit is not None:
+            base = span.count - span.tail_count
+            if base + self.encoder.count_tokens(span.suffix(span.length - span.tail_start) + suffix, limit - base) > limit:
+                return limit + 1
+        return self.count_with_suffix(span, self.suffix_span(suffix))
+
+    def count_with_suffix(self, span: TokenSpan, suffix_span: TokenSpan):
+        """
+        Returns the number of tokens of the span followed by the suffix span, which must be the current suffix.
+        Appending text never changes the stable pre-tokens of a span and matching never looks back, so the count only depends on
+        the text of the trailing pre-tokens, and it is remembered for every such text until the suffix changes
+        """
+        tail_text = span.suffix(span.length - span.tail_start)
+        tail_count = self._suffix_tail_counts.get(tail_text)
+        if tail_count is None:
+            if len(self._suffix_tail_counts) >= self.MAX_SUFFIX_TAILS:
+                self._suffix_tail_counts.clear()
+            tail_count = self.concat(span, suffix_span).count - (span.count - span.tail_count)
+            self._suffix_tail_counts[tail_text] = tail_count
+        return span.count - span.tail_count + tail_count
+
+    def suffix_span(self, suffix: str):
+        """
+        Returns the span of the suffix, which is kept until a different suffix is asked for
+        """
+        if suffix != self._suffix:
+            self._suffix, self._suffix_span = suffix, self.tokenize(suffix)
+            self._suffix_tail_counts = {}
+        return self._suffix_span
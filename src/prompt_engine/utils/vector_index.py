@@ -0,0 +1,192 @@
+# Exact nearest neighbour search over the embeddings of a prompt bank
+
+import numpy as np
+
+DEFAULT_CAPACITY = 1024
+# Types the vectors can be kept in, from the most precise to the most compact
+VECTOR_DTYPES = ("float32", "float16", "int8")
+# Rows converted to float32 at a time when scoring vectors kept in a compact type
+SCORING_BLOCK = 4096
+
+
+def normalize(vectors):
+    """
+    Scales the vectors (one per row) to unit length, so their dot products are cosine similarities. Zero vectors are left as they are
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def quantize(vectors, dtype: str = "float32"):
+    """
+    Converts unit-normalized vectors to dtype, one of VECTOR_DTYPES. int8 vectors are scaled so their largest component is 127:
+    they only keep the direction of the vectors, which is all that cosine similarities need
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float32":
+        return vectors
+    if dtype == "float16":
+        return vectors.astype(np.float16)
+    if dtype == "int8":
+        largest = np.abs(vectors).max(axis=-1, keepdims=True)
+        largest[largest == 0] = 1
+        return np.round(vectors * (127 / largest)).astype(np.int8)
+    raise Exception("Unsupported vector type %s, expected one of %s" % (dtype, ", ".join(VECTOR_DTYPES)))
+
+
+def inverse_norms(vectors):
+    """
+    Inverse of the norms of the vectors, which turn the dot products of int8 vectors into cosine similarities
+    """
+    norms = np.linalg.norm(np.asarray(vectors, dtype=np.float32), axis=-1)
+    norms[norms == 0] = 1
+    return (1 / norms).astype(np.float32)
+
+
+def dot(vectors, query, scales = None):
+    """
+    Dot products of the query with the vectors, multiplied by the scales if given. Vectors of a compact type are converted to
+    float32 a block at a time, so scoring them never makes a float32 copy of the whole matrix
+    """
+    if vectors.dtype == np.float32:
+        products = vectors @ query
+    else:
+        products = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), SCORING_BLOCK):
+            products[start:start + SCORING_BLOCK] = vectors[start:start + SCORING_BLOCK].astype(np.float32) @ query
+    return products * scales if scales is not None else products
+
+
+class VectorIndex:
+    """
+    Keeps unit-normalized vectors, of float32 by default or of a compact type (float16, or int8 along with the inverse norm of
+    every row) to hold 2 or 4 times more vectors in the same memory. The cosine similarities of a query with every row come from
+    one matrix-vector product per block of rows, and the k best rows are picked with argpartition, so only those k are sorted.
+    Rows are appended in amortized constant time: the blocks double in size and are never moved, so row() hands out views of
+    the stored vectors that stay valid, and the prompt bank keeps those views instead of its own copy of the vectors
+    """
+    def __init__(self, dimension: int = None, capacity: int = DEFAULT_CAPACITY, dtype: str = "float32"):
+        if dtype not in VECTOR_DTYPES:
+            raise Exception("Unsupported vector type %s, expected one of %s" % (dtype, ", ".join(VECTOR_DTYPES)))
+        self.dimension = dimension
+        self.dtype = dtype
+        self._capacity = capacity
+        self._blocks = []
+        self._scales = [] if dtype == "int8" else None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _locate(self, row: int):
+        # Block b holds capacity * 2 ** b rows, the block of a row and its position in it follow from the row alone
+        block = (row // self._capacity + 1).bit_length() - 1
+        return block, row - self._capacity * (2 ** block - 1)
+
+    def _filled(self):
+        # Yields every block along with the number of rows it holds
+        start = 0
+        for block in self._blocks:
+            filled = min(len(block), self._size - start)
+            if filled <= 0:
+                break
+            yield block, filled
+            start += len(block)
+
+    @property
+    def vectors(self):
+        """
+        Copy of the normalized rows, as float32
+        """
+        if self._size == 0:
+            return np.zeros((0, self.dimension or 0), dtype=np.float32)
+        return normalize(np.concatenate([block[:filled] for block, filled in self._filled()]))
+
+    def row(self, row: int):
+        """
+        Read-only view of the vector of a row, in the type of the index. It keeps describing the row, even after set()
+        """
+        if not 0 <= row < self._size:
+            raise IndexError(row)
+        block, position = self._locate(row)
+        vector = self._blocks[block][position]
+        vector.flags.writeable = False
+        return vector
+
+    def _prepare(self, vectors, normalized: bool):
+        # Vectors already unit-normalized and of the type of the index are kept as they are
+        vectors = np.atleast_2d(np.asarray(vectors))
+        if not normalized or vectors.dtype != self.dtype:
+            vectors = quantize(normalize(vectors), self.dtype)
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+        elif vectors.shape[1] != self.dimension:
+            raise Exception("Expected vectors of dimension %d, got %d" % (self.dimension, vectors.shape[1]))
+        return vectors
+
+    def add(self, vector, normalized: bool = False):
+        """
+        Appends a vector and returns its row
+        """
+        return self.add_many([vector], normalized)[0]
+
+    def add_many(self, vectors, normalized: bool = False):
+        """
+        Appends the vectors and returns their rows. With normalized set, vectors that are already unit-normalized
+        (see quantize for the compact types) and of the type of the index are neither normalized nor converted again
+        """
+        vectors = self._prepare(vectors, normalized)
+        start = self._size
+        written = 0
+        while written < len(vectors):
+            block, position = self._locate(self._size)
+            if block == len(self._blocks):
+                self._blocks.append(np.empty((self._capacity * 2 ** block, self.dimension), dtype=self.dtype))
+                if self._scales is not None:
+                    self._scales.append(np.empty(self._capacity * 2 ** block, dtype=np.float32))
+            count = min(len(vectors) - written, len(self._blocks[block]) - position)
+            self._blocks[block][position:position + count] = vectors[written:written + count]
+            if self._scales is not None:
+                self._scales[block][position:position + count] = inverse_norms(vectors[written:written + count])
+            written += count
+            self._size += count
+        return range(start, self._size)
+
+    def set(self, row: int, vector, normalized: bool = False):
+        """
+        Replaces the vector of a row
+        """
+        if not 0 <= row < self._size:
+            raise IndexError(row)
+        block, position = self._locate(row)
+        self._blocks[block][position] = self._prepare(vector, normalized)[0]
+        if self._scales is not None:
+            self._scales[block][position] = inverse_norms(self._blocks[block][position])
+
+    def similarities(self, query):
+        """
+        Cosine similarities of the query with every row
+        """
+        if self._size == 0:
+            return np.zeros(0, dtype=np.float32)
+        query = normalize(query)
+        scales = self._scales if self._scales is not None else [None] * len(self._blocks)
+        return np.concatenate([dot(block[:filled], query, block_scales[:filled] if block_scales is not None else None)
+                               for (block, filled), block_scales in zip(self._filled(), scales)])
+
+    def search(self, query, k: int):
+        """
+        Returns the rows of the k vectors most similar to the query, most similar first, along with their cosine similarities
+        """
+        k = min(k, self._size)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        similarities = self.similarities(query)
+        if k < self._size:
+            rows = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            rows = np.arange(self._size)
+        rows = rows[np.argsort(-similarities[rows], kind="stable")]
+        return rows, similarities[rows]
@@ -0,0 +1,323 @@
+# Compact, memory-mappable representation of the BPE vocabulary bundled in encoder.json and vocab.bpe
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from collections.abc import Mapping
+
+MAGIC = b"PEVOCAB\x02"
+BYTE_ORDER_MARK = 0x01020304
+VOCABULARY_FILE_NAME = "encoder.bin"
+
+# magic, byte order mark, sizes and modification times (ns) of the two source files, number of tokens, token hash slots,
+# number of merges, merge hash slots
+_HEADER = struct.Struct("=8sIQQqqIIII")
+
+_SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+_ENCODER_SOURCE = os.path.join(_SOURCE_DIRECTORY, "encoder.json")
+_MERGES_SOURCE = os.path.join(_SOURCE_DIRECTORY, "vocab.bpe")
+
+
+def _hash(key: bytes):
+    return zlib.crc32(key)
+
+
+def _table_size(entries: int):
+    """
+    Returns a power of two with room for the entries at a load factor of at most one half
+    """
+    size = 1
+    while size < entries * 2:
+        size <<= 1
+    return size
+
+
+def _pack_strings(keys):
+    """
+    Packs the keys into a single blob and returns the blob along with the offsets of every key
+    """
+    offsets = [0]
+    blob = bytearray()
+    for key in keys:
+        blob += key
+        offsets.append(len(blob))
+    return bytes(blob), offsets
+
+
+def _build_hash_table(keys):
+    """
+    Builds an open addressing hash table that stores index + 1 of each key, 0 marks an empty slot
+    """
+    size = _table_size(len(keys))
+    mask = size - 1
+    table = [0] * size
+    for index, key in enumerate(keys):
+        slot = _hash(key) & mask
+        while table[slot] != 0:
+            slot = (slot + 1) & mask
+        table[slot] = index + 1
+    return table
+
+
+def _merge_key(first: str, second: str):
+    # Byte-level BPE symbols never contain a space, so it can separate the two halves of a merge
+    return (first + " " + second).encode("utf-8")
+
+
+def compile_vocabulary(encoder: dict, bpe_merges: list, stamp: tuple = ((0, 0), (0, 0))):
+    """
+    Serializes the token to id mapping and the ranked merges into the binary vocabulary format
+    """
+    tokens = [None] * len(encoder)
+    for token, token_id in encoder.items():
+        if not 0 <= token_id < len(tokens) or tokens[token_id] is not None:
+            raise ValueError("The token ids of the vocabulary must be unique and contiguous")
+        tokens[token_id] = token.encode("utf-8")
+    merges = [_merge_key(first, second) for first, second in bpe_merges]
+
+    token_blob, token_offsets = _pack_strings(tokens)
+    merge_blob, merge_offsets = _pack_strings(merges)
+    token_table = _build_hash_table(tokens)
+    merge_table = _build_hash_table(merges)
+
+    (sizes, mtimes) = stamp
+    header = _HEADER.pack(MAGIC, BYTE_ORDER_MARK, sizes[0], sizes[1], mtimes[0], mtimes[1], len(tokens), len(token_table), len(merges), len(merge_table))
+    sections = [struct.pack("=%dI" % len(values), *values) for values in (token_offsets, token_table, merge_offsets, merge_table)]
+    return b"".join([header] + sections + [token_blob, merge_blob])
+
+
+def source_stamp(encoder_path: str = _ENCODER_SOURCE, merges_path: str = _MERGES_SOURCE):
+    """
+    Returns the sizes and the modification times of the source vocabulary files, which tell a stale binary vocabulary
+    without reading the sources
+    """
+    stats = [os.stat(path) for path in (encoder_path, merges_path)]
+    return tuple(stat.st_size for stat in stats), tuple(stat.st_mtime_ns for stat in stats)
+
+
+def read_sources(encoder_path: str = _ENCODER_SOURCE, merges_path: str = _MERGES_SOURCE):
+    """
+    Parses the bundled encoder.json and vocab.bpe files
+    """
+    with open(encoder_path, "r", encoding="utf-8") as file:
+        encoder = json.load(file)
+    with open(merges_path, "r", encoding="utf-8") as file:
+        bpe_data = file.read()
+    bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
+    return encoder, bpe_merges
+
+
+def write_vocabulary(path: str, encoder_path: str = _ENCODER_SOURCE, merges_path: str = _MERGES_SOURCE):
+    """
+    Compiles the source vocabulary files into a binary vocabulary at the given path.
+    The file is written to a temporary file first and then moved into place, so readers never see a partial file
+    """
+    encoder, bpe_merges = read_sources(encoder_path, merges_path)
+    data = compile_vocabulary(encoder, bpe_merges, source_stamp(encoder_path, merges_path))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".vocabulary-")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return path
+
+
+class _StringTable(Mapping):
+    """
+    Read-only mapping from the keys stored in a binary vocabulary section to their index.
+    Looked up keys are memoized, so the hot part of the vocabulary ends up in a regular dict without loading the rest of it
+    """
+    def __init__(self, offsets, table, blob):
+        self._offsets = offsets
+        self._table = table
+        self._mask = len(table) - 1
+        self._blob = blob
+        self._memo = {}
+        self._section = None
+
+    def __reduce__(self):
+        # Pickled as a reference to its section of the vocabulary, which is mapped again from its path
+        return (getattr, self._section)
+
+    def _encode_key(self, key):
+        return key.encode("utf-8")
+
+    def _decode_key(self, data: bytes):
+        return data.decode("utf-8")
+
+    def _find(self, key):
+        if key in self._memo:
+            return self._memo[key]
+        data = self._encode_key(key)
+        offsets, table, blob, mask = self._offsets, self._table, self._blob, self._mask
+        slot = _hash(data) & mask
+        while True:
+            entry = table[slot]
+            if entry == 0:
+                return -1
+            index = entry - 1
+            if blob[offsets[index]:offsets[index + 1]] == data:
+                self._memo[key] = index
+                return index
+            slot = (slot + 1) & mask
+
+    def key_at(self, index: int):
+        return self._decode_key(bytes(self._blob[self._offsets[index]:self._offsets[index + 1]]))
+
+    def __getitem__(self, key):
+        index = self._find(key)
+        if index < 0:
+            raise KeyError(key)
+        return index
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        return index if index >= 0 else default
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.key_at(index)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+class _MergeTable(_StringTable):
+    """
+    Read-only mapping from a (first, second) symbol pair to the rank of its merge
+    """
+    def _encode_key(self, key):
+        return _merge_key(*key)
+
+    def _decode_key(self, data: bytes):
+        return tuple(data.decode("utf-8").split(" "))
+
+
+class _TokenList(Mapping):
+    """
+    Read-only mapping from a token id to the token
+    """
+    def __init__(self, tokens: _StringTable):
+        self._tokens = tokens
+        self._section = None
+
+    def __reduce__(self):
+        return (getattr, self._section)
+
+    def __getitem__(self, token_id):
+        if not isinstance(token_id, int) or not 0 <= token_id < len(self._tokens):
+            raise KeyError(token_id)
+        return self._tokens.key_at(token_id)
+
+    def __iter__(self):
+        return iter(range(len(self._tokens)))
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+class BinaryVocabulary:
+    """
+    Memory-mapped binary vocabulary. The encoder, decoder and bpe_ranks attributes behave like the dicts built by get_encoder,
+    but they are looked up directly in the mapped file, so processes sharing the file also share its pages
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError("Invalid binary vocabulary file")
+        header = _HEADER.unpack_from(self._mmap)
+        magic, byte_order_mark, n_tokens, token_slots, n_merges, merge_slots = header[:2] + header[6:]
+        if magic != MAGIC or byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError("Invalid binary vocabulary file")
+        # Sizes and modification times of the source files it was compiled from, see source_stamp
+        self.stamp = (header[2:4], header[4:6])
+
+        view = memoryview(self._mmap)
+        position = _HEADER.size
+        sections = []
+        for count in (n_tokens + 1, token_slots, n_merges + 1, merge_slots):
+            sections.append(view[position:position + 4 * count].cast("I"))
+            position += 4 * count
+        token_offsets, token_table, merge_offsets, merge_table = sections
+        token_blob = view[position:position + token_offsets[-1]]
+        position += token_offsets[-1]
+        merge_blob = view[position:position + merge_offsets[-1]]
+        if position + merge_offsets[-1] != len(self._mmap):
+            raise ValueError("Invalid binary vocabulary file")
+
+        self.encoder = _StringTable(token_offsets, token_table, token_blob)
+        self.decoder = _TokenList(self.encoder)
+        self.bpe_ranks = _MergeTable(merge_offsets, merge_table, merge_blob)
+        for name in ("encoder", "decoder", "bpe_ranks"):
+            getattr(self, name)._section = (self, name)
+
+    def __reduce__(self):
+        return (BinaryVocabulary, (self.path,))
+
+
+def bundled_path():
+    """
+    Path of the binary vocabulary shipped with the package, compiled from the bundled sources when the package is built
+    """
+    return os.path.join(_SOURCE_DIRECTORY, VOCABULARY_FILE_NAME)
+
+
+def cache_path():
+    """
+    Path of the binary vocabulary compiled at runtime when the package ships none, in the user cache directory
+    """
+    cache_directory = os.environ.get("PROMPT_ENGINE_CACHE_DIR")
+    if cache_directory is None:
+        cache_directory = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "prompt_engine")
+    return os.path.join(cache_directory, VOCABULARY_FILE_NAME)
+
+
+def _open_if_current(path: str, stamp: tuple, check_mtimes: bool):
+    try:
+        vocabulary = BinaryVocabulary(path)
+    except (OSError, ValueError):
+        return None
+    if vocabulary.stamp[0] != stamp[0] or (check_mtimes and vocabulary.stamp[1] != stamp[1]):
+        return None
+    return vocabulary
+
+
+def load_vocabulary():
+    """
+    Opens the binary vocabulary of the bundled sources: the one shipped with the package if the sources have the sizes it was
+    compiled from (installing the package changes their modification times), otherwise the one of the user cache directory
+    if the sources also have the same modification times, compiling it there first if needed. The sources are only read to
+    compile it. Returns None if it can neither be found nor written
+    """
+    stamp = source_stamp()
+    vocabulary = _open_if_current(bundled_path(), stamp, check_mtimes=False)
+    if vocabulary is not None:
+        return vocabulary
+    vocabulary = _open_if_current(cache_path(), stamp, check_mtimes=True)
+    if vocabulary is not None:
+        return vocabulary
+    try:
+        return BinaryVocabulary(write_vocabulary(cache_path()))
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    # Precompiles the binary vocabulary, e.g. while building a container image. Packages built with setup.py ship it already
+    print(write_vocabulary(sys.argv[1] if len(sys.argv) > 1 else bundled_path()))
@@ -0,0 +1,75 @@
+from src.prompt_engine.chat_engine import ChatEngine, ChatEngineConfig
+# The engines import the package as prompt_engine, the dialogs given to them come from the same module
+from prompt_engine.dialog import Dialog
+from src.prompt_engine.interaction import Interaction
+import yaml
+
+def test_pass_dialog_list_operations():
+    interactions = [Interaction("Hello %d" % i, "Hi %d" % i) for i in range(5)]
+    dialog = Dialog(interactions)
+    assert dialog == interactions
+    assert dialog.pop(0) is interactions[0]
+    assert dialog.pop() is interactions[4]
+    assert dialog[::-1] == interactions[3:0:-1]
+    dialog.insert(0, interactions[0])
+    del dialog[1]
+    assert dialog == [interactions[0], interactions[2], interactions[3]]
+
+def test_pass_max_turns():
+    dialog = Dialog(max_turns = 2)
+    chat_engine = ChatEngine(ChatEngineConfig(), "Trial Description", dialog = dialog)
+    for i in range(5):
+        chat_engine.add_interaction("Hello %d" % i, "Hi %d" % i)
+    assert chat_engine.dialog is dialog
+    assert [interaction.input for interaction in dialog] == ["Hello 3", "Hello 4"]
+    assert chat_engine.build_prompt("Bye") == "Trial Description\n\nUSER: Hello 3\nBOT: Hi 3\n\nUSER: Hello 4\nBOT: Hi 4\n\nUSER: Bye\n"
+    assert yaml.safe_load(chat_engine.save_yaml())["dialog"] == [{"input": "Hello 3", "response": "Hi 3"}, {"input": "Hello 4", "response": "Hi 4"}]
+
+    # Replacing the dialog keeps its bounds
+    chat_engine.dialog = [Interaction("Hello %d" % i, "Hi %d" % i) for i in range(3)]
+    assert chat_engine.dialog.max_turns == 2 and len(chat_engine.dialog) == 2
+
+def test_pass_dialog_list_copied():
+    interactions = [Interaction("Hello %d" % i, "Hi %d" % i) for i in range(3)]
+    chat_engine = ChatEngine(ChatEngineConfig(), "Trial Description", dialog = interactions)
+    assert isinstance(chat_engine.dialog, Dialog) and chat_engine.dialog is not interactions
+    assert chat_engine.dialog == interactions
+
+    # The list given to the engine is copied, the dialog of the engine is changed through the engine
+    interactions.append(Interaction("Hello 3", "Hi 3"))
+    assert len(chat_engine.dialog) == 3
+    chat_engine.dialog.append(Interaction("Hello 4", "Hi 4"))
+    assert len(interactions) == 4 and chat_engine.build_prompt("Bye").endswith("USER: Hello 4\nBOT: Hi 4\n\nUSER: Bye\n")
+
+def test_pass_max_tokens():
+    chat_engine = ChatEngine(ChatEngineConfig(), "Trial Description", dialog = Dialog(max_tokens = 30))
+    for i in range(10):
+        chat_engine.add_interaction("Hello %d" % i, "Hi %d" % i)
+        chat_engine.build_prompt("Bye")
+    turn_tokens = len(chat_engine.encoder.encode("USER: Hello 9\nBOT: Hi 9\n\n"))
+    assert len(chat_engine.dialog) == 30 // turn_tokens
+    assert chat_engine.dialog.tokens == turn_tokens * len(chat_engine.dialog)
+    assert chat_engine.dialog[-1].input == "Hello 9"
+
+def test_pass_dialog_version():
+    chat_engine = ChatEngine(ChatEngineConfig(), "Trial Description")
+    for i in range(3):
+        chat_engine.add_interaction("Hello %d" % i, "Hi %d" % i)
+    chat_engine.build_prompt("Bye")
+    dialog_index = chat_engine._dialog_index
+    version = chat_engine.dialog.version
+
+    # Changes made through the engine keep the index of the turns
+    chat_engine.add_interaction("Hello 3", "Hi 3")
+    chat_engine.remove_first_interaction()
+    assert chat_engine.build_prompt("Bye").startswith("Trial Description\n\nUSER: Hello 1\n")
+    assert chat_engine._dialog_index is dialog_index and chat_engine.dialog.version > version
+
+    # Editing a turn in place or changing the dialog directly changes its version, so the index is built again
+    chat_engine.dialog[0].input = "Goodbye"
+    assert chat_engine.build_prompt("Bye").startswith("Trial Description\n\nUSER: Goodbye\n")
+    assert chat_engine._dialog_index is not dialog_index
+    dialog_index = chat_engine._dialog_index
+    chat_engine.dialog.append(Interaction("Hello 4", "Hi 4"))
+    assert chat_engine.build_prompt("Bye").endswith("USER: Hello 4\nBOT: Hi 4\n\nUSER: Bye\n")
+    assert chat_engine._dialog_index is not dialog_index
@@ -0,0 +1,138 @@
+import asyncio
+import multiprocessing
+import pytest
+from src.prompt_engine.dynamic_prompt_engine import DynamicPromptEngine, PromptBank, WHOLE_BANK
+from src.prompt_engine.interaction import Interaction
+from src.prompt_engine.model_config import ModelConfig
+from src.prompt_engine.prompt_engine import EXAMPLES_TOKEN_LIMIT_MESSAGE, PromptEngineConfig, TOKEN_LIMIT_MESSAGE
+from src.prompt_engine.utils.embedding_provider import HashedNgramEmbeddingProvider
+
+description = "Extract the monuments from the given text"
+examples = [Interaction("Can we go to Taj Mahal?", "Taj Mahal"),
+    Interaction("How old is the Stonehenge?", "Stonehenge"),
+    Interaction("The Statue of Liberty is such a massive statue, I wonder how they built it", "Statue of Liberty"),
+    Interaction("What is the name of that big Buddha statue in Asia?", "Big Buddha Statue"),
+    Interaction("I want to see the Eiffel Tower!", "Eiffel Tower"),
+    Interaction("Where is The Vatican located in italy?", "The Vatican"),
+    Interaction("How many steps are there to the top of the Great Pyramid of Giza?", "Great Pyramid of Giza")]
+
+def test_pass_local_provider(tmp_path, monkeypatch):
+    prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path))
+    config = PromptEngineConfig(ModelConfig(max_tokens=1024), description_prefix = "###")
+    dynamic_engine = DynamicPromptEngine(None, config = config, description = description, examples = examples, prompt_bank = prompt_bank)
+    assert len(prompt_bank.openaiservice.store) == len(examples)
+
+    prompt = dynamic_engine.build_prompt("How tall is the Eiffel Tower?")
+    assert prompt.startswith("### Extract the monuments from the given text\n\nI want to see the Eiffel Tower!\nEiffel Tower\n\n")
+    assert prompt.endswith("How tall is the Eiffel Tower?\n") and prompt.count("\n\n") == 6
+    assert asyncio.run(dynamic_engine.abuild_prompt("How tall is the Eiffel Tower?")) == prompt
+
+    # Worker processes that are not forked need a pickled copy of the engine, which holds an open prompt bank,
+    # so the prompts are built in the calling process instead
+    monkeypatch.setattr(multiprocessing, "get_start_method", lambda: "spawn")
+    assert not dynamic_engine._copyable_to_workers()
+    assert dynamic_engine.build_prompts(["How tall is the Eiffel Tower?"] * 3, workers = 2) == [prompt] * 3
+
+    # The embeddings are found in the store by a new bank
+    prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path))
+    assert prompt_bank.retrieve_matched_prompts("extract the monuments from the given text\tis the taj mahal in india", 1)[0].response == "Taj Mahal"
+
+def test_pass_partitioned_bank(tmp_path):
+    prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path))
+    notifications = [Interaction("Your flight is going to be delayed! Please check your Delta app for updated schedules", "Urgent"),
+        Interaction("Hey how are you? We should get lunch sometime.", "Low"),
+        Interaction("Liverpool is now leading in their game vs Aston Villa.", "Medium")]
+    monuments = DynamicPromptEngine(None, description = description, examples = examples, prompt_bank = prompt_bank, namespace = "monuments")
+    urgency = DynamicPromptEngine(None, description = description, examples = notifications, prompt_bank = prompt_bank, namespace = "urgency")
+    assert sorted(prompt_bank.namespaces()) == ["monuments", "urgency"]
+
+    # Each engine only retrieves the examples of its own task, however close the others are
+    context = urgency.build_prompt("Can we go to Taj Mahal?")[:-len("Can we go to Taj Mahal?\n")]
+    assert "Taj Mahal" not in context and all(example.input in context for example in notifications)
+    context = monuments.build_prompt("Liverpool is now leading")[:-len("Liverpool is now leading\n")]
+    assert "Liverpool" not in context and context.count("\n\n") == 6
+
+    # Engines of different tasks are kept apart by default, the namespace being derived from the description
+    greetings = DynamicPromptEngine(None, description = "Answer the greeting", examples = [Interaction("Good morning", "Morning!")], prompt_bank = prompt_bank)
+    assert greetings.namespace == "answer the greeting" and "Taj Mahal" not in greetings.build_prompt("Can we go to Taj Mahal?")[:-len("Can we go to Taj Mahal?\n")]
+    whole_bank = DynamicPromptEngine(None, description = "Answer the greeting", prompt_bank = prompt_bank, namespace = WHOLE_BANK)
+    assert whole_bank.namespace is None and "Taj Mahal\n" in whole_bank.build_prompt("Can we go to Taj Mahal?")
+
+    # Without a namespace the whole bank is searched
+    for user_input, response in [("lunch sometime?", "Low"), ("go to the Taj Mahal", "Taj Mahal")]:
+        matched = prompt_bank.retrieve_matched_prompts(monuments.preprocess_for_embedding_computation(description, user_input), 1)
+        assert [example.response for example in matched] == [response]
+
+class CountingProvider(HashedNgramEmbeddingProvider):
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    def embed(self, texts):
+        self.texts.extend(texts)
+        return super().embed(texts)
+
+def test_pass_query_caches(tmp_path):
+    provider = CountingProvider()
+    prompt_bank = PromptBank(provider, cache_location = str(tmp_path), query_cache_size = 2)
+    dynamic_engine = DynamicPromptEngine(None, description = description, examples = examples[:6], prompt_bank = prompt_bank, namespace = "monuments")
+    service = prompt_bank.openaiservice
+    provider.texts = []
+
+    # A repeated query is neither embedded nor searched again, and queries are not stored with the examples
+    prompt = dynamic_engine.build_prompt("Where is the Great Pyramid?")
+    assert dynamic_engine.build_prompt("Where is the Great Pyramid?") == prompt
+    assert len(provider.texts) == 1 and service.result_cache.info().hits == 1
+    assert len(service.store) == 6 and len(service.embedding_cache) == 6
+
+    # Adding an example to the namespace invalidates the results, not the embedding of the query
+    prompt_bank.add_examples([dynamic_engine.preprocess_for_embedding_computation(description, examples[6].input)], [examples[6]], "monuments")
+    assert "Great Pyramid of Giza\n" in dynamic_engine.build_prompt("Where is the Great Pyramid?")
+    assert len(provider.texts) == 2 and service.query_cache.info().hits == 1
+
+    # The query embeddings are bounded
+    for user_input in ["Big Buddha", "Vatican", "Stonehenge"]:
+        dynamic_engine.build_prompt(user_input)
+    assert len(service.query_cache) == 2
+
+def test_pass_stored_token_costs(tmp_path, monkeypatch):
+    DynamicPromptEngine(None, description = description, examples = examples, prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path)))
+
+    # A new bank finds the token spans of the examples in the store, an engine without examples packs them without tokenizing them
+    prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path))
+    dynamic_engine = DynamicPromptEngine(None, config = PromptEngineConfig(ModelConfig(max_tokens=1024)), description = description, prompt_bank = prompt_bank)
+    query = dynamic_engine.preprocess_for_embedding_computation(description, "I want to see the Eiffel Tower")
+    candidates = prompt_bank.retrieve_candidates(query)
+    render_key = dynamic_engine._example_render_key()
+    for example, _, token_costs in candidates:
+        text = example.render(render_key, dynamic_engine._format_example)
+        assert token_costs[dynamic_engine._token_cost_key(text)][1] == len(dynamic_engine.encoder.encode(text))
+
+    tokenized = []
+    budget_class = type(dynamic_engine._get_token_budget())
+    tokenize = budget_class.tokenize
+    monkeypatch.setattr(budget_class, "tokenize", lambda budget, text: tokenized.append(text) or tokenize(budget, text))
+    prompt = dynamic_engine.build_prompt("I want to see the Eiffel Tower")
+    assert prompt.startswith("Extract the monuments from the given text\n\nI want to see the Eiffel Tower!\nEiffel Tower\n\n")
+    assert tokenized == ["I want to see the Eiffel Tower\n"]
+
+    # The limit is checked on the exact token count of the context followed by each example and the input
+    user_input = "I want to see the Eiffel Tower"
+    formatted_input = dynamic_engine.format_input(user_input)
+    context = dynamic_engine._insert_description("", formatted_input)
+    longest = max(len(dynamic_engine.encoder.encode(context + example.render(render_key, dynamic_engine._format_example) + formatted_input)) for example, _, _ in candidates)
+    dynamic_engine.config.model_config.max_tokens = len(dynamic_engine.encoder.encode(prompt))
+    assert dynamic_engine.build_prompt(user_input) == prompt
+    for max_tokens, message in [(longest, TOKEN_LIMIT_MESSAGE), (longest - 1, EXAMPLES_TOKEN_LIMIT_MESSAGE)]:
+        dynamic_engine.config.model_config.max_tokens = max_tokens
+        with pytest.raises(Exception) as error:
+            dynamic_engine.build_prompt(user_input)
+        assert str(error.value) == message
+
+def test_pass_shared_prompt_bank(tmp_path, monkeypatch):
+    # Engines given no prompt bank share the one of the working directory instead of loading the embeddings again
+    monkeypatch.chdir(tmp_path)
+    first = DynamicPromptEngine(None, description = "Extract the monuments from the given text")
+    second = DynamicPromptEngine(None, description = "Classify the urgency of the notification")
+    assert first.prompt_bank is second.prompt_bank and first.namespace != second.namespace
+    assert first.prompt_bank.openaiservice.store.path == str(tmp_path.resolve() / "embeddings_store")
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import threading
+import time
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.prompt_engine.dynamic_prompt_engine import OpenAIEmbedding, PromptBank
+from src.prompt_engine.interaction import Interaction
+from src.prompt_engine.utils.embedding_client import EmbeddingClient, TokenBucket
+from src.prompt_engine.utils.embedding_provider import OpenAIEmbeddingProvider
+
+class StubEmbeddingServer(ThreadingHTTPServer):
+    """
+    Stands in for the embeddings endpoint, recording the inputs of every request and the most requests it served at once.
+    The next `rate_limited` requests are answered with a 429 asking to retry after `retry_after` seconds, and the next `stalled`
+    ones take a second to be answered
+    """
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubEmbeddingHandler)
+        self.rate_limited = 0
+        self.retry_after = None
+        self.stalled = 0
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def api_base(self):
+        return "http://127.0.0.1:%d/v1" % self.server_address[1]
+
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        with server.lock:
+            server.requests.append((self.path, texts))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            rate_limited = server.rate_limited > 0
+            server.rate_limited -= rate_limited
+            stalled = not rate_limited and server.stalled > 0
+            server.stalled -= stalled
+        time.sleep(1 if stalled else 0.05)
+        with server.lock:
+            server.in_flight -= 1
+        if rate_limited:
+            body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests"}}).encode()
+            self.send_response(429)
+            if server.retry_after is not None:
+                self.send_header("Retry-After", str(server.retry_after))
+        else:
+            data = [{"object": "embedding", "index": i, "embedding": [float(len(text)), float(text.count("a")), 1.0]} for i, text in enumerate(texts)]
+            body = json.dumps({"object": "list", "data": data[::-1], "model": "stub"}).encode()
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_pass_batched_embeddings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = StubEmbeddingServer()
+    provider = OpenAIEmbeddingProvider("stub", batch_size = 4, max_concurrency = 3, api_base = server.api_base, api_key = "test", client = EmbeddingClient())
+    service = OpenAIEmbedding(str(tmp_path), provider)
+
+    # A query embedded earlier is reused for the example with the same text
+    service.embedding_from_string("aaa", query = True)
+    assert len(server.requests) == 1
+    assert ("aaa", "stub") not in service.embedding_cache and len(service.store) == 0
+
+    strings = ["a" * i for i in range(1, 21)]
+    examples = [Interaction(string, "response %d" % i) for i, string in enumerate(strings)]
+    assert service.embeddings_from_strings(strings + strings[:2], examples + examples[:2])
+    assert all(path == "/v1/engines/stub/embeddings" for path, _ in server.requests)
+    assert sorted(len(texts) for _, texts in server.requests[1:]) == [3, 4, 4, 4, 4]
+    assert "aaa" not in sum([texts for _, texts in server.requests[1:]], [])
+    assert server.max_in_flight == 3
+
+    # The embeddings are kept normalized, as contiguous float32 arrays
+    for string, example in zip(strings, examples):
+        embedding, cached_example = service.embedding_cache[(string, "stub")]
+        assert embedding.dtype == np.float32 and embedding.flags["C_CONTIGUOUS"] and cached_example is example
+        assert np.allclose(embedding, np.array([len(string), len(string), 1.0]) / np.sqrt(2 * len(string) ** 2 + 1))
+
+    # Nothing is sent again, and the embeddings were persisted
+    assert service.embeddings_from_strings(strings, examples)
+    assert len(server.requests) == 6
+    assert len(service.store) == 20
+    assert service.get_recommendations_from_strings("aaaaa", 2) == [examples[4], examples[5]]
+
+    more = [Interaction("b" * i, "more %d" % i) for i in range(1, 6)]
+    assert asyncio.run(service.aembeddings_from_strings([example.input for example in more], more))
+    assert sorted(len(texts) for _, texts in server.requests[6:]) == [1, 4]
+    assert np.allclose(service.embedding_cache[("bbb", "stub")][0], np.array([3.0, 0.0, 1.0]) / np.sqrt(10))
+    server.shutdown()
+
+def test_pass_rate_limited_client(tmp_path):
+    server = StubEmbeddingServer()
+    # The delays waited between the requests are recorded instead of slept
+    delays = []
+    async def asleep(delay):
+        delays.append(delay)
+    client = EmbeddingClient(max_in_flight = 2, timeout = 0.3, max_retries = 3, backoff = 0.05, seed = 0, sleep = delays.append, asleep = asleep)
+    provider = OpenAIEmbeddingProvider("stub", batch_size = 2, max_concurrency = 4, api_base = server.api_base, api_key = "test", client = client)
+    service = OpenAIEmbedding(str(tmp_path), provider)
+
+    # Rate limited requests are sent again after a growing delay with jitter, and no more than max_in_flight requests are sent at once
+    server.rate_limited = 2
+    assert service.get_embedding_with_retries("aaa") == (True, [3.0, 3.0, 1.0])
+    assert len(server.requests) == 3 and client.retries == 2
+    assert len(delays) == 2 and 0.05 / 2 <= delays[0] <= 0.05 and 0.1 / 2 <= delays[1] <= 0.1
+    strings = ["a" * i for i in range(1, 13)]
+    assert service.embeddings_from_strings(strings, [Interaction(string, "response") for string in strings])
+    assert server.max_in_flight == 2
+
+    # The delay asked for by the server is respected, and a stalled request times out and is sent again
+    server.rate_limited, server.retry_after, server.stalled = 1, 0.4, 1
+    del delays[:]
+    assert asyncio.run(service.aget_embedding_with_retries("bbb")) == (True, [3.0, 0.0, 1.0])
+    assert delays[0] == 0.4 and len(delays) == 2 and server.stalled == 0 and client.retries == 4
+
+    # Once the retries are exhausted, the embedding is reported as failed
+    server.rate_limited, server.retry_after = 10, None
+    requests = len(server.requests)
+    assert service.get_embedding_with_retries("ccc") == (False, None)
+    assert len(server.requests) - requests == 4
+    server.shutdown()
+
+    # Providers share the client of the process unless they are given one
+    assert PromptBank(cache_location = str(tmp_path / "a")).provider.client is PromptBank(cache_location = str(tmp_path / "b")).provider.client
+
+def test_pass_async_request_slots():
+    client = EmbeddingClient(max_in_flight = 1)
+    in_flight = [0, 0]
+
+    async def asend(timeout):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0)
+        in_flight[0] -= 1
+        return True
+
+    # A thread holds the only request slot, the coroutines waiting for it are woken once it is released
+    released = threading.Event()
+    holder = threading.Thread(target=client.request, args=(lambda timeout: released.wait(),))
+    holder.start()
+    while client._in_flight == 0:
+        time.sleep(0.001)
+
+    async def run():
+        requests = asyncio.gather(*[client.arequest(asend) for _ in range(5)])
+        await asyncio.sleep(0)
+        assert len(client._async_waiters) == 5
+        released.set()
+        return await requests
+
+    assert asyncio.run(run()) == [True] * 5 and in_flight[1] == 1
+    holder.join()
+    assert client._in_flight == 0 and len(client._async_waiters) == 0
+
+def test_pass_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(120, clock = lambda: now[0])
+    assert [bucket.reserve(60), bucket.reserve(60), bucket.reserve(30)] == [0.0, 0.0, 15.0]
+    now[0] = 10.0
+    assert bucket.reserve(1) == 5.5
+    now[0] = 120.0
+    assert bucket.reserve(100) == 0.0 and bucket.level == 20
@@ -0,0 +1,80 @@
+import json
+import os
+import numpy as np
+from src.prompt_engine.utils.embedding_store import EmbeddingStore
+
+def test_pass_reopen_and_compact(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.append(("hello", "engine"), [1.0, 2.0, 3.0], {"input": "hello", "response": ""})
+    store.append_many([(("bye", "engine"), np.ones(5), {"input": "bye", "response": "ciao"}),
+                       (("hello", "engine"), [3.0, 2.0, 1.0], {"input": "hello", "response": "hi"})])
+    store.close()
+
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 2 and store.garbage == 1
+    vector, metadata = store[("hello", "engine")]
+    assert list(vector) == [3.0, 2.0, 1.0] and metadata == {"input": "hello", "response": "hi"}
+    assert [key for key, _, _ in store.items()] == [("hello", "engine"), ("bye", "engine")]
+
+    store.compact()
+    assert store.garbage == 0 and sorted(os.listdir(str(tmp_path))) == ["CURRENT", "LOCK", "index.1.jsonl", "vectors.1.bin"]
+    store.append(("new", "engine"), [0.5], {})
+    store.close()
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 3 and list(store[("bye", "engine")][0]) == [1.0] * 5 and list(store[("new", "engine")][0]) == [0.5]
+
+def test_pass_torn_writes_discarded(tmp_path):
+    store = EmbeddingStore(str(tmp_path), sync = False)
+    store.append(("a",), [1.0, 2.0], {})
+    store.append(("b",), [3.0, 4.0], {})
+    store.close()
+    vectors_path, index_path = store._paths(0)
+
+    # An index line cut short, and vectors written without their index line
+    with open(index_path, "ab") as index_file:
+        index_file.write(b'{"key": ["c"], "off')
+    with open(vectors_path, "ab") as vectors_file:
+        vectors_file.write(b"\1" * 8)
+    store = EmbeddingStore(str(tmp_path))
+    assert list(store.keys()) == [("a",), ("b",)]
+    store.append(("c",), [5.0, 6.0], {})
+    store.close()
+
+    # The vector of the last record torn although its index line is complete
+    with open(vectors_path, "r+b") as vectors_file:
+        vectors_file.seek(-8, os.SEEK_END)
+        vectors_file.write(b"\0" * 4)
+    store = EmbeddingStore(str(tmp_path))
+    assert list(store.keys()) == [("a",), ("b",)] and list(store[("b",)][0]) == [3.0, 4.0]
+
+def test_pass_shared_directory(tmp_path):
+    # Two instances appending to the same directory write after each other's records, not over them
+    first, second = EmbeddingStore(str(tmp_path)), EmbeddingStore(str(tmp_path))
+    for i in range(5):
+        first.append(("first %d" % i,), [float(i)] * 3, {})
+        second.append_many([(("second %d" % i,), [float(-i)] * (i + 1), {}), (("second %d" % i,), [float(-i)] * 2, {})])
+    second.compact()
+    first.append(("after compaction",), [7.0], {})
+
+    # Vectors appended before another instance compacts the directory are still read, from the compacted files
+    first.append(("before compaction",), [8.0], {})
+    second.compact()
+    assert list(first[("before compaction",)][0]) == [8.0] and list(first[("after compaction",)][0]) == [7.0]
+    first.append(("before compaction",), [9.0], {})
+    first.close()
+    second.close()
+
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 12 and store.garbage == 1
+    assert all(list(store[("first %d" % i,)][0]) == [float(i)] * 3 and list(store[("second %d" % i,)][0]) == [float(-i)] * 2 for i in range(5))
+    assert list(store[("after compaction",)][0]) == [7.0]
+    store.close()
+
+    # A record whose vector does not match its crc is skipped, the records after it are kept
+    vectors_path, _ = store._paths(store.generation)
+    offset = next(record for record in map(json.loads, open(store._paths(store.generation)[1])) if record["key"] == ["first 2"])["offset"]
+    with open(vectors_path, "r+b") as vectors_file:
+        vectors_file.seek(offset)
+        vectors_file.write(b"\1" * 4)
+    store = EmbeddingStore(str(tmp_path))
+    assert ("first 2",) not in store and len(store) == 11 and list(store[("after compaction",)][0]) == [7.0]
@@ -0,0 +1,121 @@
+import random
+import os
+from src.prompt_engine.utils.encoder import get_encoder, get_json_encoder, get_pairs
+from src.prompt_engine.utils import vocabulary
+from src.prompt_engine.utils.vocabulary import BinaryVocabulary, read_sources, write_vocabulary
+
+def test_pass_binary_vocabulary(tmp_path):
+    path = write_vocabulary(str(tmp_path / "encoder.bin"))
+    vocabulary = BinaryVocabulary(path)
+    encoder, bpe_merges = read_sources()
+    assert len(vocabulary.encoder) == len(encoder)
+    assert all(vocabulary.encoder[token] == token_id for token, token_id in encoder.items())
+    assert all(vocabulary.decoder[token_id] == token for token, token_id in encoder.items())
+    assert all(vocabulary.bpe_ranks[merge] == rank for rank, merge in enumerate(bpe_merges))
+    assert vocabulary.encoder.get("not a token") is None
+    assert ("not", "a merge") not in vocabulary.bpe_ranks
+
+def test_pass_binary_vocabulary_encoder():
+    text = "The binary vocabulary encodes   text like 1234567 the parsed one does, even ünïcödé!\n\n"
+    binary_encoder = get_encoder()
+    json_encoder = get_json_encoder()
+    assert binary_encoder.encode(text) == json_encoder.encode(text)
+    assert binary_encoder.decode(binary_encoder.encode(text)) == text
+
+def test_pass_bpe_cache_eviction():
+    encoder = get_encoder(cache_size = 2)
+    encoder.encode(" alpha beta")
+    assert encoder.cache_info().misses == 2
+    encoder.encode(" alpha")
+    assert encoder.cache_info().hits == 1
+    encoder.encode(" gamma")
+    info = encoder.cache_info()
+    assert (info.evictions, info.currsize, info.maxsize) == (1, 2, 2)
+    assert "Ġbeta" not in encoder.cache and "Ġalpha" in encoder.cache
+    encoder.cache.resize(1)
+    assert encoder.cache_info().currsize == 1
+
+def _reference_bpe(bpe_ranks, token):
+    """
+    The original merge loop: repeatedly merges every occurrence of the lowest ranked pair of the word
+    """
+    word = tuple(token)
+    pairs = get_pairs(word)
+    if not pairs:
+        return token
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float("inf")))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = get_pairs(word)
+    return " ".join(word)
+
+def test_pass_bpe_matches_reference_over_vocabulary():
+    encoder = get_json_encoder(cache_size = 0)
+    for token in encoder.encoder:
+        assert encoder.bpe(token) == _reference_bpe(encoder.bpe_ranks, token)
+
+def test_pass_bpe_matches_reference_on_long_pre_tokens():
+    encoder = get_json_encoder(cache_size = 0)
+    rng = random.Random(0)
+    alphabets = ["0123456789", "abcdefghijklmnopqrstuvwxyz_", "aaab", "{}();=.,"]
+    for _ in range(200):
+        text = "".join(rng.choice(rng.choice(alphabets)) for _ in range(rng.randint(2, 300)))
+        for match in encoder.pat.finditer(text):
+            token = "".join(encoder.byte_encoder[b] for b in match.group().encode("utf-8"))
+            assert encoder.bpe(token) == _reference_bpe(encoder.bpe_ranks, token)
+
+def test_pass_encode_batch():
+    encoder = get_encoder()
+    texts = ["Hello world", "", "Hello again world!\n\n", "1234567 ünïcödé  text"] * 3
+    assert encoder.encode_batch(texts) == [encoder.encode(text) for text in texts]
+    assert encoder.count_tokens_batch(texts) == [len(encoder.encode(text)) for text in texts]
+
+def test_pass_encode_batch_process_pool():
+    encoder = get_encoder()
+    texts = ["process %d of the pool" % i for i in range(50)]
+    with encoder.process_pool(2) as pool:
+        assert encoder.encode_batch(texts, pool = pool) == [encoder.encode(text) for text in texts]
+        assert encoder.count_tokens_batch(texts, pool = pool) == [len(encoder.encode(text)) for text in texts]
+
+def test_pass_count_tokens():
+    encoder = get_encoder()
+    text = "Counting tokens does not build the list of token ids " * 10
+    assert encoder.count_tokens(text) == len(encoder.encode(text))
+    assert encoder.count_tokens(text, limit = 5) == 6
+    assert encoder.count_tokens("", limit = 0) == 0
+
+def test_pass_vocabulary_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMPT_ENGINE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(vocabulary, "bundled_path", lambda: str(tmp_path / "missing" / "encoder.bin"))
+    first = vocabulary.load_vocabulary()
+    assert first.path == str(tmp_path / "encoder.bin")
+    assert first.stamp == vocabulary.source_stamp()
+    assert not os.path.exists(os.path.join(os.path.dirname(vocabulary.__file__), "encoder.bin"))
+    modified = os.stat(first.path).st_mtime_ns
+    second = vocabulary.load_vocabulary()
+    assert second.path == first.path and os.stat(second.path).st_mtime_ns == modified
+    # A bundled vocabulary compiled from sources of the same sizes is used as is, whatever their modification times
+    bundled = vocabulary.write_vocabulary(str(tmp_path / "bundled" / "encoder.bin"))
+    monkeypatch.setattr(vocabulary, "bundled_path", lambda: bundled)
+    assert vocabulary.load_vocabulary().path == bundled
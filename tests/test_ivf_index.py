@@ -0,0 +1,59 @@
+import functools
+import numpy as np
+from src.prompt_engine.dynamic_prompt_engine import PromptBank
+from src.prompt_engine.interaction import Interaction
+from src.prompt_engine.utils.embedding_provider import HashedNgramEmbeddingProvider
+from src.prompt_engine.utils.ivf_index import IVFIndex, recall_at_k
+from src.prompt_engine.utils.vector_index import VectorIndex
+
+def _clustered(rng, clusters = 50, dimension = 32):
+    centers = rng.normal(size=(clusters, dimension))
+    return lambda count: centers[rng.integers(0, clusters, count)] + 0.3 * rng.normal(size=(count, dimension))
+
+def test_pass_recall_and_updates(tmp_path):
+    rng = np.random.default_rng(0)
+    sample = _clustered(rng)
+    vectors, queries = sample(3000), sample(50)
+    exact = VectorIndex()
+    exact.add_many(vectors)
+    index = IVFIndex(nlist = 40, nprobe = 4, min_train_size = 2000)
+
+    # Exact until trained, then approximate, and exact again when every cluster is probed
+    index.add_many(vectors[:1000])
+    partial = VectorIndex()
+    partial.add_many(vectors[:1000])
+    assert not index.trained and recall_at_k(index, partial, queries, 10) == 1.0
+    index.add_many(vectors[1000:])
+    assert index.trained and len(index) == 3000
+    assert recall_at_k(index, exact, queries, 10) > 0.9
+    index.nprobe = 40
+    assert recall_at_k(index, exact, queries, 10) == 1.0
+
+    # Vectors replaced and added after training are found, and the index survives a save and a load
+    index.set(7, -vectors[7])
+    exact.set(7, -vectors[7])
+    extra = sample(100)
+    index.add_many(extra)
+    exact.add_many(extra)
+    assert recall_at_k(index, exact, np.concatenate([queries, [-vectors[7]]]), 10) == 1.0
+    index.save(str(tmp_path / "index.npz"), {"name": "test"})
+    loaded, metadata = IVFIndex.load(str(tmp_path / "index.npz"))
+    assert metadata == {"name": "test"} and np.array_equal(loaded.vectors, index.vectors)
+    for query in queries:
+        assert list(loaded.search(query, 10)[0]) == list(index.search(query, 10)[0])
+
+def test_pass_prompt_bank_index(tmp_path):
+    index_class = functools.partial(IVFIndex, nlist = 3, nprobe = 3, min_train_size = 6)
+    prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path), index_class = index_class)
+    examples = [Interaction("example %d about %s" % (i, topic), topic) for i, topic in enumerate(["cats", "dogs", "birds", "fish"] * 3)]
+    prompt_bank.add_examples([example.input for example in examples[:8]], examples[:8], "animals")
+    assert [example.response for example in prompt_bank.retrieve_matched_prompts("example about dogs", 2, "animals")] == ["dogs", "dogs"]
+    prompt_bank.save_indexes()
+
+    # A new bank loads the saved index, and adds the examples stored after it was saved
+    prompt_bank.add_examples([example.input for example in examples[8:]], examples[8:], "animals")
+    reopened = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path), index_class = index_class)
+    partition = reopened.openaiservice._get_partitions()["animals"]
+    assert partition.index.trained and len(partition.index) == 12
+    assert np.array_equal(partition.index.centroids, prompt_bank.openaiservice._get_partitions()["animals"].index.centroids)
+    assert [example.response for example in reopened.retrieve_matched_prompts("example about birds", 3, "animals")] == ["birds"] * 3
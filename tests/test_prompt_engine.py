@@ -1,6 +1,9 @@
+import asyncio
 from src.prompt_engine.prompt_engine import PromptEngine, PromptEngineConfig
 from src.prompt_engine.model_config import ModelConfig
 from src.prompt_engine.interaction import Interaction
+from src.prompt_engine.utils.encoder import get_encoder
+from src.prompt_engine.prompt_renderer import PromptRenderer
 
 def test_pass():
     config = PromptEngineConfig(ModelConfig(max_tokens=1024), description_prefix = "###", input_prefix = "##", output_prefix = "")
@@ -155,4 +158,145 @@ def test_pass_masterIntegrationTest():
     prompt_engine.add_interaction("Hello there", "print('Hello there')")
     prompt_engine.remove_last_interaction()
     prompt_engine.add_example("Hello there", "print('Hello there')")
-    assert prompt_engine.build_prompt("Hello") == "## Hello\nprint('Hello')\n\n## Goodbye\nprint('Goodbye')\n\n## Hello there\nprint('Hello there')\n\n### This is the flow reset text\n\n## Bye\nprint('Bye')\n\n## Bye\nprint('Bye')\n\n## Hello\n"
\ No newline at end of file
+    assert prompt_engine.build_prompt("Hello") == "## Hello\nprint('Hello')\n\n## Goodbye\nprint('Goodbye')\n\n## Hello there\nprint('Hello there')\n\n### This is the flow reset text\n\n## Bye\nprint('Bye')\n\n## Bye\nprint('Bye')\n\n## Hello\n"
+
+def test_pass_shared_encoder():
+    config = PromptEngineConfig(description_prefix = "###", input_prefix = "##", output_prefix = "")
+    prompt_engine = PromptEngine(config, "")
+    other_prompt_engine = PromptEngine(config, "")
+    assert prompt_engine.encoder is other_prompt_engine.encoder
+
+def test_pass_injected_encoder():
+    config = PromptEngineConfig(description_prefix = "###", input_prefix = "##", output_prefix = "")
+    encoder = get_encoder()
+    prompt_engine = PromptEngine(config, "", encoder = encoder)
+    assert prompt_engine.encoder is encoder
+    assert PromptEngine(config, "").encoder is not encoder
+
+def test_pass_dialog_window_after_updates():
+    config = PromptEngineConfig(model_config = ModelConfig(max_tokens=60), description_prefix = "###", input_prefix = "##", output_prefix = "")
+    prompt_engine = PromptEngine(config, "Trial Description", dialog = [])
+    for i in range(30):
+        prompt_engine.add_interaction("Turn %d" % i, "print(%d)" % i)
+    prompt_engine.remove_first_interaction()
+    prompt_engine.remove_last_interaction()
+
+    # The most recent turns are kept, as many as fit when checked one by one from the newest
+    context = "### Trial Description\n\n"
+    user_input = "## Hello\n"
+    interactions_text = ""
+    for i in range(28, 0, -1):
+        interaction_text = "## Turn %d\nprint(%d)\n\n" % (i, i)
+        if len(prompt_engine.encoder.encode(context + interactions_text + interaction_text + user_input)) > 60:
+            break
+        interactions_text = interaction_text + interactions_text
+    assert interactions_text != ""
+    assert prompt_engine.build_prompt("Hello") == context + interactions_text + user_input
+
+def test_pass_interaction_cache_invalidated():
+    config = PromptEngineConfig(description_prefix = "###", input_prefix = "##", output_prefix = "")
+    examples = [Interaction("Hello", "print('Hello')")]
+    dialog = [Interaction("Bye", "print('Bye')")]
+    prompt_engine = PromptEngine(config, "Trial Description", examples = examples, dialog = dialog)
+    prompt_engine.build_prompt("Hello")
+    assert examples[0].token_count == len(prompt_engine.encoder.encode("## Hello\nprint('Hello')\n\n"))
+
+    examples[0].response = "print('Hi')"
+    dialog[0].input = "Goodbye"
+    config.input_prefix = ">> "
+    assert prompt_engine.build_prompt("Hello") == "### Trial Description\n\n>> Hello\nprint('Hi')\n\n>> Goodbye\nprint('Bye')\n\n>> Hello\n"
+
+class ExamplesOverridden(PromptEngine):
+    def _insert_examples(self, context: str = "", user_input: str = ""):
+        return context + "".join("Example: %s\nAnswer: %s\n\n" % (example.input, example.response) for example in self.examples)
+
+class DescriptionWrapped(PromptEngine):
+    # The override only wraps the step of the PromptEngine, so the static prefix can still be cached
+    static_prefix_cacheable = True
+
+    def _insert_description(self, context: str = "", user_input: str = ""):
+        return super()._insert_description(context, user_input)
+
+def test_pass_static_prefix_cacheable():
+    examples = [Interaction("Hello", "print('Hello')")]
+    assert PromptEngine.static_prefix_cacheable and not ExamplesOverridden.static_prefix_cacheable
+
+    # A subclass overriding a step of the static prefix has it inserted for every prompt, unless it says otherwise
+    overridden = ExamplesOverridden(PromptEngineConfig(), "Trial Description", examples = examples)
+    assert overridden.build_prompt("Hi") == "Trial Description\n\nExample: Hello\nAnswer: print('Hello')\n\nHi\n"
+    assert getattr(overridden, "_static_prefix", None) is None
+    wrapped = DescriptionWrapped(PromptEngineConfig(), "Trial Description", examples = examples)
+    assert wrapped.build_prompt("Hi") == PromptEngine(PromptEngineConfig(), "Trial Description", examples = examples).build_prompt("Hi")
+    assert wrapped._static_prefix is not None
+
+    # build_prompts calls build_prompt when it is overridden
+    class Shouting(PromptEngine):
+        def build_prompt(self, user_input: str, multi_turn: bool = True, newline_end: bool = True):
+            return super().build_prompt(user_input.upper(), multi_turn, newline_end)
+    assert not Shouting.static_prefix_cacheable
+    assert Shouting(PromptEngineConfig(), "Trial Description").build_prompts(["hi", "bye"]) == ["Trial Description\n\nHI\n", "Trial Description\n\nBYE\n"]
+
+def test_pass_compiled_renderer():
+    config = PromptEngineConfig(description_prefix = "###", input_prefix = "##", output_prefix = "")
+    renderer = config.compile()
+    assert config.compile() is renderer
+    assert renderer.example(Interaction("Hello", "print('Hello')")) == "## Hello\nprint('Hello')\n\n"
+    assert renderer.input("Hello", newline_end = False) == "## Hello"
+    config.newline_operator = "\r\n"
+    assert config.compile() is not renderer
+    assert config.compile().description("Trial Description") == "### Trial Description\r\n\r\n"
+
+def test_pass_custom_example_format():
+    class CustomRenderer(PromptRenderer):
+        def __init__(self, config):
+            super().__init__(config)
+            self.example_format = ("Example: ", self.input_end + "Answer: ", self.input_end*2)
+
+    class CustomConfig(PromptEngineConfig):
+        renderer_class = CustomRenderer
+
+    config = CustomConfig(description_prefix = "###", input_prefix = "##", output_prefix = "")
+    examples = [Interaction("Hello", "print('Hello')")]
+    dialog = [Interaction("Bye", "print('Bye')")]
+    prompt_engine = PromptEngine(config, "Trial Description", examples = examples, dialog = dialog)
+    assert prompt_engine.build_prompt("Hello") == "### Trial Description\n\nExample: Hello\nAnswer: print('Hello')\n\n## Bye\nprint('Bye')\n\n## Hello\n"
+
+def test_pass_static_prefix_cache():
+    config = PromptEngineConfig(description_prefix = "###", input_prefix = "##", output_prefix = "")
+    prompt_engine = PromptEngine(config, "Trial Description", examples = [Interaction("Hello", "print('Hello')")], flow_reset_text = "Reset", dialog = [])
+    prompt_engine.build_prompt("Hello")
+    static_prefix = prompt_engine._static_prefix
+    prompt_engine.build_prompt("Goodbye")
+    assert prompt_engine._static_prefix is static_prefix
+
+    prompt_engine.add_example("Bye", "print('Bye')")
+    prompt_engine.description = "Other Description"
+    assert prompt_engine.build_prompt("Hello") == "### Other Description\n\n## Hello\nprint('Hello')\n\n## Bye\nprint('Bye')\n\n### Reset\n\n## Hello\n"
+    assert prompt_engine._static_prefix is not static_prefix
+    assert prompt_engine._static_prefix.span.count == len(prompt_engine.encoder.encode(prompt_engine._static_prefix.text))
+
+def test_pass_build_prompts():
+    config = PromptEngineConfig(model_config = ModelConfig(max_tokens=80), description_prefix = "###", input_prefix = "##", output_prefix = "")
+    examples = [Interaction("Hello", "print('Hello')")]
+    dialog = [Interaction("Turn %d" % i, "print(%d)" % i) for i in range(20)]
+    prompt_engine = PromptEngine(config, "Trial Description", examples = examples, flow_reset_text = "Reset", dialog = dialog)
+    user_inputs = ["Hello", "Goodbye", "A much longer question " * 5, ""]
+    expected = [prompt_engine.build_prompt(user_input) for user_input in user_inputs]
+    assert prompt_engine.build_prompts(user_inputs) == expected
+    assert list(prompt_engine.build_prompts(iter(user_inputs), stream = True)) == expected
+    assert prompt_engine.build_prompts(user_inputs * 3, workers = 2, chunk_size = 2) == expected * 3
+
+def test_pass_async_build_prompt():
+    config = PromptEngineConfig(model_config = ModelConfig(max_tokens=200), description_prefix = "###", input_prefix = "##", output_prefix = "")
+    prompt_engine = PromptEngine(config, "Trial Description", examples = [Interaction("Hello", "print('Hello')")], dialog = [])
+
+    async def converse():
+        for i in range(10):
+            prompt = await prompt_engine.abuild_prompt("Turn %d" % i)
+            assert prompt == prompt_engine.build_prompt("Turn %d" % i)
+            prompt_engine.add_interaction("Turn %d" % i, "print(%d)" % i)
+        return await asyncio.gather(*[prompt_engine.abuild_prompt("Bye %d" % i) for i in range(10)])
+
+    prompts = asyncio.run(converse())
+    assert prompts == [prompt_engine.build_prompt("Bye %d" % i) for i in range(10)]
+    assert asyncio.run(prompt_engine.abuild_context()) == prompt_engine.build_context()
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from src.prompt_engine.prompt_template import PromptTemplate
+from src.prompt_engine.prompt_engine import PromptEngine, PromptEngineConfig
+from src.prompt_engine.chat_engine import ChatEngine, ChatEngineConfig
+from src.prompt_engine.interaction import Interaction
+from src.prompt_engine.model_config import ModelConfig
+from src.prompt_engine.dynamic_prompt_engine import DynamicPromptEngine
+import pytest
+
+def test_pass_sessions_share_template():
+    examples = [Interaction("Hi", "Hello there")]
+    template = PromptTemplate(ChatEngineConfig(), "Trial Description", examples, engine_class = ChatEngine)
+    first_session = template.create_session()
+    second_session = template.create_session([Interaction("Bye", "Goodbye")])
+    first_session.add_interaction("How are you?", "Fine")
+
+    assert first_session.build_prompt("Hey") == "Trial Description\n\nUSER: Hi\nBOT: Hello there\n\nUSER: How are you?\nBOT: Fine\n\nUSER: Hey\n"
+    assert second_session.build_prompt("Hey") == "Trial Description\n\nUSER: Hi\nBOT: Hello there\n\nUSER: Bye\nBOT: Goodbye\n\nUSER: Hey\n"
+    assert first_session._static_prefix is second_session._static_prefix
+    assert template.token_count == len(template.encoder.encode(template.build_static_prefix()))
+
+    # Changing the originals does not change the template
+    examples[0].response = "Changed"
+    assert "Changed" not in template.create_session().build_prompt("Hey")
+
+    # Nor can a session change the examples shared with the other sessions
+    with pytest.raises(Exception):
+        first_session.examples[0].input = "Mutated"
+    with pytest.raises(Exception):
+        first_session.examples[0].response = "Mutated"
+    assert "Mutated" not in second_session.build_prompt("Hey") and "Mutated" not in template.build_static_prefix()
+
+def test_fail_template_is_immutable():
+    template = PromptTemplate(PromptEngineConfig(), "Trial Description", [Interaction("Hi", "Hello there")])
+    session = template.create_session()
+    with pytest.raises(Exception):
+        template.description = "Other Description"
+    with pytest.raises(Exception):
+        session.config.input_prefix = "##"
+    with pytest.raises(Exception):
+        session.add_example("Bye", "Goodbye")
+
+def test_pass_concurrent_sessions():
+    template = PromptTemplate(ChatEngineConfig(), "Trial Description", [Interaction("Hi %d" % i, "Hello %d" % i) for i in range(5)], engine_class = ChatEngine)
+
+    def converse(user):
+        session = template.create_session()
+        prompts = []
+        for turn in range(20):
+            prompts.append(session.build_prompt("User %d turn %d" % (user, turn)))
+            session.add_interaction("User %d turn %d" % (user, turn), "Reply %d" % turn)
+        return prompts
+
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        concurrent_prompts = list(executor.map(converse, range(16)))
+    assert concurrent_prompts == [converse(user) for user in range(16)]
+
+def test_pass_default_arguments_not_shared():
+    first_engine, second_engine = PromptEngine(), PromptEngine()
+    first_engine.add_example("Hi", "Hello there")
+    first_engine.add_interaction("Bye", "Goodbye")
+    assert second_engine.examples == [] and len(second_engine.dialog) == 0
+
+def test_pass_model_config_frozen():
+    model_config = ModelConfig(max_tokens = 1024, stop = ["\n"])
+    template = PromptTemplate(PromptEngineConfig(model_config), "Trial Description", [Interaction("Hi", "Hello there")])
+    session = template.create_session()
+    with pytest.raises(Exception):
+        session.config.model_config.max_tokens = 10
+    # The model config is copied, so changing the original does not change the template
+    model_config.max_tokens = 10
+    model_config.stop.append("USER:")
+    assert template.config.model_config.max_tokens == 1024 and template.config.model_config.stop == ["\n"]
+    assert "Hello there" in session.build_prompt("Hey")
+    assert "_frozen" not in session.save_yaml()
+
+def test_fail_template_engine_class():
+    with pytest.raises(Exception, match = "DynamicPromptEngine"):
+        PromptTemplate(PromptEngineConfig(), "Trial Description", [Interaction("Hi", "Hello there")], engine_class = DynamicPromptEngine)
@@ -0,0 +1,36 @@
+import random
+from src.prompt_engine.utils.encoder import get_encoder
+from src.prompt_engine.utils.token_budget import TokenBudget
+
+SEGMENTS = ["hello", " world", " ", "   ", "\n", "\n\n", "'", "'s", "ll", "re", "42", " 7", "##", ":", "ünï", "\t", "!", "USER:", "print('x')"]
+
+def _random_text(rng):
+    return "".join(rng.choice(SEGMENTS) for _ in range(rng.randint(1, 20)))
+
+def test_pass_concat_matches_encode():
+    encoder = get_encoder()
+    token_budget = TokenBudget(encoder)
+    rng = random.Random(0)
+    for _ in range(500):
+        parts = [_random_text(rng) for _ in range(rng.randint(1, 5))]
+        span = token_budget.concat(*[token_budget.tokenize(part) for part in parts])
+        assert span.count == len(encoder.encode("".join(parts)))
+        assert span.text == "".join(parts)
+
+def test_pass_count_reuses_prefix():
+    encoder = get_encoder()
+    token_budget = TokenBudget(encoder)
+    context = "### Description\n\n"
+    for turn in ["## Hi\nprint('Hi')\n\n", "## Bye\nprint('Bye')\n\n", "  \n", "'ll"]:
+        context += turn
+        assert token_budget.count(context, "## Hello\n") == len(encoder.encode(context + "## Hello\n"))
+    assert token_budget.count("### Description\n\n") == len(encoder.encode("### Description\n\n"))
+
+def test_pass_count_with_limit():
+    encoder = get_encoder()
+    token_budget = TokenBudget(encoder)
+    context = "### Description\n\n## Hi\nprint('Hi')\n\n"
+    user_input = "## " + "very long input " * 1000 + "\n"
+    assert token_budget.count(context, user_input, limit = 100) == 101
+    assert token_budget.count(context + user_input, limit = 100) == 101
+    assert token_budget.count(context, "## Hello\n", limit = 100) == len(encoder.encode(context + "## Hello\n"))
@@ -0,0 +1,85 @@
+import numpy as np
+from src.prompt_engine.dynamic_prompt_engine import PromptBank
+from src.prompt_engine.interaction import Interaction
+from src.prompt_engine.utils.embedding_provider import HashedNgramEmbeddingProvider
+from src.prompt_engine.utils.ivf_index import recall_at_k
+from src.prompt_engine.utils.vector_index import VectorIndex
+
+def _brute_force(vectors, query, k):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    similarities = vectors @ (query / np.linalg.norm(query))
+    return list(np.argsort(-similarities)[:k])
+
+def test_pass_search_matches_brute_force():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, 32))
+    index = VectorIndex(capacity = 16)
+    # Appending in batches of different sizes grows the matrix without losing rows
+    for start, stop in [(0, 1), (1, 10), (10, 17), (17, 500)]:
+        index.add_many(vectors[start:stop])
+    assert len(index) == 500
+    for _ in range(20):
+        query = rng.normal(size=32)
+        rows, similarities = index.search(query, 7)
+        assert list(rows) == _brute_force(vectors, query, 7)
+        assert np.all(np.diff(similarities) <= 0)
+    assert len(index.search(query, 1000)[0]) == 500
+
+def test_pass_set_and_empty():
+    index = VectorIndex()
+    assert len(index.search([1.0, 0.0], 3)[0]) == 0
+    assert index.add([1.0, 0.0]) == 0
+    assert index.add([0.0, 2.0]) == 1
+    assert list(index.search([0.1, 1.0], 2)[0]) == [1, 0]
+    index.set(1, [-1.0, 0.0])
+    assert list(index.search([0.1, 1.0], 2)[0]) == [0, 1]
+    try:
+        index.add([1.0, 0.0, 0.0])
+        assert False
+    except Exception as e:
+        assert "dimension" in str(e)
+
+def test_pass_compact_types(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(2000, 256))
+    exact = VectorIndex()
+    exact.add_many(vectors)
+    for dtype, bytes_per_row, tolerance in [("float16", 512, 1e-3), ("int8", 256, 2e-2)]:
+        index = VectorIndex(dtype = dtype)
+        index.add_many(vectors)
+        assert index.row(0).dtype == np.dtype(dtype) and index.row(len(index) - 1).nbytes == bytes_per_row
+        assert recall_at_k(index, exact, rng.normal(size=(20, 256)), 10) >= 0.9
+        query = rng.normal(size=256)
+        assert np.abs(index.similarities(query) - exact.similarities(query)).max() < tolerance
+
+    # A bank of int8 embeddings stores and indexes them as int8, and retrieves the same examples as a float32 bank
+    strings = ["example %d about %s" % (i, topic) for i in range(20) for topic in ["dogs", "cats", "birds", "boats"]]
+    examples = [Interaction(string, string.split()[-1]) for string in strings]
+    banks = {}
+    for dtype in ["float32", "int8"]:
+        banks[dtype] = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path / dtype), dtype = dtype)
+        banks[dtype].add_examples(strings, examples)
+    service = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path / "int8"), dtype = "int8").openaiservice
+    assert all(vector.dtype == np.int8 for _, vector, _ in service.store.items())
+    for query in ["about dogs", "a cat", "boats and birds"]:
+        assert banks["int8"].retrieve_matched_prompts(query, 5) == banks["float32"].retrieve_matched_prompts(query, 5)
+
+def test_pass_shared_vectors(tmp_path):
+    index = VectorIndex(capacity = 2)
+    index.add_many(np.eye(3, dtype=np.float32))
+    row = index.row(2)
+    # The blocks never move, so the views of the rows stay valid as rows are added and set
+    index.add_many(np.ones((10, 3)))
+    index.set(2, [0.0, 3.0, 4.0])
+    assert np.allclose(row, [0.0, 0.6, 0.8]) and not row.flags.writeable
+
+    # The prompt bank keeps views of the rows of its index instead of its own copy of the vectors
+    prompt_bank = PromptBank(HashedNgramEmbeddingProvider(), cache_location = str(tmp_path))
+    strings = ["example %d" % i for i in range(10)]
+    prompt_bank.add_examples(strings, [Interaction(string, "response") for string in strings])
+    prompt_bank.retrieve_matched_prompts("example 3", 2)
+    prompt_bank.add_examples(["example 10"], [Interaction("example 10", "response")])
+    service = prompt_bank.openaiservice
+    partition = service._get_partitions()[None]
+    for key, row in partition.rows.items():
+        assert np.shares_memory(service.embedding_cache[key][0], partition.index.row(row))